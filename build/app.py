@@ -1,25 +1,46 @@
 import os
 import yaml
-import io
-import requests
+import queue
 import threading
 import time
 import socket
 from flask import Flask, request, jsonify, g
-from PIL import Image
 from kubernetes import client, config as k8s_config
-from prometheus_client import Counter, Gauge, generate_latest, CONTENT_TYPE_LATEST, Histogram
+# SERVER_MODE=prefork: le metriche di tutti i processi vanno in file condivisi
+# (modalità multiprocess di prometheus_client), da configurare prima dell'import
+if os.getenv("SERVER_MODE", "flask").lower() == "prefork":
+    from runtime import prefork
+    prefork.prepare_metrics_dir()
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+from runtime.forwarder import Forwarder, QueueFull
+from runtime.readiness import ReadinessTracker, READINESS_PROBE_INTERVAL
+from runtime.admission import AdmissionController, Saturated
+from runtime import wire, framestream, tracing, result_store, informer, routing, metrics
+from runtime import frame as frames
+from runtime.result_cache import ResultCache, RESULT_CACHE_ENABLED, step_signature
 import traceback
 import signal
 import sys
 
 MAX_SHUTDOWN_WAIT = 4500  # secondi (scelgo in base al worst-case)
 USE_LIGHT = os.getenv("USE_LIGHT", "false").lower() == "true"
+# Formato tra step intermedi: raw (negoziato con il prossimo step) oppure jpeg
+INTERSTEP_FORMAT = os.getenv("INTERSTEP_FORMAT", "raw").lower()
+# none | lz4 | zstd (se la libreria non è installata si usa none)
+INTERSTEP_COMPRESSION = os.getenv("INTERSTEP_COMPRESSION", "none").lower()
+if INTERSTEP_COMPRESSION not in wire.available_compressions():
+    print(f"[WARN] INTERSTEP_COMPRESSION={INTERSTEP_COMPRESSION} non disponibile, uso none")
+    INTERSTEP_COMPRESSION = "none"
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 
 
 app = Flask(__name__)
 DEFAULT_LOAD_PROFILE = os.getenv("DEFAULT_LOAD_PROFILE", "light")
+# flask (server di sviluppo, threaded) | async (ASGI su uvicorn, vedi asgi_app.py)
+# | prefork (più processi worker, modello nel processo padre, vedi runtime/prefork.py)
+SERVER_MODE = os.getenv("SERVER_MODE", "flask").lower()
+# con SERVER_MODE=prefork: canale verso il processo padre (OwnerClient), solo nei worker
+prefork_worker = None
 accepting_requests = True
 shutdown_event = threading.Event()
 
@@ -29,17 +50,22 @@ local_inflight = 0
 
 @app.route("/readyz")
 def readyz():
+    return readiness_state()
+
+
+def readiness_state():
     # se lo step corrente ha l'attributo `ready`, controllalo
-    step_ready = True
-    if pipeline and hasattr(pipeline[0], "ready"):
-        step_ready = pipeline[0].ready
+    # con step fusi devono essere pronti tutti i sotto-step
+    step_ready = all(getattr(step, "ready", True) for step in pipeline)
 
+    # formati frame accettati da questo pod (negoziazione con lo step precedente)
+    headers = {wire.FORMATS_HEADER: ",".join(wire.supported_formats())}
     if accepting_requests and step_ready:
-        return "ok", 200
+        return "ok", 200, headers
     elif not step_ready:
-        return "loading", 503
+        return "loading", 503, headers
     else:
-        return "draining", 503
+        return "draining", 503, headers
 # @app.route("/drain", methods=["POST"])
 # def drain():
 #     global accepting_requests
@@ -56,7 +82,8 @@ http_requests_total = Counter(
 http_request_in_progress = Gauge(
     'http_requests_in_progress',
     'Numero di richieste attualmente in elaborazione per step',
-    ['pipeline_id', 'step_id', 'pod_name']
+    ['pipeline_id', 'step_id', 'pod_name'],
+    multiprocess_mode="livesum"
 )
 POD_NAME = os.getenv("POD_NAME", socket.gethostname())
 
@@ -67,6 +94,26 @@ step_latency = Histogram(
     buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1200)
 )
 
+stream_frames_total = Counter(
+    "stream_frames_total",
+    "Frame ricevuti via /stream per esito (processed, forwarded, stored, dropped)",
+    ["pipeline_id", "step_id", "pod_name", "result"]
+)
+
+active_streams = Gauge(
+    "active_streams",
+    "Stream /stream attualmente aperti",
+    ["pipeline_id", "step_id", "pod_name"],
+    multiprocess_mode="livesum"
+)
+
+substep_latency = Histogram(
+    "substep_processing_time_seconds",
+    "Tempo di elaborazione per sotto-step eseguito in-process (step fusi)",
+    ["pipeline_id", "step_id", "substep_id", "pod_name"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 300)
+)
+
 def handle_sigterm(signum, frame):
     global accepting_requests
     print("[SIGTERM] Received, starting graceful shutdown")
@@ -85,6 +132,8 @@ def handle_sigterm(signum, frame):
         #     inflight = 0  # se non inizializzato, usciamo
         with inflight_lock:
             inflight = local_inflight
+        # anche i frame già accettati ma non ancora inoltrati
+        inflight += forwarder.pending()
 
         if inflight <= 0:
             print("[SIGTERM] All requests completed, exiting")
@@ -107,8 +156,15 @@ signal.signal(signal.SIGINT, handle_sigterm)
 
 @app.route("/drain", methods=["POST"])
 def drain():
+    return jsonify(start_drain()), 200
+
+
+def start_drain(broadcast=True):
     global accepting_requests
     accepting_requests = False
+    # prefork: /drain arriva a un solo worker, il processo padre lo estende agli altri
+    if broadcast and prefork_worker is not None:
+        prefork_worker.broadcast_drain()
 
     # inflight = 0
     # try:
@@ -121,32 +177,55 @@ def drain():
         inflight = local_inflight
 
     print(f"[DRAIN] draining enabled, inflight={inflight}")
-    return jsonify({"status": "draining", "inflight": inflight}), 200
+    return {"status": "draining", "inflight": inflight}
 
     
+def request_started(method, path):
+    """
+    Contabilità comune a tutti i server (Flask e ASGI).
+    Ritorna (count_inflight, rifiutata_per_draining).
+    """
+    # conta SOLO /process e /stream (uno stream conta come una richiesta)
+    count_inflight = path in ("/process", "/stream")
+
+    # se draining, rifiuta SOLO nuove /process e /stream
+    if count_inflight and not accepting_requests:
+        return False, True
+
+    # incrementa solo se è /process accettata
+    if count_inflight:
+        inflight_gauge.inc()
+        global local_inflight
+        with inflight_lock:
+            local_inflight += 1
+        counter = request_counters.get((method, path))
+        if counter is None:
+            # solo /process e /stream arrivano qui: al più qualche figlio per metodo
+            counter = request_counters[(method, path)] = http_requests_total.labels(
+                method, path, PIPELINE_ID, STEP_ID, POD_NAME
+            )
+        counter.inc()
+    return count_inflight, False
+
+
+def request_finished(count_inflight):
+    if count_inflight:
+        global local_inflight
+        with inflight_lock:
+            local_inflight -= 1
+        inflight_gauge.dec()
+
+
 @app.before_request
 def before_request():
     g.start_time = time.time()
     g.test_id = request.headers.get("X-Test-ID", "unknown")
     g.load_profile = request.headers.get("X-Load-Profile", DEFAULT_LOAD_PROFILE)
 
-    # conta SOLO /process
-    g.count_inflight = (request.path == "/process")
-
-    # se draining, rifiuta SOLO nuove /process
-    if g.count_inflight and not accepting_requests:
+    g.count_inflight, rejected = request_started(request.method, request.path)
+    if rejected:
         return jsonify({"error": "draining"}), 503
 
-    # incrementa solo se è /process accettata
-    if g.count_inflight:
-        http_request_in_progress.labels(PIPELINE_ID, STEP_ID, POD_NAME).inc()
-        global local_inflight
-        with inflight_lock:
-            local_inflight += 1
-        http_requests_total.labels(
-            request.method, request.path, PIPELINE_ID, STEP_ID, POD_NAME
-        ).inc()
-
 
     # http_request_in_progress.labels(PIPELINE_ID, STEP_ID, POD_NAME).inc()
     # http_requests_total.labels(
@@ -161,37 +240,75 @@ def before_request():
 def after_request(response):
     elapsed = time.time() - g.start_time
     # http_request_in_progress.labels(PIPELINE_ID, STEP_ID, POD_NAME).dec()
-    if getattr(g, "count_inflight", False):
-        global local_inflight
-        with inflight_lock:
-            local_inflight -= 1
-        http_request_in_progress.labels(PIPELINE_ID, STEP_ID, POD_NAME).dec()
+    request_finished(getattr(g, "count_inflight", False))
     response.headers["X-Elapsed-Time"] = str(elapsed)
     return response
 
-@app.route("/metrics")
-def metrics():
-    return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+# prefork: somma dei file di metriche di tutti i processi
+metrics_registry = prefork.metrics_registry() if SERVER_MODE == "prefork" else REGISTRY
+
+
+def metrics_payload(accept_header):
+    """(body, content_type) di /metrics: OpenMetrics, con gli exemplar, se richiesto da Accept."""
+    return metrics.exposition(metrics_registry, accept_header)
+
+
+@app.route("/metrics", endpoint="metrics")
+def metrics_route():
+    body, content_type = metrics_payload(request.headers.get("Accept"))
+    return body, 200, {'Content-Type': content_type}
 
 # Cache globale protetta da un Lock per evitare problemi di concorrenza
 active_steps_cache = set()
+# step successivo -> numero di endpoint Ready del suo Service (solo step noti)
+ready_endpoints_cache = {}
 cache_lock = threading.Lock()
+# svegliato dagli informer per ri-sondare subito la readiness dopo un cambiamento
+readiness_wakeup = threading.Event()
 
-def wait_next_ready(url, timeout=5):
-    start = time.time()
-    while time.time() - start < timeout:
-        try:
-            r = requests.get(url.replace("/process", "/readyz"), timeout=1)
-            if r.status_code == 200:
-                return True
-        except:
-            pass
-        time.sleep(0.3)
-    return False
-
-def update_kubernetes_config():
-    """Aggiorna la cache degli step attivi ogni 10 secondi."""
+
+def _steps_from_configmap(cm):
+    cm_data = yaml.safe_load((cm.data or {}).get("PIPELINE_CONFIG", "{}")) or {}
+    return {str(step["id"]) for step in cm_data.get("steps", []) if step.get("id") is not None}
+
+
+def _ready_addresses(endpoints):
+    return sum(len(subset.addresses or []) for subset in (endpoints.subsets or []))
+
+
+def _on_configmaps(items):
     global active_steps_cache
+    new_active_steps = set()
+    for steps in items.values():
+        new_active_steps |= steps or set()
+    with cache_lock:
+        changed = new_active_steps != active_steps_cache
+        active_steps_cache = new_active_steps
+    if changed:
+        readiness_wakeup.set()
+
+
+def _on_endpoints(items):
+    global ready_endpoints_cache
+    prefix = f"{PIPELINE_ID}-step-"
+    new_ready = {}
+    for name, count in items.items():
+        if name.startswith(prefix) and name[len(prefix):].isdigit():
+            new_ready[str(int(name[len(prefix):]))] = count or 0
+    with cache_lock:
+        changed = new_ready != ready_endpoints_cache
+        ready_endpoints_cache = new_ready
+    if changed:
+        readiness_wakeup.set()
+
+
+def update_kubernetes_config(watch_factory=informer.kubernetes_watch):
+    """
+    Tiene aggiornate le cache degli step attivi (ConfigMap della pipeline) e
+    degli endpoint Ready dei Service degli step con due informer (list +
+    watch, vedi runtime/informer.py), e sonda la readiness dei prossimi step
+    ogni READINESS_PROBE_INTERVAL o subito dopo un cambiamento.
+    """
     print("[INFO] Thread di aggiornamento configurazione K8s avviato.")
     
     # Carica la config una volta sola per il thread
@@ -202,36 +319,24 @@ def update_kubernetes_config():
         print(f"[ERROR] Impossibile caricare config K8s: {e}")
         return
 
+    labels = (PIPELINE_ID, STEP_ID, POD_NAME)
+    selector = f"pipeline_id={PIPELINE_ID}"
+    informer.Informer(
+        "configmaps", v1.list_namespaced_config_map, _steps_from_configmap, _on_configmaps,
+        labels=labels, watch_factory=watch_factory, namespace=NAMESPACE, label_selector=selector,
+    ).start()
+    # gli Endpoints ereditano le label del Service (pipeline_id)
+    informer.Informer(
+        "endpoints", v1.list_namespaced_endpoints, _ready_addresses, _on_endpoints,
+        labels=labels, watch_factory=watch_factory, namespace=NAMESPACE, label_selector=selector,
+    ).start()
+
     while True:
-        try:
-            # Recupera le ConfigMap
-            configmaps = v1.list_namespaced_config_map(
-                namespace=NAMESPACE,
-                label_selector=f"pipeline_id={PIPELINE_ID}"
-            )
-            
-            new_active_steps = set()
-            for cm in configmaps.items:
-                try:
-                    cm_data = yaml.safe_load(cm.data.get("PIPELINE_CONFIG", "{}"))
-                    steps = cm_data.get("steps", [])
-                    for step in steps:
-                        s_id = step.get("id")
-                        if s_id is not None:
-                            new_active_steps.add(str(s_id))
-                except Exception as e:
-                    print(f"[ERROR] Parsing ConfigMap {cm.metadata.name}: {e}")
-
-            # Aggiorna la cache in modo sicuro
-            with cache_lock:
-                active_steps_cache = new_active_steps
-            
-            # print(f"[DEBUG] Cache aggiornata: {active_steps_cache}")
-            
-        except Exception as e:
-            print(f"[ERROR] Durante l'aggiornamento cache K8s: {e}")
-        
-        time.sleep(10) # Controlla i cambiamenti ogni 10 secondi
+        with cache_lock:
+            current_active = set(active_steps_cache)
+        readiness.probe_all(only=current_active)
+        readiness_wakeup.wait(READINESS_PROBE_INTERVAL)
+        readiness_wakeup.clear()
 
 # --- Lettura config pipeline da env ---
 pipeline_yaml = os.getenv("PIPELINE_CONFIG", '{"steps":[]}')
@@ -293,110 +398,616 @@ for step_conf in config["steps"]:
         current_step_conf = step_conf
         break
 
-# Inizializza lo step corrente
+# Step fusi: la ConfigMap elenca in "fused_steps" gli id da eseguire in-process
+# nell'ordine dato; si inoltra solo dopo l'ultimo (boundary_step_conf).
+steps_by_id = {int(s.get("id", -1)): s for s in config["steps"]}
+fused_ids = [int(i) for i in config.get("fused_steps", [])] or [STEP_ID]
+chain_confs = [steps_by_id[i] for i in fused_ids if i in steps_by_id]
+boundary_step_conf = chain_confs[-1] if chain_confs else current_step_conf
+
+# Inizializza lo step corrente (o la catena di step fusi)
 pipeline = []
-if current_step_conf:
-    step_type = current_step_conf["type"]
+pipeline_ids = []
+for step_conf in chain_confs:
+    step_type = step_conf["type"]
     if step_type in available_steps:
-        pipeline.append(available_steps[step_type](**current_step_conf.get("params", {})))
-        
+        pipeline.append(available_steps[step_type](**step_conf.get("params", {})))
+        pipeline_ids.append(str(step_conf["id"]))
+if len(pipeline) > 1:
+    print(f"[INFO] Step fusi in-process: {pipeline_ids}")
+
+# Istogrammi per sotto-step (label risolte una volta sola)
+substep_timers = [substep_latency.labels(PIPELINE_ID, STEP_ID, sid, POD_NAME) for sid in pipeline_ids]
+
+# Figli delle metriche per richiesta risolti una volta sola; test_id (da X-Test-ID)
+# con valori ammessi, tetto e scadenza (runtime/metrics.py)
+inflight_gauge = http_request_in_progress.labels(PIPELINE_ID, STEP_ID, POD_NAME)
+request_counters = {}
+step_latency_by_test = metrics.BoundedLabels(step_latency, (PIPELINE_ID, STEP_ID, POD_NAME), "test_id")
+stream_frame_counters = {result: stream_frames_total.labels(PIPELINE_ID, STEP_ID, POD_NAME, result)
+                         for result in ("received", "processed", "forwarded", "stored", "dropped")}
+
+# Tracing: request id propagato tra gli step, istogrammi per fase
+# (step_phase_seconds) e export opzionale degli span (TRACE_EXPORT)
+tracer = tracing.Tracer(
+    service=f"{PIPELINE_ID}-step-{STEP_ID}",
+    labels=(PIPELINE_ID, STEP_ID, POD_NAME),
+    exporter=tracing.make_exporter(),
+)
+
+
+# Indirizzo dei prossimi step; sovrascrivibile per eseguire la pipeline fuori da
+# Kubernetes (es. "http://127.0.0.1:61{step_id:02d}" in test/bench_pipeline.py)
+NEXT_STEP_URL_TEMPLATE = os.getenv(
+    "NEXT_STEP_URL_TEMPLATE",
+    "http://{pipeline_id}-step-{step_id}.{namespace}.svc.cluster.local:{port}"
+)
+
+
+def next_step_url(step_id, path="/process"):
+    base = NEXT_STEP_URL_TEMPLATE.format(
+        pipeline_id=PIPELINE_ID, step_id=int(step_id), namespace=NAMESPACE, port=SERVICE_PORT
+    )
+    return f"{base}{path}"
+
+# Readiness dei prossimi step in cache (aggiornata da update_kubernetes_config)
+readiness = ReadinessTracker(labels=(PIPELINE_ID, STEP_ID, POD_NAME))
+_configured_next = (boundary_step_conf or {}).get("next_step") or []
+if isinstance(_configured_next, (str, int)):
+    _configured_next = [_configured_next]
+# Scelta tra più next_step (ROUTING_STRATEGY, vedi runtime/routing.py)
+router = routing.Router(labels=(PIPELINE_ID, STEP_ID, POD_NAME))
+for _s in _configured_next:
+    readiness.register(_s, next_step_url(_s))
+    router.register(_s, next_step_url(_s))
+
+# Inoltro asincrono con pool di worker e connessioni keep-alive
+forwarder = Forwarder(labels=(PIPELINE_ID, STEP_ID, POD_NAME), on_result=readiness.record,
+                      on_response=router.observe)
+if SERVER_MODE != "prefork":
+    forwarder.start()  # prefork: lo avvia ogni worker dopo il fork
+
+# Admission control: fasi CPU (decode/encode/inoltro) e acceleratore
+# (step.run se lo step usa la GPU) con limiti e code separate.
+# Gli step che raggruppano in batch (es. classifier_light) dichiarano `concurrency`
+_accel_default = max([getattr(step, "concurrency", 1) for step in pipeline] or [1])
+admission = AdmissionController(
+    labels=(PIPELINE_ID, STEP_ID, POD_NAME),
+    accel_concurrency=int(os.getenv("ADMISSION_ACCEL_CONCURRENCY", _accel_default)),
+)
+COMPUTE_STAGE = "accel" if any(int(c.get("gpu", 0) or 0) > 0 for c in chain_confs) else "cpu"
+
+
+def decode_image(data, content_type, min_side=None):
+    """bytes -> runtime.frame.Frame; min_side: lato minore che basta al primo step (decode ridotto)."""
+    if wire.is_raw(content_type):
+        # frame raw da uno step precedente: nessun decode, vista sul buffer ricevuto
+        return frames.decode_raw(wire.decode_frame(data))
+    return frames.decode_image(data, min_side)
 
-def send_to_next_step_async(url, files, headers):
+
+class UploadedFrame:
+    """
+    Frame ricevuto come upload multipart da Flask (FileStorage).
+    Stessa interfaccia del frame in streaming del server ASGI:
+    decode(min_side) -> Frame, read_bytes() -> byte originali (per la cache).
+    """
+
+    def __init__(self, file_storage):
+        self.file = file_storage
+
+    def decode(self, min_side=None):
+        return decode_image(self.file.read(), self.file.mimetype, min_side)
+
+    def read_bytes(self):
+        data = self.file.read()
+        self.file.stream.seek(0)
+        return data
+
+
+class BytesFrame:
+    """Frame già in memoria (record di /stream): stessa interfaccia di UploadedFrame."""
+
+    def __init__(self, data, content_type):
+        self.data = data
+        self.content_type = content_type
+        self._image = None
+
+    def decode(self, min_side=None):
+        # decodificato una volta (fase decode di /stream), riusato dalla fase step
+        if self._image is None:
+            self._image = decode_image(self.data, self.content_type, min_side)
+        return self._image
+
+    def read_bytes(self):
+        return self.data
+
+
+# Job: l'ultimo step scrive il risultato nello store (JOB_STORE), il client
+# lo recupera con GET /jobs/<id> o lo riceve su X-Callback-URL
+job_store = result_store.make_store()
+if job_store is not None:
+    print(f"[INFO] Result store dei job: {result_store.JOB_STORE}")
+
+
+def _job_update(job_id, status, error=None):
+    if job_store is None:
+        return
     try:
-        requests.post(url, files=files, headers=headers, timeout=300)
+        job_store.set_status(job_id, status, error)
     except Exception as e:
-        print(f"[WARN] Async send failed: {e}")
-        
-ram_semaphore = threading.Semaphore(1) 
+        print(f"[WARN] Aggiornamento job {job_id} fallito: {e}")
 
-@app.route("/process", methods=["POST"])
-def process():
-    # Usiamo il semaforo per assicurarci che solo N richieste alla volta carichino immagini
-    with ram_semaphore:
+
+def _job_result(job_id, data, content_type, callback_url):
+    if job_store is not None:
+        try:
+            job_store.put_result(job_id, data, content_type)
+        except Exception as e:
+            print(f"[WARN] Salvataggio risultato job {job_id} fallito: {e}")
+    if callback_url:
+        try:
+            forwarder.submit(callback_url, data, filename="result.jpg", content_type=content_type,
+                             headers={"X-Job-ID": job_id})
+        except QueueFull:
+            print(f"[WARN] Callback del job {job_id} scartata: coda di inoltro piena")
+
+
+def _forward_done(trace, url):
+    """on_done dell'inoltro: chiude il tracing e segna il job fallito se l'invio non è andato."""
+    def done(ok, enqueued, end):
+        router.finished(url)
+        trace.forwarded(ok, enqueued, end)
+        if not ok:
+            _job_update(trace.request_id, result_store.FAILED, "inoltro al prossimo step fallito")
+    return done
+
+
+def job_status(job_id):
+    """Ritorna (payload, status, headers) per GET /jobs/<id>."""
+    if job_store is None:
+        return {"error": "job store disabilitato (JOB_STORE)"}, 404, {}
+    meta = job_store.get(job_id)
+    if meta is None:
+        return {"error": "job sconosciuto o scaduto"}, 404, {}
+    payload = {"job_id": job_id}
+    payload.update(meta)
+    if meta.get("status") == result_store.DONE:
+        payload["result"] = f"/jobs/{job_id}/result"
+    return payload, 200, {}
+
+
+def job_result(job_id):
+    """Ritorna (payload, status, headers) per GET /jobs/<id>/result: bytes se pronto."""
+    payload, status, headers = job_status(job_id)
+    if status != 200:
+        return payload, status, headers
+    if payload["status"] == result_store.PENDING:
+        return payload, 202, {"Retry-After": "1"}
+    if payload["status"] == result_store.FAILED:
+        return payload, 500, {}
+    found = job_store.get_result(job_id)
+    if found is None:
+        return {"error": "risultato non più disponibile"}, 404, {}
+    data, content_type = found
+    return data, 200, {"Content-Type": content_type}
+
+
+# Cache dei risultati: solo se tutti gli step eseguiti in questo pod sono deterministici
+result_cache = None
+if RESULT_CACHE_ENABLED and pipeline and all(getattr(step, "deterministic", False) for step in pipeline):
+    result_cache = ResultCache(labels=(PIPELINE_ID, STEP_ID, POD_NAME), signature=step_signature(chain_confs))
+    print("[INFO] Cache dei risultati attiva")
+
+
+def input_min_side(load_profile):
+    """Lato minore dichiarato dal primo step (input_min_side), per il decode JPEG ridotto."""
+    declare = getattr(pipeline[0], "input_min_side", None) if pipeline else None
+    return declare(load_profile) if declare is not None else None
+
+
+def run_step(step, image, load_profile):
+    """Gli step con accepts_frame ricevono il Frame senza copie, gli altri una PIL Image RGB."""
+    if not getattr(step, "accepts_frame", False):
+        image = image.to_pil()
+    return frames.as_frame(step.run(image, load_profile=load_profile))
+
+
+def run_pipeline(frame, test_id, load_profile, trace):
+    with admission.stage("cpu", on_wait=trace.queue_wait):
+        with trace.phase("decode"):
+            image = frame.decode(input_min_side(load_profile))
+
+    # Esecuzione della pipeline (con il tempo misurato per Prometheus)
+    with admission.stage(COMPUTE_STAGE, on_wait=trace.queue_wait):
+        with metrics.timed(step_latency_by_test.child(test_id), trace.request_id), trace.phase("compute"):
+            for step, timer in zip(pipeline, substep_timers):
+                with timer.time():
+                    image = run_step(step, image, load_profile)
+    return image
+
+
+def run_pipeline_cached(frame, test_id, load_profile, trace):
+    """Come run_pipeline, ma con lookup per contenuto (byte in ingresso + step + profilo)."""
+    key = result_cache.key(frame.read_bytes(), load_profile)
+
+    cached, lead = result_cache.begin(key)
+    if cached is not None:
+        return frames.decode_raw(wire.decode_frame(cached))
+    if not lead:
+        return run_pipeline(frame, test_id, load_profile, trace)
+
+    try:
+        image = run_pipeline(frame, test_id, load_profile, trace)
+    except Exception:
+        result_cache.finish(key, None)
+        raise
+    result_cache.finish(key, wire.encode_frame(image.channels()))
+    return image
+
+
+def choose_next_step():
+    """Ritorna (chosen_next, errore_json, status)."""
+    next_steps = boundary_step_conf.get("next_step", None)
+    if isinstance(next_steps, (str, int)):
+        next_steps = [next_steps]
+
+    # Leggi dalla CACHE aggiornata dal thread di background
+    with cache_lock:
+        current_active = list(active_steps_cache)
+
+    # Filtra e seleziona il prossimo step
+    available_next = [s for s in next_steps if str(s) in current_active]
+    if not available_next:
+        return None, {"error": "Nessun prossimo step attivo"}, 500
+
+    # Readiness letta dalla cache, nessun probe sincrono qui; un Service senza
+    # endpoint Ready (visto dall'informer) esclude lo step anche prima del probe
+    with cache_lock:
+        no_endpoints = {step for step, count in ready_endpoints_cache.items() if count == 0}
+    available_next = [s for s in available_next
+                      if str(s) not in no_endpoints and readiness.is_ready(next_step_url(s))]
+    if not available_next:
+        return None, {"error": "next step not ready"}, 503
+
+    # Selezione secondo ROUTING_STRATEGY (default: preferito o il primo disponibile)
+    preferred = boundary_step_conf.get("preferred_next")
+    candidates = [(s, next_step_url(s)) for s in sorted(available_next)]
+    return router.choose(candidates, preferred), None, None
+
+
+def encode_for_next(image, next_url, trace):
+    """Se il prossimo step accetta il formato raw si evita l'encode JPEG."""
+    raw_fmt = wire.format_name(INTERSTEP_COMPRESSION)
+    with trace.phase("encode"):
+        if INTERSTEP_FORMAT == "raw" and readiness.accepts(next_url, raw_fmt):
+            return wire.encode_frame(image.channels(), INTERSTEP_COMPRESSION), "frame.raw", wire.CONTENT_TYPE_RAW
+        return image.encode_jpeg(), "frame.jpg", wire.CONTENT_TYPE_JPEG
+
+
+def handle_process(frame, test_id, load_profile, incoming=None, callback_url=None):
+    """
+    Logica di /process indipendente dal server (Flask o ASGI).
+    incoming: header di tracing della richiesta (tracing.extract).
+    callback_url: X-Callback-URL, a cui l'ultimo step invia il risultato.
+    Ritorna (payload, status, headers): payload è bytes (immagine) o dict (JSON).
+    """
+    trace = tracer.begin(incoming)
+    # primo step della pipeline: il request id diventa l'id del job
+    entry = trace.parent_span is None
+    if entry:
+        _job_update(trace.request_id, result_store.PENDING)
+
+    payload, status, headers = _process(frame, test_id, load_profile, trace, callback_url)
+    # se inoltrato, lo span dello step si chiude a invio concluso (Forwarder on_done)
+    if status != 202:
+        trace.finish(status=status)
+    # 429 (o 503 con Retry-After) = "riprova": chi ha inviato il frame ritenta
+    # (Forwarder, FORWARD_MAX_RETRIES) e segna il job fallito solo se rinuncia
+    retryable = status == 429 or (status == 503 and "Retry-After" in headers)
+    if status >= 400 and not retryable:
+        _job_update(trace.request_id, result_store.FAILED,
+                    payload.get("error") if isinstance(payload, dict) else status)
+
+    headers = dict(headers)
+    headers[tracing.HEADER_REQUEST_ID] = trace.request_id
+    if job_store is not None and entry and status == 202:
+        payload = dict(payload)
+        payload["job_id"] = trace.request_id
+        headers["Location"] = f"/jobs/{trace.request_id}"
+    return payload, status, headers
+
+
+def _process(frame, test_id, load_profile, trace, callback_url):
+    if not accepting_requests:
+        return {"error": "draining"}, 503, {}
+    try:
+        if result_cache is not None:
+            image = run_pipeline_cached(frame, test_id, load_profile, trace)
+        else:
+            image = run_pipeline(frame, test_id, load_profile, trace)
+
+        # Se è l'ultimo step della catena
+        if not boundary_step_conf.get("next_step", None):
+            with admission.stage("cpu", on_wait=trace.queue_wait):
+                with trace.phase("encode"):
+                    data = image.encode_jpeg()
+            trace.end_to_end()
+            if job_store is not None or callback_url:
+                _job_result(trace.request_id, data, "image/jpeg", callback_url)
+                if job_store is not None and trace.parent_span:
+                    # arrivato da uno step precedente: il risultato è nello store,
+                    # non serve rimandare l'immagine indietro lungo la catena
+                    return {"status": "stored", "job_id": trace.request_id}, 200, {}
+            return data, 200, {"Content-Type": "image/jpeg"}
+
+        chosen_next, error, status = choose_next_step()
+        if error:
+            return error, status, {}
+        next_url = next_step_url(chosen_next)
+
+        # il posto "cpu" copre solo l'encode: submit con FORWARD_QUEUE_POLICY=block
+        # può attendere fino a FORWARD_BLOCK_TIMEOUT e non deve fermare decode ed encode
+        with admission.stage("cpu", on_wait=trace.queue_wait):
+            body, filename, content_type = encode_for_next(image, next_url, trace)
+
+        # Invia immagine in modo asincrono per non tenere bloccato Locust
+        fwd_headers = {
+            "X-Test-ID": test_id,
+            "X-Load-Profile": load_profile,  # 🔹 PROPAGAZIONE
+        }
+        # request id, span padre e istante di ingresso nella pipeline
+        fwd_headers.update(trace.headers())
+        if callback_url:
+            fwd_headers["X-Callback-URL"] = callback_url
         if not accepting_requests:
-            return jsonify({"error": "draining"}), 503    
+            return {"error": "draining"}, 503, {}
+        router.started(next_url)
         try:
-            image_file = request.files["image"]
-            image = Image.open(image_file).convert("RGB")
-            
-            # Esecuzione della pipeline (con il tempo misurato per Prometheus)
-            with step_latency.labels(PIPELINE_ID, STEP_ID, POD_NAME, g.test_id).time():
-                for step in pipeline:
-                    image = step.run(image, load_profile=g.load_profile)
-
-
-            # Determina il prossimo step dalla config locale
-            next_steps = current_step_conf.get("next_step", None)
-            
-            # Se è l'ultimo step della catena
-            if not next_steps:
-                output = io.BytesIO()
-                image.save(output, format="JPEG")
-                output.seek(0)
-                return output.read(), 200, {"Content-Type": "image/jpeg"}
-
-            if isinstance(next_steps, (str, int)):
-                next_steps = [next_steps]
-
-            # Leggi dalla CACHE aggiornata dal thread di background
-            with cache_lock:
-                current_active = list(active_steps_cache)
-
-            # Filtra e seleziona il prossimo step
-            available_next = [s for s in next_steps if str(s) in current_active]
-            
-            if not available_next:
-                return jsonify({"error": "Nessun prossimo step attivo"}), 500
-
-            # Logica di selezione (Preferito o il primo disponibile)
-            preferred = current_step_conf.get("preferred_next")
-            if preferred and str(preferred) in available_next:
-                chosen_next = preferred
-            else:
-                chosen_next = sorted(available_next)[0]
-
-            # Costruisci URL
-            next_url = f"http://{PIPELINE_ID}-step-{chosen_next}.{NAMESPACE}.svc.cluster.local:{SERVICE_PORT}/process"
-
-            # Invia immagine in modo asincrono per non tenere bloccato Locust
-            buf = io.BytesIO()
-            image.save(buf, format="JPEG")
-            buf.seek(0)
-            files = {"image": ("frame.jpg", buf, "image/jpeg")}
-            
-            fwd_headers = {
-                "X-Test-ID": g.test_id,
-                "X-Load-Profile": g.load_profile,  # 🔹 PROPAGAZIONE
-            }
-            if not accepting_requests:
-                return jsonify({"error": "draining"}), 503
-            if not wait_next_ready(next_url):
-                return jsonify({"error": "next step not ready"}), 503
-            threading.Thread(
-                target=send_to_next_step_async,
-                args=(next_url, files, fwd_headers),
-                daemon=True
-            ).start()
-            with inflight_lock:
-                inflight = local_inflight
-            headers = {
-                "X-Step-ID": str(STEP_ID),
-                "X-Pod-Name": POD_NAME,
-                "X-In-Flight": str(inflight)
-            }
-            return jsonify({"status": "forwarded", "next": chosen_next}), 202, headers
+            forwarder.submit(next_url, body, filename=filename, content_type=content_type,
+                             headers=fwd_headers, on_done=_forward_done(trace, next_url))
+        except QueueFull:
+            router.finished(next_url)
+            return {"error": "forward queue full"}, 503, {}
+
+        with inflight_lock:
+            inflight = local_inflight
+        headers = {
+            "X-Step-ID": str(STEP_ID),
+            "X-Pod-Name": POD_NAME,
+            "X-In-Flight": str(inflight),
+            "X-Queue-Length": str(admission.queue_length()),
+        }
+        return {"status": "forwarded", "next": chosen_next}, 202, headers
+
+    except Saturated as e:
+        return {"error": f"{e.stage} saturated"}, 429, {"Retry-After": str(e.retry_after)}
+    except Exception as e:
+        print(f"[ERROR] /process: {e}")
+        traceback.print_exc()
+        return {"error": str(e)}, 500, {}
 
+
+_STREAM_END = object()
+
+
+def _retry_saturated(fn):
+    """In uno stream una fase satura rallenta il mittente invece di scartare il frame."""
+    while True:
+        try:
+            return fn()
+        except Saturated as e:
+            time.sleep(min(e.retry_after, 1))
+
+
+def _stream_stage(work, inbox, outbox, count):
+    """Una fase di /stream: un solo thread FIFO, quindi l'ordine dei frame resta invariato."""
+    while True:
+        item = inbox.get()
+        if item is _STREAM_END:
+            if outbox is not None:
+                outbox.put(_STREAM_END)
+            return
+        seq, value = item
+        try:
+            value = work(seq, value)
+        except Exception as e:
+            print(f"[WARN] /stream: frame {seq} scartato: {e}")
+            count("dropped")
+            continue
+        if outbox is not None:
+            outbox.put((seq, value))
+
+
+def handle_stream(records, test_id, load_profile, incoming=None, callback_url=None):
+    """
+    Logica di /stream indipendente dal server (Flask o ASGI).
+    I frame di una connessione attraversano tre fasi (decode, step,
+    encode/inoltro), ognuna in un thread con coda limitata: decode, calcolo
+    e invio si sovrappongono, l'ordine è preservato e le code piene fermano
+    la lettura dal client (backpressure). Gli step intermedi inoltrano su un
+    solo stream verso il prossimo step; l'ultimo step salva ogni frame
+    finale come fa /process (JOB_STORE e/o X-Callback-URL), con job id
+    "<request id>-<seq>".
+    Ritorna (riepilogo dict, status, headers) a fine stream.
+    """
+    if not accepting_requests:
+        return {"error": "draining"}, 503, {}
+
+    # un solo contesto di tracing per tutto lo stream
+    trace = tracer.begin(incoming)
+    sender = None
+    chosen_next = None
+    if boundary_step_conf.get("next_step", None):
+        chosen_next, error, status = choose_next_step()
+        if error:
+            return error, status, {}
+        fwd_headers = {"X-Test-ID": test_id, "X-Load-Profile": load_profile}
+        fwd_headers.update(trace.headers())
+        if callback_url:
+            fwd_headers["X-Callback-URL"] = callback_url
+        sender = framestream.StreamSender(next_step_url(chosen_next, "/stream"), headers=fwd_headers).start()
+
+    elif job_store is None and not callback_url:
+        print("[WARN] /stream sull'ultimo step senza JOB_STORE né X-Callback-URL: i frame finali non vengono salvati")
+
+    stats = {"received": 0, "processed": 0, "forwarded": 0, "stored": 0, "dropped": 0}
+    stats_lock = threading.Lock()
+
+    def count(result):
+        with stats_lock:
+            stats[result] += 1
+        stream_frame_counters[result].inc()
+
+    def decode(seq, frame):
+        def work():
+            with admission.stage("cpu", on_wait=trace.queue_wait):
+                with trace.phase("decode"):
+                    frame.decode(input_min_side(load_profile))
+        _retry_saturated(work)
+        return frame
+
+    def compute(seq, frame):
+        run = run_pipeline_cached if result_cache is not None else run_pipeline
+        image = _retry_saturated(lambda: run(frame, test_id, load_profile, trace))
+        count("processed")
+        return image
+
+    def store(seq, image):
+        """Ultimo step: frame finale nello store dei job e/o alla callback."""
+        if job_store is None and not callback_url:
+            return image
+
+        def work():
+            with admission.stage("cpu", on_wait=trace.queue_wait):
+                with trace.phase("encode"):
+                    return image.encode_jpeg()
+        data = _retry_saturated(work)
+        _job_result(f"{trace.request_id}-{seq}", data, "image/jpeg", callback_url)
+        count("stored")
+        return image
+
+    def forward(seq, image):
+        if sender is None:
+            return store(seq, image)
+        next_url = next_step_url(chosen_next)
+
+        def work():
+            with admission.stage("cpu", on_wait=trace.queue_wait):
+                return encode_for_next(image, next_url, trace)
+        body, _, content_type = _retry_saturated(work)
+        with trace.phase("forward"):
+            sender.send(framestream.kind_for(content_type), seq, body)
+        count("forwarded")
+        return image
+
+    queues = [queue.Queue(maxsize=framestream.STREAM_QUEUE_SIZE) for _ in range(3)]
+    stages = [(decode, queues[0], queues[1]), (compute, queues[1], queues[2]), (forward, queues[2], None)]
+    threads = [threading.Thread(target=_stream_stage, args=(work, inbox, outbox, count), daemon=True)
+               for work, inbox, outbox in stages]
+    for t in threads:
+        t.start()
+
+    streams_gauge = active_streams.labels(PIPELINE_ID, STEP_ID, POD_NAME)
+    streams_gauge.inc()
+    error = None
+    status = 200
+    last_seq = -1
+    try:
+        for kind, seq, payload in records:
+            if not accepting_requests:
+                error, status = "draining", 503
+                break
+            if seq <= last_seq:
+                # duplicato o fuori ordine
+                count("dropped")
+                continue
+            last_seq = seq
+            count("received")
+            queues[0].put((seq, BytesFrame(payload, framestream.content_type_for(kind))))
+    except Exception as e:
+        print(f"[ERROR] /stream: {e}")
+        error, status = str(e), 400
+    finally:
+        queues[0].put(_STREAM_END)
+        for t in threads:
+            t.join()
+        streams_gauge.dec()
+
+    summary = dict(stats)
+    summary["status"] = "completed" if error is None else "aborted"
+    summary["last_seq"] = last_seq
+    if error is not None:
+        summary["error"] = error
+    if sender is None and job_store is not None:
+        summary["results"] = f"/jobs/{trace.request_id}-<seq>/result"
+    if sender is not None:
+        summary["next"] = chosen_next
+        try:
+            summary["downstream"] = sender.close(last_seq + 1)
         except Exception as e:
-            print(f"[ERROR] /process: {e}")
-            traceback.print_exc()
-            return jsonify({"error": str(e)}), 500
+            print(f"[ERROR] /stream verso step {chosen_next}: {e}")
+            readiness.record(next_step_url(chosen_next), False)
+            summary["downstream_error"] = str(e)
+            if error is None:
+                status = 502
+    trace.finish(status=status, frames=stats["received"])
+    return summary, status, {"X-Step-ID": str(STEP_ID), "X-Pod-Name": POD_NAME,
+                             tracing.HEADER_REQUEST_ID: trace.request_id}
+
+
+@app.route("/stream", methods=["POST"])
+def stream():
+    records = framestream.iter_records(request.stream)
+    payload, status, headers = handle_stream(records, g.test_id, g.load_profile,
+                                             tracing.extract(request.headers.get),
+                                             request.headers.get("X-Callback-URL"))
+    return jsonify(payload), status, headers
+
+
+@app.route("/jobs/<job_id>")
+def job(job_id):
+    payload, status, headers = job_status(job_id)
+    return jsonify(payload), status, headers
+
+
+@app.route("/jobs/<job_id>/result")
+def job_result_route(job_id):
+    payload, status, headers = job_result(job_id)
+    if isinstance(payload, dict):
+        payload = jsonify(payload)
+    return payload, status, headers
+
+
+@app.route("/process", methods=["POST"])
+def process():
+    try:
+        frame = UploadedFrame(request.files["image"])
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    payload, status, headers = handle_process(frame, g.test_id, g.load_profile,
+                                              tracing.extract(request.headers.get),
+                                              request.headers.get("X-Callback-URL"))
+    if isinstance(payload, dict):
+        payload = jsonify(payload)
+    return payload, status, headers
 
 if __name__ == "__main__":
     import logging
     logging.basicConfig(level=logging.INFO)
     
+    if SERVER_MODE == "prefork":
+        # worker sulla stessa porta; informer e forwarder partono in ogni worker
+        sys.exit(prefork.serve(sys.modules[__name__]))
+
     # Avvio thread per configurazione K8s
     threading.Thread(target=update_kubernetes_config, daemon=True).start()
+
+    if SERVER_MODE == "async":
+        # server ASGI (uvicorn): stesso contratto /process, /readyz, /drain, /metrics
+        from asgi_app import serve
+        serve(sys.modules[__name__])
+        sys.exit(0)
     
     # threaded=True serve per far rispondere il pod alle metriche 
     # mentre sta elaborando un'immagine (altrimenti Prometheus va in timeout)
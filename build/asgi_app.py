@@ -0,0 +1,352 @@
+import asyncio
+import json
+import os
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import ImageFile
+
+from runtime import wire, framestream, tracing
+from runtime import frame as frames
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    from multipart.multipart import MultipartParser, parse_options_header
+
+# --- Config (sovrascrivibile da env / ConfigMap) ---
+# thread per il lavoro bloccante (decode, step.run, encode, inoltro)
+SERVER_EXECUTOR_WORKERS = int(os.getenv("SERVER_EXECUTOR_WORKERS", "8"))
+# connessioni contemporanee prima di rispondere 503 (limit_concurrency di uvicorn)
+SERVER_CONNECTION_LIMIT = int(os.getenv("SERVER_CONNECTION_LIMIT", "128"))
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", "2048"))
+
+# attesa tra due tentativi di accodare un record di /stream a coda piena
+STREAM_PUT_POLL = 0.005
+
+
+class StreamingFrame:
+    """
+    Frame ricevuto in streaming: i chunk del corpo vengono passati al
+    decoder man mano che arrivano (ImageFile.Parser per JPEG/PNG, buffer per
+    il formato raw), così il decode si sovrappone alla ricezione.
+    Stessa interfaccia di app.UploadedFrame: decode() e read_bytes().
+    """
+
+    def __init__(self, content_type, keep_bytes=False):
+        self.raw = wire.is_raw(content_type)
+        self.parser = None if self.raw else ImageFile.Parser()
+        self.keep_bytes = keep_bytes or self.raw
+        self.chunks = []
+        self.size = 0
+        self._image = None
+
+    def feed(self, data):
+        if not data:
+            return
+        self.size += len(data)
+        if self.parser is not None:
+            self.parser.feed(data)
+        if self.keep_bytes:
+            self.chunks.append(bytes(data))
+
+    def decode(self, min_side=None):
+        # il JPEG è già decodificato durante la ricezione: min_side non si applica
+        if self._image is None:
+            if self.size == 0:
+                raise ValueError("frame vuoto")
+            if self.raw:
+                self._image = frames.decode_raw(wire.decode_frame(b"".join(self.chunks)))
+            else:
+                self._image = frames.Frame.from_pil(self.parser.close())
+        return self._image
+
+    def read_bytes(self):
+        return b"".join(self.chunks)
+
+
+class _MultipartImage:
+    """Estrae in streaming la parte "image" di un corpo multipart/form-data."""
+
+    def __init__(self, boundary, keep_bytes):
+        self.keep_bytes = keep_bytes
+        self.frame = None
+        self._headers = {}
+        self._field = b""
+        self._value = b""
+        self._current = None
+        callbacks = {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+        }
+        self.parser = MultipartParser(boundary, callbacks)
+
+    def write(self, data):
+        self.parser.write(data)
+
+    def _on_part_begin(self):
+        self._headers = {}
+        self._current = None
+
+    def _on_header_field(self, data, start, end):
+        self._field += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._field.lower()] = self._value
+        self._field = b""
+        self._value = b""
+
+    def _on_headers_finished(self):
+        _, params = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if params.get(b"name") == b"image" and self.frame is None:
+            content_type = self._headers.get(b"content-type", b"application/octet-stream").decode("latin-1")
+            self.frame = StreamingFrame(content_type, keep_bytes=self.keep_bytes)
+            self._current = self.frame
+
+    def _on_part_data(self, data, start, end):
+        if self._current is not None:
+            self._current.feed(data[start:end])
+
+
+def _records_from(q):
+    """Iteratore bloccante sui record messi in coda dall'event loop (None = fine)."""
+    while True:
+        item = q.get()
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+async def _put_while_running(q, item, future):
+    """
+    Accoda con backpressure finché l'handler dello stream è attivo: put
+    non bloccante dall'event loop, senza occupare thread dell'executor
+    (che servono all'handler stesso per svuotare la coda).
+    """
+    while not future.done():
+        try:
+            q.put_nowait(item)
+            return True
+        except queue.Full:
+            await asyncio.sleep(STREAM_PUT_POLL)
+    return False
+
+
+def create_app(core):
+    """Applicazione ASGI che espone le stesse route di app.py usando la logica di `core`."""
+    executor = ThreadPoolExecutor(max_workers=SERVER_EXECUTOR_WORKERS, thread_name_prefix="asgi-worker")
+    # un thread per stream aperto, separato da `executor`: uno stream resta
+    # bloccato sulla propria coda per tutta la connessione e non deve togliere
+    # thread a /process, /metrics e agli altri stream
+    stream_executor = ThreadPoolExecutor(max_workers=SERVER_CONNECTION_LIMIT, thread_name_prefix="asgi-stream")
+
+    async def send_response(send, status, body, headers):
+        raw_headers = [(k.lower().encode("latin-1"), str(v).encode("latin-1")) for k, v in headers.items()]
+        await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+        await send({"type": "http.response.body", "body": body})
+
+    async def send_json(send, status, payload, headers=None):
+        headers = dict(headers or {})
+        headers["Content-Type"] = "application/json"
+        await send_response(send, status, json.dumps(payload).encode(), headers)
+
+    async def read_frame(receive, content_type, loop):
+        keep_bytes = core.result_cache is not None
+        mimetype, params = parse_options_header(content_type)
+        if mimetype == b"multipart/form-data":
+            target = _MultipartImage(params.get(b"boundary", b""), keep_bytes)
+        else:
+            # corpo = frame direttamente (image/jpeg o application/x-raw-frame)
+            target = StreamingFrame(content_type, keep_bytes=keep_bytes)
+
+        write = target.write if isinstance(target, _MultipartImage) else target.feed
+        more = True
+        while more:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise ConnectionError("client disconnesso")
+            chunk = message.get("body", b"")
+            more = message.get("more_body", False)
+            if chunk:
+                # parsing/decode incrementale fuori dall'event loop
+                await loop.run_in_executor(executor, write, chunk)
+
+        frame = target.frame if isinstance(target, _MultipartImage) else target
+        if frame is None:
+            raise KeyError("image")
+        return frame
+
+    async def handle_stream(receive, headers, loop):
+        records = queue.Queue(maxsize=framestream.STREAM_QUEUE_SIZE)
+        future = loop.run_in_executor(
+            stream_executor, core.handle_stream, _records_from(records),
+            headers.get("x-test-id", "unknown"),
+            headers.get("x-load-profile", core.DEFAULT_LOAD_PROFILE),
+            tracing.extract(lambda name: headers.get(name.lower())), headers.get("x-callback-url"),
+        )
+        parser = framestream.RecordParser()
+        more = True
+        try:
+            while more and not parser.ended:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    raise ConnectionError("client disconnesso")
+                more = message.get("more_body", False)
+                for record in parser.feed(message.get("body", b"")):
+                    if record[0] == framestream.KIND_END:
+                        break
+                    if not await _put_while_running(records, record, future):
+                        more = False
+                        break
+            if parser.pending_bytes() and not parser.ended:
+                raise ValueError("stream troncato a metà record")
+        except Exception as e:
+            await _put_while_running(records, e, future)
+        await _put_while_running(records, None, future)
+        return await future
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    executor.shutdown(wait=False)
+                    stream_executor.shutdown(wait=False)
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+
+        if scope["type"] != "http":
+            return
+
+        start = time.time()
+        path = scope["path"]
+        method = scope["method"]
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        loop = asyncio.get_event_loop()
+
+        if path == "/readyz" and method == "GET":
+            text, status, extra = core.readiness_state()
+            extra = dict(extra)
+            extra["Content-Type"] = "text/plain"
+            await send_response(send, status, text.encode(), extra)
+            return
+
+        if path == "/metrics" and method == "GET":
+            body, content_type = await loop.run_in_executor(executor, core.metrics_payload, headers.get("accept"))
+            await send_response(send, 200, body, {"Content-Type": content_type})
+            return
+
+        if path.startswith("/jobs/") and method == "GET":
+            parts = path[len("/jobs/"):].split("/")
+            if len(parts) == 1:
+                # lo store può essere su disco o redis: I/O fuori dall'event loop
+                payload, status, extra = await loop.run_in_executor(executor, core.job_status, parts[0])
+            elif len(parts) == 2 and parts[1] == "result":
+                payload, status, extra = await loop.run_in_executor(executor, core.job_result, parts[0])
+            else:
+                await send_json(send, 404, {"error": "not found"})
+                return
+            if isinstance(payload, dict):
+                await send_json(send, status, payload, extra)
+            else:
+                await send_response(send, status, payload, extra)
+            return
+
+        if path == "/drain" and method == "POST":
+            await send_json(send, 200, core.start_drain())
+            return
+
+        if path == "/stream" and method == "POST":
+            count_inflight, rejected = core.request_started(method, path)
+            if rejected:
+                await send_json(send, 503, {"error": "draining"})
+                return
+            try:
+                payload, status, extra = await handle_stream(receive, headers, loop)
+                extra = dict(extra)
+                extra["X-Elapsed-Time"] = time.time() - start
+                await send_json(send, status, payload, extra)
+            finally:
+                core.request_finished(count_inflight)
+            return
+
+        if path != "/process" or method != "POST":
+            await send_json(send, 404, {"error": "not found"})
+            return
+
+        count_inflight, rejected = core.request_started(method, path)
+        if rejected:
+            await send_json(send, 503, {"error": "draining"})
+            return
+        try:
+            test_id = headers.get("x-test-id", "unknown")
+            load_profile = headers.get("x-load-profile", core.DEFAULT_LOAD_PROFILE)
+            try:
+                frame = await read_frame(receive, headers.get("content-type", ""), loop)
+            except ConnectionError:
+                return
+            except Exception as e:
+                await send_json(send, 500, {"error": str(e)}, {"X-Elapsed-Time": time.time() - start})
+                return
+
+            payload, status, extra = await loop.run_in_executor(
+                executor, core.handle_process, frame, test_id, load_profile,
+                tracing.extract(lambda name: headers.get(name.lower())), headers.get("x-callback-url")
+            )
+            extra = dict(extra)
+            extra["X-Elapsed-Time"] = time.time() - start
+            if isinstance(payload, dict):
+                await send_json(send, status, payload, extra)
+            else:
+                await send_response(send, status, payload, extra)
+        finally:
+            core.request_finished(count_inflight)
+
+    return app
+
+
+def serve(core):
+    """Avvia uvicorn mantenendo lo shutdown graduale di app.handle_sigterm."""
+    import uvicorn
+
+    config = uvicorn.Config(
+        create_app(core),
+        host="0.0.0.0",
+        port=int(core.SERVICE_PORT),
+        limit_concurrency=SERVER_CONNECTION_LIMIT,
+        backlog=SERVER_BACKLOG,
+        lifespan="on",
+        access_log=False,
+    )
+    server = uvicorn.Server(config)
+    # I segnali restano gestiti da app.handle_sigterm: attende gli inflight e
+    # poi esce. Lo eseguiamo in un thread per non bloccare l'event loop che
+    # deve completare proprio quelle richieste.
+    server.install_signal_handlers = lambda: None
+
+    def on_signal(signum):
+        threading.Thread(target=core.handle_sigterm, args=(signum, None), daemon=True).start()
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, on_signal, sig)
+        await server.serve()
+
+    print(f"[INFO] Server ASGI su porta {core.SERVICE_PORT}: executor={SERVER_EXECUTOR_WORKERS}, "
+          f"connessioni={SERVER_CONNECTION_LIMIT}")
+    asyncio.get_event_loop().run_until_complete(main())
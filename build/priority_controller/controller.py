@@ -1,9 +1,12 @@
+import copy
 import os
 import time
 import requests
 import yaml
 from kubernetes import client, config
 from datetime import datetime
+from reconciler import ResourceCache, WorkQueue, DrainTracker, start_workers, is_ready
+from policy import PRIORITY_POLICY, choose_class, make_policy
 
 # ===== CONFIG =====
 PROM_URL = os.getenv("PROMETHEUS_URL", "http://prometheus.monitoring.svc.cluster.local:9090")
@@ -16,11 +19,10 @@ PRIORITY_THRESHOLDS = []
 PRIORITY_THRESHOLDS_LAST_RELOAD = 0
 PRIORITY_THRESHOLDS_RELOAD_INTERVAL = 300  # 5 minuti
 PRIORITY_COOLDOWN = 60  # secondi 
-PRIORITY_DOWNSCALE_GRACE = 600  # 10 minuti
-DOWNSCALE_ZERO_REQUIRED = 3
-ZERO_COUNT = {}
-LAST_NONZERO_INFLIGHT = {}
 LAST_PRIORITY_CHANGE = {}
+DRAIN_TIMEOUT = int(os.getenv("DRAIN_TIMEOUT", "180"))
+# (pipeline_id, step_id) -> priority decisa dall'ultima valutazione, applicata dai worker
+DESIRED_PRIORITY = {}
 # ===== SETUP =====
 try:
     config.load_incluster_config()
@@ -30,6 +32,28 @@ except:
 v1 = client.CoreV1Api()
 apps_v1 = client.AppsV1Api()
 
+
+def pod_key(pod):
+    labels = pod.metadata.labels or {}
+    if "pipeline_id" not in labels or not str(labels.get("step", "")).isdigit():
+        return None
+    return labels["pipeline_id"], int(labels["step"])
+
+
+# ===== CACHE LOCALI (list + watch) =====
+# le decisioni leggono solo da qui: nessuna read_node / list per ogni pod
+nodes = ResourceCache("nodes", v1.list_node)
+pods = ResourceCache("pods", v1.list_namespaced_pod, index=pod_key,
+                     on_change=lambda pod: on_pod_event(pod),
+                     namespace=NAMESPACE, label_selector="app=nn-service")
+configmaps = ResourceCache("configmaps", v1.list_namespaced_config_map,
+                           namespace=NAMESPACE, label_selector="pipeline_id")
+priority_classes = ResourceCache("priorityclasses", client.SchedulingV1Api().list_priority_class,
+                                 on_change=lambda pc: invalidate_priority_thresholds())
+
+work_queue = WorkQueue()
+drains = DrainTracker(pods, timeout=DRAIN_TIMEOUT)
+
 print(f"[INFO] Priority Controller avviato - Prometheus={PROM_URL}, Namespace={NAMESPACE}", flush=True)
 
 def load_priority_thresholds():
@@ -41,8 +65,7 @@ def load_priority_thresholds():
       {"name": "high-qos", "min": 61, "max": 100000},
     ]
     """
-    api = client.SchedulingV1Api()
-    pcs = api.list_priority_class().items
+    pcs = priority_classes.list()
 
     thresholds = []
 
@@ -74,6 +97,12 @@ def refresh_priority_thresholds_if_needed():
         PRIORITY_THRESHOLDS = load_priority_thresholds()
         PRIORITY_THRESHOLDS_LAST_RELOAD = now
 
+
+def invalidate_priority_thresholds():
+    """Una PriorityClass è cambiata: soglie ricalcolate alla prossima decisione."""
+    global PRIORITY_THRESHOLDS_LAST_RELOAD
+    PRIORITY_THRESHOLDS_LAST_RELOAD = 0
+
 def notify_pod_drain(pod_ip):
     try:
         url = f"http://{pod_ip}:5000/drain"
@@ -90,35 +119,9 @@ def in_cooldown(pipeline_id, step_id):
         return False
     return (time.time() - ts) < PRIORITY_COOLDOWN
     
-def wait_for_pod_not_ready(pod_name, timeout_s=180):
-    start = time.time()
-    while True:
-        try:
-            pod = v1.read_namespaced_pod(pod_name, namespace=NAMESPACE)
-        except Exception:
-            return  # pod sparito
-
-        for cond in pod.status.conditions or []:
-            if cond.type == "Ready" and cond.status == "False":
-                return
-
-        if time.time() - start > timeout_s:
-            print(f"[WARN] Timeout waiting NotReady for {pod_name}", flush=True)
-            return
-
-        time.sleep(1)
 def find_pod_to_fix(pods, target_priority):
     for pod in pods:
-        if pod.status.phase != "Running":
-            continue
-
-        ready = False
-        for cond in pod.status.conditions or []:
-            if cond.type == "Ready" and cond.status == "True":
-                ready = True
-                break
-
-        if not ready:
+        if pod.status.phase != "Running" or not is_ready(pod):
             continue
 
         if not pod_already_on_suitable_node(pod, target_priority):
@@ -193,8 +196,10 @@ def pod_already_on_suitable_node(pod, new_priority):
     if not node_name:
         return False
 
-    node = v1.read_node(node_name)
-    gpu_class = node.metadata.labels.get(GPU_LABEL_KEY)
+    node = nodes.get(node_name)
+    if node is None:
+        return False
+    gpu_class = (node.metadata.labels or {}).get(GPU_LABEL_KEY)
     if not gpu_class:
         return False
 
@@ -239,16 +244,18 @@ def restart_deployment_for_step(pipeline_id, step_id):
         
 def get_all_pipelines():
     """Ritorna tutte le configmap con label pipeline_id."""
-    cms = v1.list_namespaced_config_map(namespace=NAMESPACE, label_selector="pipeline_id")
-    return cms.items
+    return configmaps.list()
 def get_pods_for_step(pipeline_id, step_id):
     """Ritorna la lista dei pod per un dato step e pipeline."""
-    label_selector = f"app=nn-service,pipeline_id={pipeline_id},step={step_id}"
-    pods = v1.list_namespaced_pod(namespace=NAMESPACE, label_selector=label_selector)
-    return pods.items
+    return pods.by_index((pipeline_id, int(step_id)))
 
 def update_configmap_priority(cm_name, new_priority, step_id):
-    cm = v1.read_namespaced_config_map(name=cm_name, namespace=NAMESPACE)
+    cached = configmaps.get(cm_name)
+    if cached is None:
+        print(f"[WARN] ConfigMap {cm_name} non presente in cache", flush=True)
+        return
+    # copia: l'oggetto in cache è condiviso tra i worker
+    cm = copy.deepcopy(cached)
     data = yaml.safe_load(cm.data["PIPELINE_CONFIG"])
 
     pipeline_id = cm.metadata.labels["pipeline_id"]
@@ -273,6 +280,8 @@ def update_configmap_priority(cm_name, new_priority, step_id):
         return
 
     cm.data["PIPELINE_CONFIG"] = yaml.dump(data)
+    # resourceVersion della cache: se nel frattempo è cambiata -> 409, il
+    # worker riprova con la cache aggiornata
     v1.replace_namespaced_config_map(
         name=cm_name,
         namespace=NAMESPACE,
@@ -280,26 +289,10 @@ def update_configmap_priority(cm_name, new_priority, step_id):
     )
 
     # ===== POD ATTUALI =====
-    pods = get_pods_for_step(pipeline_id=pipeline_id, step_id=step_id)
+    step_pods = get_pods_for_step(pipeline_id=pipeline_id, step_id=step_id)
 
     # trova UN pod che NON soddisfa il target
-    pod_to_fix = None
-    for pod in pods:
-        if pod.status.phase != "Running":
-            continue
-
-        ready = False
-        for cond in pod.status.conditions or []:
-            if cond.type == "Ready" and cond.status == "True":
-                ready = True
-                break
-
-        if not ready:
-            continue
-
-        if not pod_already_on_suitable_node(pod, new_priority):
-            pod_to_fix = pod
-            break
+    pod_to_fix = find_pod_to_fix(step_pods, new_priority)
 
     if not pod_to_fix:
         print(
@@ -333,20 +326,49 @@ def update_configmap_priority(cm_name, new_priority, step_id):
     )
 
     # ===== DRAIN DI UN SOLO POD =====
+    # non si attende qui: la chiave resta occupata (DrainTracker) finché la
+    # cache dei pod non vede il pod NotReady, gli altri step proseguono
     if pod_to_fix.status.pod_ip:
         notify_pod_drain(pod_to_fix.status.pod_ip)
-        wait_for_pod_not_ready(pod_to_fix.metadata.name)
- 
+        drains.start(key, pod_to_fix.metadata.name)
+
+
+def on_pod_event(pod):
+    """Un pod in drain è cambiato: rimette in coda il suo step."""
+    draining = drains.keys()
+    if pod is None:
+        keys = draining  # nuovo list completo
+    else:
+        key = pod_key(pod)
+        keys = [key] if key in draining else []
+    for key in keys:
+        work_queue.add(key)
+
+
+def reconcile(key):
+    """Applica la priority desiderata a uno step; eseguita dai worker, mai due volte insieme per chiave."""
+    if drains.pending(key):
+        return  # riaccodata da on_pod_event quando il pod cambia stato
+    new_priority = DESIRED_PRIORITY.get(key)
+    if new_priority is None:
+        return
+    pipeline_id, step_id = key
+    update_configmap_priority(f"{pipeline_id}-step-{step_id}", new_priority, step_id)
 
-def choose_priority(in_flight: float) -> str:
+
+def current_thresholds():
     refresh_priority_thresholds_if_needed()
+    return PRIORITY_THRESHOLDS
+
 
-    for entry in PRIORITY_THRESHOLDS:
-        if entry["min"] <= in_flight <= entry["max"]:
-            return entry["name"]
+def choose_priority(in_flight: float) -> str:
+    # fallback di sicurezza: LOW_PRIORITY_CLASS
+    return choose_class(current_thresholds(), in_flight, LOW_PRIORITY_CLASS)
 
-    # fallback di sicurezza
-    return LOW_PRIORITY_CLASS
+
+# Policy di scelta della priority (PRIORITY_POLICY): vedi policy.py e il
+# backtest offline in test/backtest_priority.py
+POLICY = make_policy(PRIORITY_POLICY, current_thresholds, LOW_PRIORITY_CLASS)
 
 def evaluate_priority():
     """Analizza le metriche Prometheus e aggiorna priorità solo per gli step interessati."""
@@ -372,56 +394,45 @@ def evaluate_priority():
         print("[WARN] Nessuna metrica disponibile, salto iterazione.", flush=True)
         return
 
+    # arrival rate per step (usata dalla policy forecast)
+    rates = {}
+    for metric in query_prometheus(
+        'sum by (pipeline_id, step_id) (rate(http_requests_total{job=~"pipeline-.*", endpoint="/process"}[1m]))'
+    ):
+        rates[(metric["metric"]["pipeline_id"], int(metric["metric"]["step_id"]))] = float(metric["value"][1])
+
+    now = time.time()
     for metric in results:
         pipeline_id = metric["metric"]["pipeline_id"]
         step_id = int(metric["metric"]["step_id"])
         key = (pipeline_id, step_id)
+        in_flight = max(0.0, float(metric["value"][1]))
         if in_cooldown(*key):
+            # solo i modelli di previsione (forecast) usano i campioni in cooldown
+            POLICY.observe(key, now, in_flight, rates.get(key))
+            continue
+        decision = POLICY.decide(key, now, in_flight, rates.get(key))
+        if decision.priority is None:
+            print(f"[{decision.reason}] Skip downscale for {key}", flush=True)
             continue
-        # in_flight = float(metric["value"][1])
-        in_flight = max(0.0, float(metric["value"][1]))
-        
-        # if in_flight > 0:
-        #     LAST_NONZERO_INFLIGHT[(pipeline_id, step_id)] = time.time()
-        if in_flight == 0:
-            ZERO_COUNT[key] = ZERO_COUNT.get(key, 0) + 1
-        else:
-            ZERO_COUNT[key] = 0
-        new_priority = choose_priority(in_flight)
-        if in_flight > 0 and new_priority != LOW_PRIORITY_CLASS:
-            LAST_NONZERO_INFLIGHT[(pipeline_id, step_id)] = time.time()
         print(
-            f"[DECISION] pipeline={pipeline_id} step={step_id} "
-            f"in_flight={in_flight:.2f} → target_priority={new_priority}",
+            f"[{decision.reason}] pipeline={pipeline_id} step={step_id} "
+            f"in_flight={in_flight:.2f} forecast={decision.forecast:.2f} → target_priority={decision.priority}",
             flush=True
         )
-        # Cerca la ConfigMap corrispondente a questa pipeline
-        # cms = v1.list_namespaced_config_map(namespace=NAMESPACE, label_selector=f"pipeline_id={pipeline_id}").items
-        # for cm in cms:
-        #     update_configmap_priority(cm.metadata.name, new_priority, step_id)
-        # print(
-        #     f"[INFO] Pipeline={pipeline_id} Step={step_id} "
-        #     f"in_flight={in_flight:.1f} → priority={new_priority}",
-        #     flush=True
-        # )
-        if new_priority == LOW_PRIORITY_CLASS and ZERO_COUNT.get(key, 0) < DOWNSCALE_ZERO_REQUIRED:
-            print(f"[HYSTERESIS] Skip downscale for {key}, zero_count={ZERO_COUNT.get(key, 0)}", flush=True)
-            continue
-
-        if new_priority == LOW_PRIORITY_CLASS:
-            last_active = LAST_NONZERO_INFLIGHT.get((pipeline_id, step_id))
-            if last_active and (time.time() - last_active) < PRIORITY_DOWNSCALE_GRACE:
-                print(
-                    f"[STICKY] Skip downscale for {(pipeline_id, step_id)} "
-                    f"(recent activity)",
-                    flush=True
-                )
-                continue
-        cm_name = f"{pipeline_id}-step-{step_id}"
-        update_configmap_priority(cm_name, new_priority, step_id)
+        new_priority = decision.priority
+        DESIRED_PRIORITY[key] = new_priority
+        work_queue.add(key)
 
 
 def main():
+    for cache in (nodes, pods, configmaps, priority_classes):
+        cache.start()
+    for cache in (nodes, pods, configmaps, priority_classes):
+        if not cache.synced.wait(60):
+            print(f"[WARN] Cache {cache.name} non sincronizzata, proseguo", flush=True)
+    start_workers(work_queue, reconcile)
+
     while True:
         try:
             evaluate_priority()
@@ -0,0 +1,166 @@
+import os
+from collections import namedtuple
+
+# ===== CONFIG =====
+# threshold = soglie sul valore istantaneo (comportamento storico)
+# forecast  = previsione (Holt) di in-flight e arrival rate all'orizzonte di migrazione
+PRIORITY_POLICY = os.getenv("PRIORITY_POLICY", "threshold").lower()
+PRIORITY_DOWNSCALE_GRACE = 600  # 10 minuti
+DOWNSCALE_ZERO_REQUIRED = 3
+FORECAST_ALPHA = float(os.getenv("FORECAST_ALPHA", "0.5"))
+FORECAST_BETA = float(os.getenv("FORECAST_BETA", "0.3"))
+# tempo (s) perché un cambio di PriorityClass abbia effetto: drain, nuovo
+# scheduling, avvio del pod e caricamento del modello
+MIGRATION_COST_S = float(os.getenv("MIGRATION_COST_S", "90"))
+FORECAST_DOWNSCALE_GRACE = float(os.getenv("FORECAST_DOWNSCALE_GRACE", "180"))
+
+# priority=None -> nessun cambio; reason per i log del controller
+Decision = namedtuple("Decision", ["priority", "reason", "forecast"])
+
+
+def choose_class(thresholds, value, fallback):
+    """PriorityClass la cui fascia [min, max] di in-flight contiene `value`."""
+    for entry in thresholds:
+        if entry["min"] <= value <= entry["max"]:
+            return entry["name"]
+    return fallback
+
+
+def class_rank(thresholds, name):
+    for i, entry in enumerate(thresholds):
+        if entry["name"] == name:
+            return i
+    return -1
+
+
+class ThresholdPolicy:
+    """
+    Soglie sul valore istantaneo di in-flight, con isteresi solo in discesa:
+    verso la classe bassa servono DOWNSCALE_ZERO_REQUIRED letture a zero e
+    nessuna attività recente (PRIORITY_DOWNSCALE_GRACE).
+    """
+
+    name = "threshold"
+
+    def __init__(self, thresholds, low_class, zero_required=DOWNSCALE_ZERO_REQUIRED,
+                 downscale_grace=PRIORITY_DOWNSCALE_GRACE):
+        self.thresholds = thresholds
+        self.low_class = low_class
+        self.zero_required = zero_required
+        self.downscale_grace = downscale_grace
+        self.zero_count = {}
+        self.last_nonzero = {}
+
+    def observe(self, key, now, in_flight, rate=None):
+        """Campione durante il cooldown: ignorato, come nel controller storico."""
+
+    def decide(self, key, now, in_flight, rate=None):
+        if in_flight == 0:
+            self.zero_count[key] = self.zero_count.get(key, 0) + 1
+        else:
+            self.zero_count[key] = 0
+        new_priority = choose_class(self.thresholds(), in_flight, self.low_class)
+        if in_flight > 0 and new_priority != self.low_class:
+            self.last_nonzero[key] = now
+
+        if new_priority == self.low_class and self.zero_count.get(key, 0) < self.zero_required:
+            return Decision(None, "HYSTERESIS", in_flight)
+        if new_priority == self.low_class:
+            last_active = self.last_nonzero.get(key)
+            if last_active and (now - last_active) < self.downscale_grace:
+                return Decision(None, "STICKY", in_flight)
+        return Decision(new_priority, "DECISION", in_flight)
+
+
+class _Holt:
+    """Smoothing esponenziale doppio (livello + trend al secondo) su campioni a intervalli irregolari."""
+
+    __slots__ = ("level", "trend", "t")
+
+    def __init__(self):
+        self.level = None
+        self.trend = 0.0
+        self.t = None
+
+    def update(self, t, x, alpha, beta):
+        if self.level is None:
+            self.level, self.t = x, t
+            return
+        dt = max(t - self.t, 1e-3)
+        prev = self.level
+        self.level = alpha * x + (1 - alpha) * (prev + self.trend * dt)
+        self.trend = beta * (self.level - prev) / dt + (1 - beta) * self.trend
+        self.t = t
+
+    def forecast(self, horizon):
+        return max(0.0, self.level + self.trend * horizon)
+
+
+class ForecastPolicy:
+    """
+    Sceglie la classe per il carico previsto fra MIGRATION_COST_S secondi
+    (quando una migrazione decisa ora avrebbe effetto), non per quello
+    attuale: si sale di classe prima della saturazione.
+
+    In-flight e arrival rate sono previsti con Holt; se la rate è nota, la
+    crescita prevista degli arrivi scala l'in-flight attuale (Little: a
+    parità di latenza l'in-flight cresce con gli arrivi). In discesa si
+    tiene la classe più alta richiesta negli ultimi FORECAST_DOWNSCALE_GRACE
+    secondi, per non oscillare.
+    """
+
+    name = "forecast"
+
+    def __init__(self, thresholds, low_class, alpha=FORECAST_ALPHA, beta=FORECAST_BETA,
+                 horizon=MIGRATION_COST_S, downscale_grace=FORECAST_DOWNSCALE_GRACE):
+        self.thresholds = thresholds
+        self.low_class = low_class
+        self.alpha = alpha
+        self.beta = beta
+        self.horizon = horizon
+        self.downscale_grace = downscale_grace
+        self._inflight = {}
+        self._rate = {}
+        self._peaks = {}  # key -> [(t, rank, classe)]
+
+    def observe(self, key, now, in_flight, rate=None):
+        """Campione durante il cooldown: aggiorna solo i modelli di previsione."""
+        self.predict(key, now, in_flight, rate)
+
+    def predict(self, key, now, in_flight, rate=None):
+        model = self._inflight.setdefault(key, _Holt())
+        model.update(now, in_flight, self.alpha, self.beta)
+        predicted = model.forecast(self.horizon)
+        if rate is not None:
+            rate_model = self._rate.setdefault(key, _Holt())
+            rate_model.update(now, rate, self.alpha, self.beta)
+            if rate_model.level and rate_model.level > 1e-6:
+                growth = rate_model.forecast(self.horizon) / rate_model.level
+                predicted = max(predicted, in_flight * growth)
+        return max(in_flight, predicted)
+
+    def decide(self, key, now, in_flight, rate=None):
+        thresholds = self.thresholds()
+        predicted = self.predict(key, now, in_flight, rate)
+        target = choose_class(thresholds, predicted, self.low_class)
+
+        peaks = [p for p in self._peaks.get(key, []) if now - p[0] < self.downscale_grace]
+        peaks.append((now, class_rank(thresholds, target), target))
+        self._peaks[key] = peaks
+        held = max(peaks, key=lambda p: p[1])[2]
+        if held != target:
+            return Decision(held, "STICKY", predicted)
+        return Decision(target, "FORECAST", predicted)
+
+
+POLICIES = {
+    ThresholdPolicy.name: ThresholdPolicy,
+    ForecastPolicy.name: ForecastPolicy,
+}
+
+
+def make_policy(name, thresholds, low_class, **kwargs):
+    """`thresholds` è una funzione che ritorna le soglie correnti (ricaricate dalle PriorityClass)."""
+    if name not in POLICIES:
+        raise ValueError(f"PRIORITY_POLICY sconosciuta: {name} (disponibili: {', '.join(POLICIES)})")
+    return POLICIES[name](thresholds, low_class, **kwargs)
@@ -0,0 +1,245 @@
+import os
+import threading
+import time
+from collections import defaultdict
+
+# ===== CONFIG =====
+RECONCILE_WORKERS = int(os.getenv("RECONCILE_WORKERS", "4"))
+WATCH_TIMEOUT = int(os.getenv("WATCH_TIMEOUT", "300"))
+RETRY_DELAY = float(os.getenv("RECONCILE_RETRY_DELAY", "5"))
+
+
+def _kubernetes_watch(func, **kwargs):
+    from kubernetes import watch
+    return watch.Watch().stream(func, **kwargs)
+
+
+def _bookmark_version(event):
+    """resourceVersion di un BOOKMARK: il client non lo deserializza, object è un dict."""
+    obj = event.get("raw_object") or event["object"]
+    if isinstance(obj, dict):
+        return (obj.get("metadata") or {}).get("resourceVersion")
+    return obj.metadata.resource_version
+
+
+class ResourceCache:
+    """
+    Copia locale di una risorsa (list + watch dall'ultimo resourceVersion,
+    nuovo list dopo un 410). `index(obj)` opzionale: chiave secondaria per
+    by_index(), es. (pipeline_id, step) per i pod. Le letture non chiamano
+    mai l'API server.
+    """
+
+    def __init__(self, name, list_func, index=None, on_change=None,
+                 watch_factory=_kubernetes_watch, **list_kwargs):
+        self.name = name
+        self.list_func = list_func
+        self.index = index
+        self.on_change = on_change
+        self.watch_factory = watch_factory
+        self.list_kwargs = list_kwargs
+        self.synced = threading.Event()
+        self._objects = {}
+        self._indexed = defaultdict(dict)
+        self._rv = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._run, name=f"cache-{self.name}", daemon=True).start()
+        return self
+
+    def get(self, name):
+        with self._lock:
+            return self._objects.get(name)
+
+    def list(self):
+        with self._lock:
+            return list(self._objects.values())
+
+    def by_index(self, key):
+        with self._lock:
+            return list(self._indexed.get(key, {}).values())
+
+    def _store(self, obj):
+        name = obj.metadata.name
+        self._remove(name)
+        self._objects[name] = obj
+        if self.index is not None:
+            key = self.index(obj)
+            if key is not None:
+                self._indexed[key][name] = obj
+
+    def _remove(self, name):
+        old = self._objects.pop(name, None)
+        if old is not None and self.index is not None:
+            bucket = self._indexed.get(self.index(old))
+            if bucket is not None:
+                bucket.pop(name, None)
+
+    def _relist(self):
+        resp = self.list_func(**self.list_kwargs)
+        with self._lock:
+            self._objects = {}
+            self._indexed = defaultdict(dict)
+            for obj in resp.items:
+                self._store(obj)
+        self._rv = resp.metadata.resource_version
+        self.synced.set()
+        if self.on_change:
+            self.on_change(None)
+
+    def _watch(self):
+        for event in self.watch_factory(self.list_func, resource_version=self._rv,
+                                        timeout_seconds=WATCH_TIMEOUT, allow_watch_bookmarks=True,
+                                        **self.list_kwargs):
+            obj = event["object"]
+            if event["type"] == "ERROR":
+                code = obj.get("code") if isinstance(obj, dict) else None
+                if code == 410:
+                    self._rv = None
+                    return
+                print(f"[WARN] Watch {self.name}: {obj}", flush=True)
+                continue
+            if event["type"] == "BOOKMARK":
+                self._rv = _bookmark_version(event) or self._rv
+                continue
+            self._rv = obj.metadata.resource_version or self._rv
+            with self._lock:
+                if event["type"] == "DELETED":
+                    self._remove(obj.metadata.name)
+                else:
+                    self._store(obj)
+            if self.on_change:
+                self.on_change(obj)
+
+    def _run(self):
+        backoff = 1
+        while True:
+            try:
+                if self._rv is None:
+                    self._relist()
+                self._watch()
+                backoff = 1
+            except Exception as e:
+                if getattr(e, "status", None) == 410:
+                    self._rv = None
+                    continue
+                print(f"[WARN] Cache {self.name}: {e} (riprovo tra {backoff}s)", flush=True)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+
+class WorkQueue:
+    """
+    Coda di chiavi come la workqueue di client-go: una chiave è in coda al
+    più una volta e non viene mai elaborata da due worker insieme; se arriva
+    mentre è in lavorazione viene rimessa in coda a fine lavoro (done).
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queue = []
+        self._queued = set()
+        self._processing = set()
+        self._dirty = set()
+
+    def add(self, key):
+        with self._cond:
+            if key in self._processing:
+                self._dirty.add(key)
+                return
+            if key in self._queued:
+                return
+            self._queued.add(key)
+            self._queue.append(key)
+            self._cond.notify()
+
+    def add_after(self, key, delay):
+        timer = threading.Timer(delay, self.add, args=(key,))
+        timer.daemon = True
+        timer.start()
+
+    def get(self):
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            key = self._queue.pop(0)
+            self._queued.discard(key)
+            self._processing.add(key)
+            return key
+
+    def done(self, key):
+        with self._cond:
+            self._processing.discard(key)
+            if key in self._dirty:
+                self._dirty.discard(key)
+                self._queued.add(key)
+                self._queue.append(key)
+                self._cond.notify()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._queue)
+
+
+def start_workers(queue, handler, workers=RECONCILE_WORKERS):
+    """Worker paralleli: `handler(key)` che solleva un'eccezione rimette la chiave in coda dopo RETRY_DELAY."""
+    def loop():
+        while True:
+            key = queue.get()
+            try:
+                handler(key)
+            except Exception as e:
+                print(f"[ERROR] Reconcile {key}: {e} (riprovo tra {RETRY_DELAY:.0f}s)", flush=True)
+                queue.add_after(key, RETRY_DELAY)
+            finally:
+                queue.done(key)
+
+    for i in range(workers):
+        threading.Thread(target=loop, name=f"reconcile-{i}", daemon=True).start()
+
+
+class DrainTracker:
+    """
+    Drain in corso per chiave: invece di attendere inline che il pod diventi
+    NotReady, la chiave resta "occupata" finché la cache dei pod non lo vede
+    NotReady (o sparito) oppure scade il timeout.
+    """
+
+    def __init__(self, pods, timeout=180):
+        self.pods = pods
+        self.timeout = timeout
+        self._draining = {}
+        self._lock = threading.Lock()
+
+    def start(self, key, pod_name):
+        with self._lock:
+            self._draining[key] = (pod_name, time.time() + self.timeout)
+
+    def pending(self, key):
+        with self._lock:
+            entry = self._draining.get(key)
+        if entry is None:
+            return False
+        pod_name, deadline = entry
+        pod = self.pods.get(pod_name)
+        if pod is None or not is_ready(pod):
+            print(f"[DRAIN] Pod {pod_name} NotReady, drain di {key} completato", flush=True)
+        elif time.time() > deadline:
+            print(f"[WARN] Timeout waiting NotReady for {pod_name}", flush=True)
+        else:
+            return True
+        with self._lock:
+            self._draining.pop(key, None)
+        return False
+
+    def keys(self):
+        with self._lock:
+            return list(self._draining)
+
+
+def is_ready(pod):
+    for cond in pod.status.conditions or []:
+        if cond.type == "Ready":
+            return cond.status == "True"
+    return False
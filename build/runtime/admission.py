@@ -0,0 +1,150 @@
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Gauge, Histogram
+
+# --- Config (sovrascrivibile da env / ConfigMap) ---
+# richieste contemporanee nelle fasi CPU (decode, pre/post, encode, inoltro)
+ADMISSION_CPU_CONCURRENCY = int(os.getenv("ADMISSION_CPU_CONCURRENCY", "2"))
+# richieste contemporanee nella fase acceleratore (step.run di step con gpu > 0)
+ADMISSION_ACCEL_CONCURRENCY = int(os.getenv("ADMISSION_ACCEL_CONCURRENCY", "1"))
+# richieste massime in attesa per fase, oltre si risponde 429
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+# attesa massima in coda per fase (secondi), oltre si risponde 429
+ADMISSION_MAX_QUEUE_TIME = float(os.getenv("ADMISSION_MAX_QUEUE_TIME", "120"))
+
+admission_queue_length = Gauge(
+    "admission_queue_length",
+    "Richieste in attesa di essere ammesse nella fase",
+    ["pipeline_id", "step_id", "pod_name", "stage"],
+    multiprocess_mode="livesum"
+)
+
+admission_in_service = Gauge(
+    "admission_in_service",
+    "Richieste attualmente in esecuzione nella fase",
+    ["pipeline_id", "step_id", "pod_name", "stage"],
+    multiprocess_mode="livesum"
+)
+
+admission_wait_seconds = Histogram(
+    "admission_wait_seconds",
+    "Tempo di attesa in coda prima dell'ammissione nella fase",
+    ["pipeline_id", "step_id", "pod_name", "stage"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120)
+)
+
+
+class Saturated(Exception):
+    """La fase è satura: il chiamante risponde 429 con Retry-After."""
+
+    def __init__(self, stage, retry_after):
+        super().__init__(f"stage {stage} saturated")
+        self.stage = stage
+        self.retry_after = retry_after
+
+
+class Stage:
+    """
+    Semaforo con coda di attesa limitata (in numero e in tempo).
+    Tiene una media mobile del tempo di servizio per stimare Retry-After.
+    """
+
+    def __init__(self, name, limit, max_queue, max_wait, labels):
+        self.name = name
+        self.limit = max(1, int(limit))
+        self.max_queue = max(0, int(max_queue))
+        self.max_wait = max_wait
+        self._sem = threading.Semaphore(self.limit)
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._service_ewma = 1.0
+
+        self._queue_gauge = admission_queue_length.labels(*labels, name)
+        self._service_gauge = admission_in_service.labels(*labels, name)
+        self._wait_hist = admission_wait_seconds.labels(*labels, name)
+
+    def queue_length(self):
+        with self._lock:
+            return self._waiting
+
+    def retry_after(self):
+        with self._lock:
+            backlog = self._waiting + 1
+            est = self._service_ewma * backlog / self.limit
+        return max(1, int(math.ceil(est)))
+
+    def acquire(self):
+        """Ritorna il tempo passato in coda (secondi)."""
+        # fast path: slot libero, nessuna coda
+        if self._sem.acquire(blocking=False):
+            self._wait_hist.observe(0)
+            self._service_gauge.inc()
+            return 0.0
+
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                full = True
+            else:
+                full = False
+                self._waiting += 1
+                self._queue_gauge.set(self._waiting)
+        if full:
+            raise Saturated(self.name, self.retry_after())
+
+        start = time.time()
+        try:
+            ok = self._sem.acquire(timeout=self.max_wait)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+                self._queue_gauge.set(self._waiting)
+        waited = time.time() - start
+        self._wait_hist.observe(waited)
+        if not ok:
+            raise Saturated(self.name, self.retry_after())
+        self._service_gauge.inc()
+        return waited
+
+    def release(self, service_time):
+        with self._lock:
+            self._service_ewma = 0.8 * self._service_ewma + 0.2 * service_time
+        self._service_gauge.dec()
+        self._sem.release()
+
+    @contextmanager
+    def slot(self, on_wait=None):
+        waited = self.acquire()
+        if on_wait is not None:
+            on_wait(waited)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.release(time.time() - start)
+
+
+class AdmissionController:
+    """Fasi "cpu" e "accel" con limiti e code separate."""
+
+    def __init__(self, labels, cpu_concurrency=ADMISSION_CPU_CONCURRENCY,
+                 accel_concurrency=ADMISSION_ACCEL_CONCURRENCY,
+                 max_queue=ADMISSION_MAX_QUEUE, max_wait=ADMISSION_MAX_QUEUE_TIME):
+        labels = tuple(str(l) for l in labels)
+        self.stages = {
+            "cpu": Stage("cpu", cpu_concurrency, max_queue, max_wait, labels),
+            "accel": Stage("accel", accel_concurrency, max_queue, max_wait, labels),
+        }
+
+    def stage(self, name, on_wait=None):
+        """
+        Context manager: `with admission.stage("cpu"): ...`
+        on_wait(secondi), se passato, riceve il tempo di attesa in coda.
+        """
+        return self.stages[name].slot(on_wait)
+
+    def queue_length(self):
+        return sum(s.queue_length() for s in self.stages.values())
@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+
+from prometheus_client import Histogram
+
+# --- Config (sovrascrivibile da env / ConfigMap) ---
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "4"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "5"))
+
+batch_size_hist = Histogram(
+    "inference_batch_size",
+    "Numero di frame per inferenza batched",
+    ["batcher", "key"],
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16, 32)
+)
+
+batch_wait_hist = Histogram(
+    "inference_batch_wait_seconds",
+    "Attesa di un frame prima che il suo batch parta",
+    ["batcher", "key"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+)
+
+
+class _Pending:
+    __slots__ = ("item", "enqueued", "event", "result", "error")
+
+    def __init__(self, item):
+        self.item = item
+        self.enqueued = time.time()
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    Raccoglie le richieste concorrenti con la stessa chiave (es. risoluzione
+    del profilo) fino a max_batch elementi o max_wait_ms dal primo arrivato,
+    e le esegue con una sola chiamata infer_batch(key, items) -> results
+    (una lista con un risultato per item, nello stesso ordine).
+
+    Un solo thread esegue le inferenze: l'accesso alla GPU resta serializzato.
+    """
+
+    def __init__(self, infer_batch, max_batch=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS, name="default"):
+        self.infer_batch = infer_batch
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.name = name
+        self._queues = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._hists = {}  # chiave -> (dimensione batch, attesa): figli risolti una volta
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name=f"batcher-{self.name}", daemon=True)
+            self._thread.start()
+
+    def submit(self, key, item):
+        """Blocca fino al risultato di `item`; rilancia l'eventuale eccezione del batch."""
+        p = _Pending(item)
+        with self._cond:
+            self._ensure_started()
+            self._queues.setdefault(key, []).append(p)
+            self._cond.notify()
+        p.event.wait()
+        if p.error is not None:
+            raise p.error
+        return p.result
+
+    def _next_batch(self):
+        with self._cond:
+            while not any(self._queues.values()):
+                self._cond.wait()
+
+            # serve prima la chiave con la richiesta più vecchia
+            key = min((k for k, q in self._queues.items() if q), key=lambda k: self._queues[k][0].enqueued)
+            deadline = self._queues[key][0].enqueued + self.max_wait
+            while len(self._queues[key]) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            queue = self._queues[key]
+            batch = queue[:self.max_batch]
+            del queue[:self.max_batch]
+            return key, batch
+
+    def _loop(self):
+        while True:
+            key, batch = self._next_batch()
+            now = time.time()
+            hists = self._hists.get(key)
+            if hists is None:
+                label = str(key)
+                hists = self._hists[key] = (batch_size_hist.labels(self.name, label),
+                                            batch_wait_hist.labels(self.name, label))
+            size_hist, wait = hists
+            size_hist.observe(len(batch))
+            for p in batch:
+                wait.observe(now - p.enqueued)
+
+            try:
+                results = self.infer_batch(key, [p.item for p in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"infer_batch ha restituito {len(results)} risultati per {len(batch)} item")
+                for p, r in zip(batch, results):
+                    p.result = r
+            except Exception as e:
+                for p in batch:
+                    p.error = e
+            finally:
+                for p in batch:
+                    p.event.set()
@@ -0,0 +1,212 @@
+import os
+import queue
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from prometheus_client import Counter, Gauge, Histogram
+
+# --- Config (sovrascrivibile da env / ConfigMap) ---
+FORWARD_WORKERS = int(os.getenv("FORWARD_WORKERS", "4"))
+FORWARD_QUEUE_SIZE = int(os.getenv("FORWARD_QUEUE_SIZE", "32"))
+# block | reject | drop_oldest
+FORWARD_QUEUE_POLICY = os.getenv("FORWARD_QUEUE_POLICY", "block").lower()
+FORWARD_BLOCK_TIMEOUT = float(os.getenv("FORWARD_BLOCK_TIMEOUT", "5"))
+FORWARD_TIMEOUT = float(os.getenv("FORWARD_TIMEOUT", "300"))
+# tentativi extra quando il prossimo step risponde 429 (rispettando Retry-After)
+FORWARD_MAX_RETRIES = int(os.getenv("FORWARD_MAX_RETRIES", "3"))
+FORWARD_MAX_RETRY_DELAY = float(os.getenv("FORWARD_MAX_RETRY_DELAY", "10"))
+
+POLICIES = ("block", "reject", "drop_oldest")
+
+forward_queue_depth = Gauge(
+    "forward_queue_depth",
+    "Numero di frame in coda verso il prossimo step",
+    ["pipeline_id", "step_id", "pod_name"],
+    multiprocess_mode="livesum"
+)
+
+forward_send_latency = Histogram(
+    "forward_send_latency_seconds",
+    "Tempo di invio di un frame al prossimo step",
+    ["pipeline_id", "step_id", "pod_name"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 300)
+)
+
+forward_dropped_total = Counter(
+    "forward_dropped_total",
+    "Frame scartati o rifiutati dalla coda di inoltro",
+    ["pipeline_id", "step_id", "pod_name", "reason"]
+)
+
+
+class QueueFull(Exception):
+    """La coda di inoltro è piena e la policy non permette di attendere."""
+
+
+class Forwarder:
+    """
+    Inoltro verso il prossimo step con un pool fisso di worker e una
+    Session keep-alive per ogni destinazione (scheme://host:port).
+
+    La coda è limitata: quando è piena si applica FORWARD_QUEUE_POLICY
+    - block:       attende fino a FORWARD_BLOCK_TIMEOUT, poi QueueFull
+    - reject:      QueueFull immediato (il chiamante risponde 503)
+    - drop_oldest: scarta il frame più vecchio in coda e accoda il nuovo
+
+    on_result(url, ok), se passato, riceve l'esito di ogni invio: ok è
+    False solo per errori di rete e 5xx (usato per alimentare il circuit
+    breaker della readiness; un 429 non conta come guasto).
+    on_response(url, resp, secondi), se passato, riceve l'ultima risposta
+    (None se l'invio è fallito) e la durata dell'invio (usato dal routing).
+    """
+
+    def __init__(self, labels, workers=FORWARD_WORKERS, queue_size=FORWARD_QUEUE_SIZE,
+                 policy=FORWARD_QUEUE_POLICY, block_timeout=FORWARD_BLOCK_TIMEOUT,
+                 timeout=FORWARD_TIMEOUT, on_result=None, on_response=None):
+        if policy not in POLICIES:
+            print(f"[WARN] FORWARD_QUEUE_POLICY={policy} non valida, uso 'block'")
+            policy = "block"
+
+        self.labels = tuple(str(l) for l in labels)
+        self.workers = max(1, int(workers))
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.timeout = timeout
+        self.on_result = on_result
+        self.on_response = on_response
+
+        self._queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        # lock usato solo da drop_oldest per rendere atomico get+put
+        self._put_lock = threading.Lock()
+        self._active = 0
+        self._active_lock = threading.Lock()
+        self._threads = []
+        self._started = False
+
+        self._depth = forward_queue_depth.labels(*self.labels)
+        self._latency = forward_send_latency.labels(*self.labels)
+        self._dropped = {reason: forward_dropped_total.labels(*self.labels, reason)
+                         for reason in ("rejected", "dropped_oldest", "timeout", "next_saturated")}
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"forwarder-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        print(f"[INFO] Forwarder avviato: workers={self.workers}, "
+              f"queue={self._queue.maxsize}, policy={self.policy}")
+
+    def pending(self):
+        """Frame ancora da inviare (in coda + in invio)."""
+        with self._active_lock:
+            return self._queue.qsize() + self._active
+
+    def submit(self, url, body, filename="frame.jpg", content_type="image/jpeg", headers=None, on_done=None):
+        """
+        Accoda un frame (bytes) per l'invio. Solleva QueueFull se rifiutato.
+        on_done(ok, accodato_alle, terminato_alle), se passato, viene chiamato
+        dal worker a invio concluso (anche in caso di errore); ok è True solo
+        se il prossimo step ha accettato il frame (2xx).
+        """
+        item = (url, body, filename, content_type, dict(headers or {}), on_done, time.time())
+
+        if self.policy == "reject":
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self._dropped["rejected"].inc()
+                raise QueueFull("forward queue full")
+
+        elif self.policy == "drop_oldest":
+            with self._put_lock:
+                while True:
+                    try:
+                        self._queue.put_nowait(item)
+                        break
+                    except queue.Full:
+                        try:
+                            dropped = self._queue.get_nowait()
+                            self._queue.task_done()
+                            self._dropped["dropped_oldest"].inc()
+                        except queue.Empty:
+                            continue
+                        if dropped[5] is not None:
+                            dropped[5](False, dropped[6], time.time())
+
+        else:
+            try:
+                self._queue.put(item, timeout=self.block_timeout)
+            except queue.Full:
+                self._dropped["timeout"].inc()
+                raise QueueFull("forward queue full (timeout)")
+
+        self._depth.set(self._queue.qsize())
+
+    def _session_for(self, url):
+        parts = urlsplit(url)
+        key = f"{parts.scheme}://{parts.netloc}"
+        with self._sessions_lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+                session.mount(key, adapter)
+                self._sessions[key] = session
+            return session
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            with self._active_lock:
+                self._active += 1
+            self._depth.set(self._queue.qsize())
+            url, body, filename, content_type, headers, on_done, enqueued = item
+            start = time.time()
+            healthy = False    # per on_result: il prossimo step non è guasto
+            delivered = False  # per on_done: frame accettato (2xx)
+            resp = None
+            try:
+                session = self._session_for(url)
+                files = {"image": (filename, body, content_type)}
+                for attempt in range(FORWARD_MAX_RETRIES + 1):
+                    resp = session.post(url, files=files, headers=headers, timeout=self.timeout)
+                    if resp.status_code != 429 or attempt == FORWARD_MAX_RETRIES:
+                        break
+                    # prossimo step saturo: backpressure, riprova dopo Retry-After
+                    try:
+                        delay = float(resp.headers.get("Retry-After", "1"))
+                    except ValueError:
+                        delay = 1.0
+                    time.sleep(min(max(delay, 0.0), FORWARD_MAX_RETRY_DELAY))
+                if resp.status_code == 429:
+                    self._dropped["next_saturated"].inc()
+                    print(f"[WARN] Prossimo step saturo, frame scartato: {url}")
+                # 429 non è un guasto del prossimo step: non apre il circuito,
+                # ma il frame non è stato consegnato
+                healthy = resp.status_code < 500
+                delivered = 200 <= resp.status_code < 300
+            except Exception as e:
+                print(f"[WARN] Async send failed: {e}")
+            finally:
+                if self.on_result is not None:
+                    self.on_result(url, healthy)
+                end = time.time()
+                self._latency.observe(end - start)
+                if self.on_response is not None:
+                    self.on_response(url, resp, end - start)
+                if on_done is not None:
+                    try:
+                        on_done(delivered, enqueued, end)
+                    except Exception as e:
+                        print(f"[WARN] on_done dell'inoltro fallito: {e}")
+                with self._active_lock:
+                    self._active -= 1
+                self._queue.task_done()
@@ -0,0 +1,153 @@
+"""
+Frame condiviso tra gli step della pipeline.
+
+Un Frame è un buffer numpy uint8 (h, w, 3) o (h, w) con i metadati che
+servono per non copiarlo: ordine dei canali (RGB, BGR o GRAY) e dimensione
+originale (w, h) prima di un eventuale decode ridotto. Gli step che
+dichiarano `accepts_frame = True` ricevono il Frame così com'è; gli altri
+ricevono ancora una PIL Image RGB (to_pil) e possono restituire una PIL
+Image o un Frame (as_frame). Uno step può dichiarare con
+`input_min_side(load_profile)` il lato minore che gli basta in ingresso.
+
+Le conversioni di colore sono viste quando possibile (RGB <-> BGR inverte
+solo gli stride); le copie avvengono solo dove servono davvero: buffer in
+sola lettura da modificare (writable) o espansione da GRAY a 3 canali.
+
+Il decode JPEG usa OpenCV (array BGR scrivibile, nessuna conversione PIL)
+e, se uno step dichiara il lato minimo che gli serve, la scalatura DCT di
+libjpeg (IMREAD_REDUCED_COLOR_2/4/8, o draft() di PIL senza OpenCV).
+"""
+import io
+
+import numpy as np
+from PIL import Image
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+RGB = "RGB"
+BGR = "BGR"
+GRAY = "GRAY"
+
+# qualità di default di PIL, per avere gli stessi JPEG con o senza OpenCV
+JPEG_QUALITY = 75
+
+if cv2 is not None:
+    _IMREAD_FLAGS = getattr(cv2, "IMREAD_IGNORE_ORIENTATION", 0)  # come PIL: EXIF ignorato
+    _REDUCED = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+class Frame:
+    __slots__ = ("array", "order", "original_size")
+
+    def __init__(self, array, order=None, original_size=None):
+        if order is None:
+            order = GRAY if array.ndim == 2 else RGB
+        self.array = array
+        self.order = order
+        self.original_size = original_size or (array.shape[1], array.shape[0])
+
+    @classmethod
+    def from_pil(cls, image):
+        if image.mode == "L":
+            return cls(np.asarray(image), GRAY)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        return cls(np.asarray(image), RGB)
+
+    @property
+    def size(self):
+        """(w, h) come PIL."""
+        return self.array.shape[1], self.array.shape[0]
+
+    def rgb(self):
+        """Array (h, w, 3) RGB: vista se il frame è RGB o BGR, copia se GRAY."""
+        if self.order == RGB:
+            return self.array
+        if self.order == BGR:
+            return self.array[..., ::-1]
+        return np.repeat(self.array[..., None], 3, axis=2)
+
+    def bgr(self):
+        if self.order == BGR:
+            return self.array
+        if self.order == RGB:
+            return self.array[..., ::-1]
+        return np.repeat(self.array[..., None], 3, axis=2)
+
+    def channels(self):
+        """Array da serializzare: (h, w) per GRAY, (h, w, 3) RGB altrimenti."""
+        return self.array if self.order == GRAY else self.rgb()
+
+    def writable(self):
+        """Array modificabile in-place (copia solo se il buffer è in sola lettura o non contiguo)."""
+        if not (self.array.flags.writeable and self.array.flags.c_contiguous):
+            self.array = np.array(self.array, order="C")
+        return self.array
+
+    def to_pil(self):
+        """PIL Image RGB, per gli step che non accettano Frame."""
+        return Image.fromarray(np.ascontiguousarray(self.rgb()))
+
+    def encode_jpeg(self, quality=JPEG_QUALITY):
+        if cv2 is not None:
+            arr = self.array if self.order == GRAY else self.bgr()
+            ok, buf = cv2.imencode(".jpg", arr, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if ok:
+                return buf.tobytes()
+        out = io.BytesIO()
+        Image.fromarray(np.ascontiguousarray(self.channels())).save(out, format="JPEG", quality=quality)
+        return out.getvalue()
+
+
+def as_frame(image):
+    return image if isinstance(image, Frame) else Frame.from_pil(image)
+
+
+def as_pil(image):
+    return image.to_pil() if isinstance(image, Frame) else image
+
+
+def reduction_factor(size, min_side):
+    """Fattore di scalatura DCT (1, 2, 4, 8) che lascia il lato minore >= min_side."""
+    if not min_side:
+        return 1
+    shortest = min(size)
+    for factor in (8, 4, 2):
+        if shortest // factor >= min_side:
+            return factor
+    return 1
+
+
+def decode_image(data, min_side=None):
+    """
+    JPEG/PNG in bytes -> Frame. Con `min_side` il JPEG viene decodificato
+    già ridotto (1/2, 1/4, 1/8) finché il lato minore resta >= min_side.
+    """
+    factor, original = 1, None
+    if min_side:
+        with Image.open(io.BytesIO(data)) as probe:  # legge solo l'header
+            original = probe.size
+        factor = reduction_factor(original, min_side)
+
+    if cv2 is not None:
+        flags = cv2.IMREAD_COLOR | _IMREAD_FLAGS
+        for f, flag in _REDUCED:
+            if f == factor:
+                flags = flag | _IMREAD_FLAGS
+        arr = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+        if arr is not None:
+            return Frame(arr, BGR, original)
+
+    image = Image.open(io.BytesIO(data))
+    if factor > 1:
+        image.draft("RGB", (image.size[0] // factor, image.size[1] // factor))
+    return Frame(np.asarray(image.convert("RGB")), RGB, original)
+
+
+def decode_raw(arr):
+    """Array dal formato raw (wire.decode_frame): vista sul buffer ricevuto, in sola lettura."""
+    return Frame(arr, GRAY if arr.ndim == 2 else RGB)
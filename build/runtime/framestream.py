@@ -0,0 +1,174 @@
+import os
+import queue
+import struct
+import threading
+
+import requests
+
+from runtime import wire
+from runtime.forwarder import FORWARD_TIMEOUT
+
+# --- Config (sovrascrivibile da env / ConfigMap) ---
+# frame in coda tra una fase e l'altra di uno stream (e verso il prossimo step):
+# code piene fermano la lettura dal socket -> backpressure fino al client
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "8"))
+
+# Stream di frame su una sola connessione HTTP (corpo chunked):
+# sequenza di record [header | payload], header = kind (B), seq (Q), len (I).
+# kind indica il formato del payload; KIND_END chiude lo stream in modo esplicito.
+CONTENT_TYPE_STREAM = "application/x-frame-stream"
+
+KIND_JPEG = 0
+KIND_RAW = 1
+KIND_END = 255
+
+_HEADER = struct.Struct("<BQI")
+HEADER_SIZE = _HEADER.size
+
+MAX_RECORD_BYTES = 64 * 1024 * 1024
+
+_CONTENT_TYPES = {
+    KIND_JPEG: wire.CONTENT_TYPE_JPEG,
+    KIND_RAW: wire.CONTENT_TYPE_RAW,
+}
+
+
+def kind_for(content_type):
+    return KIND_RAW if wire.is_raw(content_type) else KIND_JPEG
+
+
+def content_type_for(kind):
+    return _CONTENT_TYPES[kind]
+
+
+def encode_record(kind, seq, payload=b""):
+    return _HEADER.pack(kind, seq, len(payload)) + payload
+
+
+def end_record(seq):
+    return encode_record(KIND_END, seq)
+
+
+class RecordParser:
+    """
+    Parser incrementale: feed(chunk) -> lista di (kind, seq, payload) completi.
+    I chunk possono spezzare header e payload in qualsiasi punto.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self.ended = False
+
+    def feed(self, data):
+        self._buf += data
+        records = []
+        while not self.ended and len(self._buf) >= HEADER_SIZE:
+            kind, seq, length = _HEADER.unpack_from(self._buf)
+            if kind != KIND_END and kind not in _CONTENT_TYPES:
+                raise ValueError(f"record di tipo sconosciuto: {kind}")
+            if length > MAX_RECORD_BYTES:
+                raise ValueError(f"record troppo grande: {length} byte")
+            if len(self._buf) < HEADER_SIZE + length:
+                break
+            payload = bytes(self._buf[HEADER_SIZE:HEADER_SIZE + length])
+            del self._buf[:HEADER_SIZE + length]
+            if kind == KIND_END:
+                self.ended = True
+            records.append((kind, seq, payload))
+        return records
+
+    def pending_bytes(self):
+        return len(self._buf)
+
+
+def iter_records(stream, chunk_size=64 * 1024):
+    """Legge record da un file-like bloccante (es. request.stream) fino a EOF o KIND_END."""
+    parser = RecordParser()
+    while not parser.ended:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            if parser.pending_bytes():
+                raise ValueError("stream troncato a metà record")
+            return
+        for record in parser.feed(chunk):
+            if record[0] == KIND_END:
+                return
+            yield record
+
+
+class StreamSender:
+    """
+    Inoltra i record di uno stream al prossimo step su un'unica POST chunked
+    (corpo generato dalla coda). La coda è limitata: send() blocca quando il
+    prossimo step non consuma abbastanza in fretta.
+    close() chiude lo stream e ritorna il riepilogo JSON del prossimo step.
+    """
+
+    def __init__(self, url, headers=None, queue_size=STREAM_QUEUE_SIZE, timeout=FORWARD_TIMEOUT):
+        self.url = url
+        self.headers = dict(headers or {})
+        self.headers["Content-Type"] = CONTENT_TYPE_STREAM
+        self.timeout = timeout
+        self.error = None
+        self.status = None
+        self.summary = None
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._thread = threading.Thread(target=self._run, name="stream-sender", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def send(self, kind, seq, payload):
+        record = encode_record(kind, seq, payload)
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self._queue.put(record, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def close(self, seq):
+        """Invia KIND_END, attende la risposta del prossimo step e la ritorna."""
+        if self.error is None:
+            for item in (end_record(seq), None):
+                while self.error is None:
+                    try:
+                        self._queue.put(item, timeout=1)
+                        break
+                    except queue.Full:
+                        continue
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.summary
+
+    def _body(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            yield item
+
+    def _run(self):
+        try:
+            with requests.Session() as session:
+                resp = session.post(self.url, data=self._body(), headers=self.headers,
+                                    timeout=(5, self.timeout))
+            self.status = resp.status_code
+            try:
+                self.summary = resp.json()
+            except ValueError:
+                self.summary = {"error": resp.text[:200]}
+            if resp.status_code >= 400:
+                raise RuntimeError(f"{self.url} -> {resp.status_code}")
+        except Exception as e:
+            self.error = e
+            # sblocca chi è fermo su send()/close()
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
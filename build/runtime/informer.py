@@ -0,0 +1,185 @@
+import os
+import threading
+import time
+
+from prometheus_client import Counter
+
+# --- Config (sovrascrivibile da env / ConfigMap) ---
+# durata massima di una watch lato API server, poi si riapre dallo stesso resourceVersion
+INFORMER_WATCH_TIMEOUT = int(os.getenv("INFORMER_WATCH_TIMEOUT", "300"))
+# relist completo di sicurezza (0 = solo quando la watch scade con 410 Gone)
+INFORMER_RESYNC_INTERVAL = float(os.getenv("INFORMER_RESYNC_INTERVAL", "600"))
+INFORMER_MAX_BACKOFF = float(os.getenv("INFORMER_MAX_BACKOFF", "30"))
+
+informer_events = Counter(
+    "informer_events_total",
+    "Eventi ricevuti dalle watch Kubernetes (ADDED, MODIFIED, DELETED, BOOKMARK, RELIST, ERROR)",
+    ["pipeline_id", "step_id", "pod_name", "resource", "type"]
+)
+
+
+def kubernetes_watch(func, **kwargs):
+    """Stream di eventi {"type", "object"} del client ufficiale (kubernetes.watch)."""
+    from kubernetes import watch
+    return watch.Watch().stream(func, **kwargs)
+
+
+class ResourceGone(Exception):
+    """resourceVersion troppo vecchio (HTTP 410): serve un nuovo list."""
+
+
+def _is_gone(exc):
+    return isinstance(exc, ResourceGone) or getattr(exc, "status", None) == 410
+
+
+def bookmark_version(event):
+    """
+    resourceVersion di un evento BOOKMARK. Il client Python non deserializza
+    i BOOKMARK: "object" (e "raw_object") è un dict, non un modello V1.
+    """
+    obj = event.get("raw_object") or event["object"]
+    if isinstance(obj, dict):
+        return (obj.get("metadata") or {}).get("resourceVersion")
+    return obj.metadata.resource_version
+
+
+class Informer:
+    """
+    Cache locale di una risorsa Kubernetes tenuta aggiornata con list + watch,
+    come gli informer di client-go:
+
+    - all'avvio (e dopo un 410 Gone o ogni INFORMER_RESYNC_INTERVAL) un list
+      completo; poi una watch che riparte dall'ultimo resourceVersion visto,
+      quindi nessun evento perso tra una watch e la successiva
+    - `parse(obj)` viene chiamato solo se il resourceVersion dell'oggetto è
+      cambiato (niente re-parsing YAML a ogni giro)
+    - `on_change(items)` riceve una copia {nome: valore} dopo ogni modifica
+
+    `list_func` è un metodo list_* di CoreV1Api; `watch_factory(list_func, **kwargs)`
+    ritorna un iteratore di eventi: di default kubernetes_watch, nei test uno
+    stream finto.
+    """
+
+    def __init__(self, resource, list_func, parse, on_change=None, labels=("", "", ""),
+                 watch_factory=kubernetes_watch, watch_timeout=INFORMER_WATCH_TIMEOUT,
+                 resync_interval=INFORMER_RESYNC_INTERVAL, max_backoff=INFORMER_MAX_BACKOFF, **list_kwargs):
+        self.resource = resource
+        self.list_func = list_func
+        self.parse = parse
+        self.on_change = on_change
+        self.watch_factory = watch_factory
+        self.watch_timeout = watch_timeout
+        self.resync_interval = resync_interval
+        self.max_backoff = max_backoff
+        self.list_kwargs = list_kwargs
+        self.synced = threading.Event()
+        self.resource_version = None
+
+        self._labels = tuple(str(l) for l in labels)
+        self._items = {}  # nome -> (resourceVersion, valore)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._last_list = 0.0
+
+    def start(self):
+        threading.Thread(target=self.run, name=f"informer-{self.resource}", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def items(self):
+        with self._lock:
+            return {name: value for name, (_, value) in self._items.items()}
+
+    def _count(self, event_type):
+        informer_events.labels(*self._labels, self.resource, event_type).inc()
+
+    def _notify(self):
+        if self.on_change is not None:
+            self.on_change(self.items())
+
+    def _parse(self, obj):
+        try:
+            return self.parse(obj)
+        except Exception as e:
+            print(f"[ERROR] Parsing {self.resource} {obj.metadata.name}: {e}")
+            return None
+
+    def relist(self):
+        resp = self.list_func(**self.list_kwargs)
+        with self._lock:
+            old = self._items
+            fresh = {}
+            for obj in resp.items:
+                name, rv = obj.metadata.name, obj.metadata.resource_version
+                cached = old.get(name)
+                if cached is not None and rv is not None and cached[0] == rv:
+                    fresh[name] = cached
+                else:
+                    fresh[name] = (rv, self._parse(obj))
+            self._items = fresh
+        self.resource_version = resp.metadata.resource_version
+        self._last_list = time.time()
+        self._count("RELIST")
+        self.synced.set()
+        self._notify()
+
+    def apply(self, event):
+        """Applica un evento di watch alla cache; ResourceGone se va rifatto il list."""
+        event_type = event["type"]
+        obj = event["object"]
+        self._count(event_type)
+        if event_type == "ERROR":
+            code = obj.get("code") if isinstance(obj, dict) else getattr(obj, "code", None)
+            if code == 410:
+                raise ResourceGone(str(obj))
+            print(f"[WARN] Errore dalla watch di {self.resource}: {obj}")
+            return
+        if event_type == "BOOKMARK":
+            # nessun oggetto cambiato: solo il resourceVersion da cui riprendere
+            rv = bookmark_version(event)
+            if rv:
+                self.resource_version = rv
+            return
+        rv = obj.metadata.resource_version
+        name = obj.metadata.name
+        with self._lock:
+            if event_type == "DELETED":
+                self._items.pop(name, None)
+            else:
+                self._items[name] = (rv, self._parse(obj))
+        if rv:
+            self.resource_version = rv
+        self._notify()
+
+    def _watch(self):
+        stream = self.watch_factory(
+            self.list_func,
+            resource_version=self.resource_version,
+            timeout_seconds=self.watch_timeout,
+            allow_watch_bookmarks=True,
+            **self.list_kwargs
+        )
+        for event in stream:
+            self.apply(event)
+            if self._stop.is_set():
+                return
+
+    def run(self):
+        backoff = 1.0
+        while not self._stop.is_set():
+            try:
+                resync = self.resync_interval and time.time() - self._last_list > self.resync_interval
+                if self.resource_version is None or resync:
+                    self.relist()
+                self._watch()
+                backoff = 1.0
+            except Exception as e:
+                if _is_gone(e):
+                    print(f"[INFO] Watch di {self.resource} scaduta (410), nuovo list")
+                    self.resource_version = None
+                    continue
+                print(f"[WARN] Watch di {self.resource} interrotta: {e} (riprovo tra {backoff:.0f}s)")
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
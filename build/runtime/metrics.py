@@ -0,0 +1,147 @@
+"""
+Metriche con cardinalità limitata.
+
+Le label fisse del pod (pipeline_id, step_id, pod_name) hanno un solo
+valore per processo e vengono risolte una volta sola. Una label che arriva
+dal client (es. test_id da X-Test-ID) invece crea una serie nuova per ogni
+valore, con tutti i bucket di un istogramma, mai liberata. BoundedLabels:
+  - accetta solo i valori che rispettano METRICS_LABEL_ALLOW (regex) e al
+    più METRICS_MAX_LABEL_VALUES valori diversi; gli altri finiscono in
+    "other" (contati in metrics_label_overflow_total)
+  - rimuove le serie non aggiornate da METRICS_SERIES_TTL secondi, così il
+    tetto si libera quando un test finisce
+  - tiene in cache i figli: nessun labels() nel percorso della richiesta
+
+Gli identificativi per richiesta (request id) non diventano label ma
+exemplar degli istogrammi, visibili con il formato OpenMetrics (/metrics
+con Accept: application/openmetrics-text, come fa Prometheus con
+--enable-feature=exemplar-storage).
+
+In SERVER_MODE=prefork (prometheus_client multiprocess) le serie rimosse
+restano nei file mmap fino al riavvio e gli exemplar non vengono esportati.
+"""
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from timeit import default_timer
+
+from prometheus_client import Counter
+
+# --- Config (sovrascrivibile da env / ConfigMap) ---
+# regex dei valori ammessi per le label che arrivano dal client (vuoto = tutti, fino al tetto)
+METRICS_LABEL_ALLOW = os.getenv("METRICS_LABEL_ALLOW", r"[A-Za-z0-9_.:-]{1,64}")
+METRICS_MAX_LABEL_VALUES = int(os.getenv("METRICS_MAX_LABEL_VALUES", "16"))
+# secondi senza aggiornamenti dopo cui una serie viene rimossa (0 = mai)
+METRICS_SERIES_TTL = float(os.getenv("METRICS_SERIES_TTL", "3600"))
+METRICS_EXEMPLARS = os.getenv("METRICS_EXEMPLARS", "true").lower() == "true"
+
+OTHER = "other"
+# limite di OpenMetrics: 128 caratteri per nomi e valori delle label dell'exemplar
+EXEMPLAR_MAX_LEN = 64
+
+label_overflow_total = Counter(
+    "metrics_label_overflow_total",
+    "Osservazioni con un valore di label non ammesso o oltre il tetto, registrate come 'other'",
+    ["metric", "label"]
+)
+
+
+class BoundedLabels:
+    """
+    Figli di `metric` con le label fisse `fixed` più un'ultima label libera.
+    child(value) ritorna il figlio in cache (o quello di "other").
+    """
+
+    def __init__(self, metric, fixed, label, allow=METRICS_LABEL_ALLOW,
+                 max_values=METRICS_MAX_LABEL_VALUES, ttl=METRICS_SERIES_TTL, clock=time.time):
+        self.metric = metric
+        self.fixed = tuple(str(v) for v in fixed)
+        self.max_values = max(1, max_values)
+        self.ttl = ttl
+        self._allow = re.compile(allow) if allow else None
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._children = {}  # valore -> [figlio, ultimo uso]
+        self._next_sweep = clock() + self._sweep_interval()
+        self._overflow = label_overflow_total.labels(metric._name, label)
+
+    def _sweep_interval(self):
+        return min(self.ttl, 60.0) if self.ttl > 0 else float("inf")
+
+    def child(self, value):
+        now = self._clock()
+        # prima lo sweep: i valori scaduti liberano il tetto per quello nuovo
+        if now >= self._next_sweep:
+            self.sweep(now)
+        entry = self._children.get(value)
+        if entry is None:
+            entry = self._admit(str(value))
+        entry[1] = now
+        return entry[0]
+
+    def _admit(self, value):
+        with self._lock:
+            entry = self._children.get(value)
+            if entry is not None:
+                return entry
+            allowed = self._allow is None or self._allow.fullmatch(value) is not None
+            named = sum(1 for v in self._children if v != OTHER)
+            if not allowed or named >= self.max_values:
+                # non in cache: il valore rifiutato non deve occupare memoria
+                self._overflow.inc()
+                value = OTHER
+                entry = self._children.get(OTHER)
+                if entry is not None:
+                    return entry
+            entry = self._children[value] = [self.metric.labels(*self.fixed, value), self._clock()]
+            return entry
+
+    def sweep(self, now=None):
+        """Rimuove le serie non usate da più di ttl secondi."""
+        now = self._clock() if now is None else now
+        with self._lock:
+            self._next_sweep = now + self._sweep_interval()
+            if self.ttl <= 0:
+                return 0
+            stale = [v for v, entry in self._children.items() if now - entry[1] > self.ttl]
+            for value in stale:
+                del self._children[value]
+                try:
+                    self.metric.remove(*self.fixed, value)
+                except KeyError:
+                    pass
+            return len(stale)
+
+    def values(self):
+        with self._lock:
+            return sorted(self._children)
+
+
+def observe(child, amount, request_id=None):
+    """observe() con il request id come exemplar (se abilitato e supportato dal client)."""
+    if request_id and METRICS_EXEMPLARS:
+        try:
+            child.observe(amount, exemplar={"request_id": str(request_id)[:EXEMPLAR_MAX_LEN]})
+            return
+        except TypeError:
+            pass  # prometheus_client < 0.9: niente exemplar
+    child.observe(amount)
+
+
+@contextmanager
+def timed(child, request_id=None):
+    """Come Histogram.time(), con exemplar; osserva anche se il blocco solleva."""
+    start = default_timer()
+    try:
+        yield
+    finally:
+        observe(child, max(default_timer() - start, 0), request_id)
+
+
+def exposition(registry, accept_header):
+    """(body, content_type) per /metrics: OpenMetrics (con exemplar) se il client lo chiede."""
+    from prometheus_client.exposition import choose_encoder
+    encoder, content_type = choose_encoder(accept_header)
+    return encoder(registry), content_type
@@ -0,0 +1,373 @@
+"""
+SERVER_MODE=prefork: più processi worker sulla stessa porta, un solo modello.
+
+Il processo padre importa app.py (quindi crea gli step e carica il modello
+una volta sola), apre il socket in ascolto e poi crea PREFORK_WORKERS
+processi con fork(): ognuno accetta connessioni sullo stesso socket con il
+server threaded di werkzeug ed esegue in parallelo, su core diversi, le
+fasi CPU (HTTP, decode, step senza modello, encode, inoltro).
+
+Gli step che dichiarano `shared_model = True` (detector, upscaler) non
+girano nei worker: il loro run() viene eseguito dal padre, proprietario del
+modello, così il MicroBatcher raccoglie in un solo batch i frame di tutti i
+worker e la GPU ha un solo contesto. Il frame passa in memoria condivisa
+(mmap anonimo creato prima del fork, PREFORK_SLOTS slot da PREFORK_SLOT_MB
+per worker): il worker lo copia nello slot, il padre lo usa senza copie
+(il detector disegna direttamente nello slot) e il worker copia fuori il
+risultato. Sulla Pipe viaggiano solo metadati; un frame più grande dello
+slot viene serializzato sulla Pipe.
+
+Metriche: prometheus_client in modalità multiprocess (file mmap in
+PROMETHEUS_MULTIPROC_DIR, un file per processo): qualunque worker risponda
+a /metrics restituisce la somma di tutti i processi, padre compreso.
+
+Segnali: SIGTERM al padre viene girato ai worker, che fanno il graceful
+shutdown di app.py (handle_sigterm); il padre resta vivo finché non sono
+usciti tutti, perché i worker in drain possono ancora chiedergli
+inferenze. /drain arriva a un solo worker: il padre lo estende agli altri
+con SIGUSR1. Se un worker muore il padre ferma gli altri ed esce con
+errore: il riavvio è compito di Kubernetes.
+"""
+import itertools
+import mmap
+import os
+import queue
+import signal
+import socket
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pipe
+
+import numpy as np
+
+from runtime.frame import Frame, as_frame
+
+# --- Config (sovrascrivibile da env / ConfigMap) ---
+# processi worker (0 = uno per core)
+PREFORK_WORKERS = int(os.getenv("PREFORK_WORKERS", "0")) or (os.cpu_count() or 1)
+# chiamate contemporanee al modello per worker e dimensione di ogni slot di memoria condivisa
+PREFORK_SLOTS = int(os.getenv("PREFORK_SLOTS", "4"))
+PREFORK_SLOT_MB = float(os.getenv("PREFORK_SLOT_MB", "16"))
+# intervallo (s) di aggiornamento della readiness degli step del padre vista dai worker
+PREFORK_STATUS_INTERVAL = float(os.getenv("PREFORK_STATUS_INTERVAL", "0.25"))
+
+METRICS_DIR_ENV = "PROMETHEUS_MULTIPROC_DIR"
+
+
+def prepare_metrics_dir():
+    """
+    Da chiamare prima di importare prometheus_client: abilita la modalità
+    multiprocess e svuota i file lasciati da un'esecuzione precedente.
+    """
+    path = os.environ.get(METRICS_DIR_ENV)
+    if not path:
+        path = os.path.join(tempfile.gettempdir(), f"prometheus-multiproc-{os.getpid()}")
+        os.environ[METRICS_DIR_ENV] = path
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.endswith(".db"):
+            os.remove(os.path.join(path, name))
+    return path
+
+
+def metrics_registry():
+    """Registry per /metrics: aggrega i file di tutti i processi."""
+    from prometheus_client import CollectorRegistry, multiprocess
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+class _Channel:
+    """Canale padre <-> worker: Pipe per i messaggi, slot in memoria condivisa per i frame."""
+
+    def __init__(self, index, slots=PREFORK_SLOTS, slot_mb=PREFORK_SLOT_MB):
+        self.index = index
+        self.slots = max(1, slots)
+        self.slot_bytes = int(slot_mb * 1024 * 1024)
+        self.owner_conn, self.worker_conn = Pipe()
+        # mmap anonimo: MAP_SHARED, ereditato dal worker con il fork
+        self.shm = mmap.mmap(-1, self.slots * self.slot_bytes)
+        self.send_lock = threading.Lock()
+        self.pid = None
+
+    def view(self, slot, shape, dtype):
+        count = int(np.prod(shape))
+        return np.frombuffer(self.shm, dtype=dtype, count=count,
+                             offset=slot * self.slot_bytes).reshape(shape)
+
+    def put_frame(self, slot, frame):
+        """Frame -> descrittore per la Pipe; l'array va nello slot se ci sta."""
+        arr = frame.array
+        if arr.nbytes > self.slot_bytes:
+            return ("inline", arr, frame.order, frame.original_size)
+        dst = self.view(slot, arr.shape, arr.dtype)
+        same = (dst.__array_interface__["data"][0] == arr.__array_interface__["data"][0]
+                and dst.strides == arr.strides)
+        if not same:
+            if np.shares_memory(dst, arr):
+                arr = arr.copy()  # vista sullo slot con un altro layout (es. BGR -> RGB)
+            np.copyto(dst, arr)
+        return ("shm", arr.shape, arr.dtype.str, frame.order, frame.original_size)
+
+    def get_frame(self, slot, desc, copy):
+        if desc[0] == "inline":
+            _, arr, order, original_size = desc
+            return Frame(arr, order, original_size)
+        _, shape, dtype, order, original_size = desc
+        arr = self.view(slot, shape, np.dtype(dtype))
+        return Frame(arr.copy() if copy else arr, order, tuple(original_size))
+
+
+class _Reply:
+    __slots__ = ("event", "desc", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.desc = None
+        self.error = None
+
+
+class OwnerClient:
+    """Lato worker: invia i frame al padre e attende il risultato."""
+
+    def __init__(self, channel, status):
+        self._ch = channel
+        self._status = status
+        self._free = queue.Queue()
+        for slot in range(channel.slots):
+            self._free.put(slot)
+        self._ids = itertools.count()
+        self._pending = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._receive, name="prefork-owner", daemon=True).start()
+
+    def ready(self, pos):
+        return self._status[pos] == 1
+
+    def _send(self, msg):
+        with self._ch.send_lock:
+            self._ch.worker_conn.send(msg)
+
+    def call(self, pos, frame, load_profile):
+        slot = self._free.get()  # al più PREFORK_SLOTS chiamate in corso per worker
+        try:
+            reply = _Reply()
+            req_id = next(self._ids)
+            with self._lock:
+                self._pending[req_id] = reply
+            self._send(("run", req_id, pos, slot, self._ch.put_frame(slot, frame), load_profile))
+            reply.event.wait()
+            if reply.error is not None:
+                raise RuntimeError(reply.error)
+            return self._ch.get_frame(slot, reply.desc, copy=True)
+        finally:
+            self._free.put(slot)
+
+    def broadcast_drain(self):
+        self._send(("drain",))
+
+    def _receive(self):
+        while True:
+            try:
+                kind, req_id, value = self._ch.worker_conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                reply = self._pending.pop(req_id, None)
+            if reply is None:
+                continue
+            if kind == "ok":
+                reply.desc = value
+            else:
+                reply.error = value
+            reply.event.set()
+
+        print("[ERROR] Processo padre (modello) non raggiungibile", flush=True)
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for reply in pending.values():
+            reply.error = "processo del modello terminato"
+            reply.event.set()
+
+
+class RemoteStep:
+    """
+    Nel worker sostituisce uno step con `shared_model`: run() viene eseguito
+    dal padre, gli altri attributi (input_min_side, concurrency, ...) restano
+    quelli dello step originale.
+    """
+    accepts_frame = True
+
+    def __init__(self, step, pos, client):
+        self._step = step
+        self._pos = pos
+        self._client = client
+
+    @property
+    def ready(self):
+        return self._client.ready(self._pos)
+
+    def run(self, image, load_profile="light"):
+        return self._client.call(self._pos, as_frame(image), load_profile)
+
+    def __getattr__(self, name):
+        return getattr(self._step, name)
+
+
+class ModelOwner:
+    """Lato padre: esegue gli step con `shared_model` per conto dei worker."""
+
+    def __init__(self, steps, run_step, channels, status, on_drain):
+        self.steps = steps
+        self.run_step = run_step
+        self.channels = channels
+        self.status = status
+        self.on_drain = on_drain
+        # abbastanza thread perché ogni slot di ogni worker possa essere servito:
+        # le richieste concorrenti finiscono nello stesso batch del MicroBatcher
+        self._executor = ThreadPoolExecutor(max_workers=sum(ch.slots for ch in channels))
+
+    def start(self):
+        for ch in self.channels:
+            threading.Thread(target=self._serve, args=(ch,), name=f"prefork-serve-{ch.index}",
+                             daemon=True).start()
+        threading.Thread(target=self._publish_status, name="prefork-status", daemon=True).start()
+
+    def _publish_status(self):
+        while True:
+            for pos, step in enumerate(self.steps):
+                self.status[pos] = 1 if getattr(step, "ready", True) else 0
+            time.sleep(PREFORK_STATUS_INTERVAL)
+
+    def _serve(self, ch):
+        while True:
+            try:
+                msg = ch.owner_conn.recv()
+            except (EOFError, OSError):
+                return
+            if msg[0] == "run":
+                self._executor.submit(self._run, ch, msg)
+            elif msg[0] == "drain":
+                self.on_drain()
+
+    def _run(self, ch, msg):
+        _, req_id, pos, slot, desc, load_profile = msg
+        try:
+            frame = ch.get_frame(slot, desc, copy=False)
+            out = self.run_step(self.steps[pos], frame, load_profile)
+            reply = ("ok", req_id, ch.put_frame(slot, out))
+        except Exception as e:
+            reply = ("error", req_id, f"{type(e).__name__}: {e}")
+        try:
+            with ch.send_lock:
+                ch.owner_conn.send(reply)
+        except (OSError, ValueError) as e:
+            print(f"[WARN] Risposta al worker {ch.index} non inviata: {e}")
+
+
+def _listen(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.listen(socket.SOMAXCONN)
+    return sock
+
+
+def _worker_main(app_module, sock, channel, channels, status, start_config):
+    """Nel processo figlio: proxy degli step condivisi, thread di servizio, server HTTP."""
+    from werkzeug.serving import make_server
+
+    signal.signal(signal.SIGTERM, app_module.handle_sigterm)
+    signal.signal(signal.SIGINT, app_module.handle_sigterm)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: app_module.start_drain(broadcast=False))
+
+    for other in channels:
+        other.owner_conn.close()
+        if other is not channel:
+            other.worker_conn.close()
+
+    client = OwnerClient(channel, status)
+    for pos, step in enumerate(app_module.pipeline):
+        if getattr(step, "shared_model", False):
+            app_module.pipeline[pos] = RemoteStep(step, pos, client)
+    app_module.prefork_worker = client
+
+    # i thread del padre non sopravvivono al fork: ogni worker avvia i suoi
+    app_module.forwarder.start()
+    if app_module.tracer.exporter is not None:
+        app_module.tracer.exporter = app_module.tracing.make_exporter()
+    threading.Thread(target=start_config or app_module.update_kubernetes_config, daemon=True).start()
+
+    server = make_server("0.0.0.0", sock.getsockname()[1], app_module.app, threaded=True, fd=sock.fileno())
+    print(f"[INFO] Worker {channel.index} (pid {os.getpid()}) in ascolto", flush=True)
+    server.serve_forever()
+
+
+def serve(app_module, workers=PREFORK_WORKERS, start_config=None):
+    """
+    Entry point del processo padre: ritorna il codice di uscita quando tutti
+    i worker sono usciti. start_config: thread delle cache K8s di ogni worker
+    (default app_module.update_kubernetes_config).
+    """
+    from prometheus_client import multiprocess
+
+    port = int(app_module.SERVICE_PORT)
+    sock = _listen(port)
+    status = mmap.mmap(-1, max(1, len(app_module.pipeline)))
+    channels = [_Channel(i) for i in range(max(1, workers))]
+
+    for ch in channels:
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _worker_main(app_module, sock, ch, channels, status, start_config)
+            except Exception:
+                traceback.print_exc()
+            os._exit(1)
+        ch.pid = pid
+        ch.worker_conn.close()
+
+    stopping = threading.Event()
+    children = {ch.pid: ch for ch in channels}
+
+    def signal_workers(signum):
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def on_sigterm(signum, frame):
+        if not stopping.is_set():
+            print(f"[SIGTERM] Inoltro ai {len(children)} worker, attendo la loro uscita", flush=True)
+            stopping.set()
+        signal_workers(signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+    signal.signal(signal.SIGINT, on_sigterm)
+
+    owner = ModelOwner(app_module.pipeline, app_module.run_step, channels, status,
+                       on_drain=lambda: signal_workers(signal.SIGUSR1))
+    owner.start()
+    shared = [app_module.pipeline_ids[pos] for pos, step in enumerate(app_module.pipeline)
+              if getattr(step, "shared_model", False)]
+    print(f"[INFO] Prefork: {len(channels)} worker sulla porta {port}, "
+          f"step con modello nel padre: {shared or 'nessuno'}", flush=True)
+
+    exit_code = 0
+    while children:
+        pid, code = os.wait()
+        if pid not in children:
+            continue
+        children.pop(pid)
+        multiprocess.mark_process_dead(pid)
+        if not stopping.is_set():
+            print(f"[ERROR] Worker {pid} terminato (stato {code}), arresto degli altri", flush=True)
+            exit_code = 1
+            stopping.set()
+            signal_workers(signal.SIGTERM)
+    return exit_code
@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+
+import requests
+from prometheus_client import Gauge
+
+from runtime.wire import FORMATS_HEADER
+
+# --- Config (sovrascrivibile da env / ConfigMap) ---
+READINESS_PROBE_INTERVAL = float(os.getenv("READINESS_PROBE_INTERVAL", "1"))
+READINESS_TTL = float(os.getenv("READINESS_TTL", "3"))
+READINESS_PROBE_TIMEOUT = float(os.getenv("READINESS_PROBE_TIMEOUT", "1"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "3"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "10"))
+
+next_step_ready = Gauge(
+    "next_step_ready",
+    "Stato di readiness in cache del prossimo step (1=pronto, 0=non pronto, -1=circuito aperto)",
+    ["pipeline_id", "step_id", "pod_name", "next_step"],
+    multiprocess_mode="liveall"
+)
+
+
+class _State:
+    __slots__ = ("ready", "checked_at", "failures", "open_until", "formats")
+
+    def __init__(self):
+        self.formats = frozenset(["jpeg"])
+        self.ready = False
+        self.checked_at = 0.0
+        self.failures = 0
+        self.open_until = 0.0
+
+
+class ReadinessTracker:
+    """
+    Cache della readiness dei prossimi step.
+
+    Il probe su /readyz viene fatto SOLO dal thread di background
+    (probe_all), mentre il percorso della richiesta legge lo stato in
+    memoria con is_ready() senza mai bloccarsi.
+
+    Dopo CIRCUIT_FAILURE_THRESHOLD fallimenti consecutivi il circuito si
+    apre per CIRCUIT_OPEN_SECONDS: in quel periodo la destinazione è
+    considerata non pronta e non viene interrogata. Alla scadenza si fa
+    un singolo probe (half-open) che richiude o riapre il circuito.
+
+    Dal probe si memorizzano anche i formati frame dichiarati dal
+    prossimo step (header X-Frame-Formats), usati per negoziare il
+    formato di inoltro.
+    """
+
+    def __init__(self, labels, ttl=READINESS_TTL, probe_timeout=READINESS_PROBE_TIMEOUT,
+                 failure_threshold=CIRCUIT_FAILURE_THRESHOLD, open_seconds=CIRCUIT_OPEN_SECONDS):
+        self.labels = tuple(str(l) for l in labels)
+        self.ttl = ttl
+        self.probe_timeout = probe_timeout
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+
+        self._states = {}
+        self._names = {}
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+
+    def register(self, name, url):
+        """Registra una destinazione (name = id dello step successivo)."""
+        with self._lock:
+            if url not in self._states:
+                self._states[url] = _State()
+                self._names[url] = str(name)
+
+    def is_ready(self, url, now=None):
+        now = now or time.time()
+        with self._lock:
+            st = self._states.get(url)
+            if st is None:
+                return False
+            if st.open_until > now:
+                return False
+            return st.ready and (now - st.checked_at) <= self.ttl
+
+    def accepts(self, url, fmt):
+        """True se il prossimo step ha dichiarato di accettare il formato `fmt`."""
+        with self._lock:
+            st = self._states.get(url)
+            return st is not None and fmt in st.formats
+
+    def record(self, url, ok, now=None, formats=None):
+        """Aggiorna lo stato con l'esito di un probe o di un invio."""
+        now = now or time.time()
+        with self._lock:
+            st = self._states.get(url)
+            if st is None:
+                return
+            if formats is not None:
+                st.formats = formats
+            st.checked_at = now
+            if ok:
+                st.ready = True
+                st.failures = 0
+                st.open_until = 0.0
+            else:
+                st.ready = False
+                st.failures += 1
+                if st.failures >= self.failure_threshold:
+                    if st.open_until <= now:
+                        print(f"[WARN] Circuito aperto verso {url} "
+                              f"({st.failures} fallimenti consecutivi)")
+                    st.open_until = now + self.open_seconds
+            value = -1 if st.open_until > now else (1 if st.ready else 0)
+            name = self._names[url]
+        next_step_ready.labels(*self.labels, name).set(value)
+
+    def _probe(self, url):
+        try:
+            r = self._session.get(url.replace("/process", "/readyz"), timeout=self.probe_timeout)
+        except Exception:
+            return False, None
+        raw = r.headers.get(FORMATS_HEADER)
+        # step senza header (versioni precedenti) -> solo jpeg
+        formats = frozenset(f.strip() for f in raw.split(",") if f.strip()) if raw else frozenset(["jpeg"])
+        return r.status_code == 200, formats
+
+    def probe_all(self, only=None):
+        """
+        Interroga /readyz delle destinazioni registrate.
+        `only` (opzionale) limita il probe ai nomi indicati, ad es. gli step attivi.
+        """
+        now = time.time()
+        with self._lock:
+            targets = [
+                url for url, st in self._states.items()
+                if st.open_until <= now and (only is None or self._names[url] in only)
+            ]
+        for url in targets:
+            ok, formats = self._probe(url)
+            self.record(url, ok, formats=formats)
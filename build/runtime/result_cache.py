@@ -0,0 +1,200 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from prometheus_client import Counter
+
+# --- Config (sovrascrivibile da env / ConfigMap) ---
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "false").lower() == "true"
+RESULT_CACHE_MAX_MB = float(os.getenv("RESULT_CACHE_MAX_MB", "256"))
+# directory del livello su disco (vuoto = solo memoria)
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "")
+RESULT_CACHE_DISK_MAX_MB = float(os.getenv("RESULT_CACHE_DISK_MAX_MB", "2048"))
+# attesa massima di una richiesta identica già in corso
+RESULT_CACHE_COALESCE_TIMEOUT = float(os.getenv("RESULT_CACHE_COALESCE_TIMEOUT", "300"))
+
+result_cache_requests = Counter(
+    "result_cache_requests_total",
+    "Esito delle ricerche nella cache dei risultati (hit_memory, hit_disk, coalesced, miss)",
+    ["pipeline_id", "step_id", "pod_name", "result"]
+)
+
+_DISK_PRUNE_EVERY = 50
+
+
+def step_signature(step_confs):
+    """Tipo e parametri degli step eseguiti, in forma canonica."""
+    return json.dumps(
+        [{"type": c.get("type"), "params": c.get("params", {})} for c in step_confs],
+        sort_keys=True, default=str,
+    ).encode()
+
+
+class ResultCache:
+    """
+    Cache dei risultati per step deterministici, indirizzata per contenuto:
+    chiave = sha256(byte in ingresso + tipo/parametri degli step + load_profile).
+    I valori sono bytes (frame già serializzati dal chiamante).
+
+    - livello in memoria LRU limitato in byte
+    - livello opzionale su disco (un file per chiave, potato per mtime)
+    - coalescenza: richieste identiche contemporanee attendono il risultato
+      della prima invece di ricalcolarlo
+
+    Uso:
+        value, lead = cache.begin(key)
+        if lead:
+            try:
+                value = calcola()
+                cache.finish(key, value)
+            except Exception:
+                cache.finish(key, None)
+                raise
+    """
+
+    def __init__(self, labels, signature, max_bytes=int(RESULT_CACHE_MAX_MB * 1024 * 1024),
+                 disk_dir=RESULT_CACHE_DIR, disk_max_bytes=int(RESULT_CACHE_DISK_MAX_MB * 1024 * 1024),
+                 coalesce_timeout=RESULT_CACHE_COALESCE_TIMEOUT):
+        self.signature = signature
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir or None
+        self.disk_max_bytes = disk_max_bytes
+        self.coalesce_timeout = coalesce_timeout
+
+        self._lru = OrderedDict()
+        self._bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._disk_puts = 0
+
+        labels = tuple(str(l) for l in labels)
+        self._counters = {r: result_cache_requests.labels(*labels, r)
+                          for r in ("hit_memory", "hit_disk", "coalesced", "miss")}
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def key(self, data, load_profile):
+        h = hashlib.sha256()
+        h.update(self.signature)
+        h.update(b"\0")
+        h.update(str(load_profile).encode())
+        h.update(b"\0")
+        h.update(data)
+        return h.hexdigest()
+
+    # --- livello in memoria ---
+    def _mem_get(self, key):
+        value = self._lru.get(key)
+        if value is not None:
+            self._lru.move_to_end(key)
+        return value
+
+    def _mem_put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        old = self._lru.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        self._lru[key] = value
+        self._bytes += len(value)
+        while self._bytes > self.max_bytes:
+            _, evicted = self._lru.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    # --- livello su disco ---
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key)
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+            os.utime(path, None)
+            return value
+        except OSError:
+            return None
+
+    def _disk_put(self, key, value):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(value)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[WARN] Scrittura cache su disco fallita: {e}")
+            return
+        self._disk_puts += 1
+        if self._disk_puts % _DISK_PRUNE_EVERY == 0:
+            self._disk_prune()
+
+    def _disk_prune(self):
+        try:
+            entries = [e for e in os.scandir(self.disk_dir) if e.is_file() and not e.name.endswith(".tmp")]
+        except OSError:
+            return
+        stats = [(e.stat().st_mtime, e.stat().st_size, e.path) for e in entries]
+        total = sum(s[1] for s in stats)
+        for _, size, path in sorted(stats):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    # --- API ---
+    def begin(self, key):
+        """
+        Ritorna (value, lead). Se value non è None è un hit.
+        Se lead è True il chiamante deve calcolare il valore e chiamare finish().
+        """
+        with self._lock:
+            value = self._mem_get(key)
+            if value is not None:
+                self._counters["hit_memory"].inc()
+                return value, False
+            event = self._inflight.get(key)
+            if event is None:
+                self._inflight[key] = threading.Event()
+
+        if event is not None:
+            event.wait(self.coalesce_timeout)
+            with self._lock:
+                value = self._mem_get(key)
+            if value is not None:
+                self._counters["coalesced"].inc()
+                return value, False
+            # il primo ha fallito o è scaduto il timeout: calcolo senza coordinarmi
+            self._counters["miss"].inc()
+            return None, False
+
+        value = self._disk_get(key)
+        if value is not None:
+            self._counters["hit_disk"].inc()
+            self.finish(key, value, to_disk=False)
+            return value, False
+
+        self._counters["miss"].inc()
+        return None, True
+
+    def finish(self, key, value, to_disk=True):
+        """Memorizza il valore (se non None) e sblocca le richieste in attesa."""
+        if value is not None:
+            with self._lock:
+                self._mem_put(key, value)
+            if to_disk:
+                self._disk_put(key, value)
+        with self._lock:
+            event = self._inflight.pop(key, None)
+        if event is not None:
+            event.set()
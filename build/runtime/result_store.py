@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# --- Config (sovrascrivibile da env / ConfigMap) ---
+# "" = job disabilitati (comportamento classico: l'ultimo step risponde al chiamante)
+# "memory"                 -> in memoria nel pod (pipeline a un solo pod / test locali)
+# "disk:/percorso"         -> file su un volume condiviso tra gli step
+# "redis://host:6379/0"    -> Redis o server compatibile (richiede il pacchetto redis)
+JOB_STORE = os.getenv("JOB_STORE", "")
+# per quanto tempo restano disponibili stato e risultato di un job
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "600"))
+JOB_STORE_MAX_MB = float(os.getenv("JOB_STORE_MAX_MB", "256"))
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+_DISK_PRUNE_EVERY = 50
+
+
+def _meta(status, error=None, content_type=None):
+    meta = {"status": status, "updated": time.time()}
+    if error:
+        meta["error"] = str(error)
+    if content_type:
+        meta["content_type"] = content_type
+    return meta
+
+
+class MemoryStore:
+    """Stato e risultati in memoria, con TTL e limite in byte sui risultati."""
+
+    def __init__(self, ttl=JOB_RESULT_TTL, max_bytes=int(JOB_STORE_MAX_MB * 1024 * 1024)):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._meta = OrderedDict()
+        self._results = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._meta:
+            job_id, meta = next(iter(self._meta.items()))
+            if now - meta["updated"] <= self.ttl:
+                break
+            self._meta.popitem(last=False)
+            self._drop_result(job_id)
+
+    def _drop_result(self, job_id):
+        data = self._results.pop(job_id, None)
+        if data is not None:
+            self._bytes -= len(data[0])
+
+    def set_status(self, job_id, status, error=None):
+        with self._lock:
+            self._meta.pop(job_id, None)
+            self._meta[job_id] = _meta(status, error)
+            self._expire(time.time())
+
+    def put_result(self, job_id, data, content_type):
+        with self._lock:
+            self._drop_result(job_id)
+            if len(data) <= self.max_bytes:
+                self._results[job_id] = (data, content_type)
+                self._bytes += len(data)
+                while self._bytes > self.max_bytes:
+                    old_id, (old, _) = self._results.popitem(last=False)
+                    self._bytes -= len(old)
+                    self._meta.pop(old_id, None)
+            self._meta.pop(job_id, None)
+            self._meta[job_id] = _meta(DONE, content_type=content_type)
+            self._expire(time.time())
+
+    def get(self, job_id):
+        with self._lock:
+            self._expire(time.time())
+            meta = self._meta.get(job_id)
+            return dict(meta) if meta else None
+
+    def get_result(self, job_id):
+        with self._lock:
+            self._expire(time.time())
+            return self._results.get(job_id)
+
+
+class DiskStore:
+    """Un file di stato (JSON) e uno di risultato per job; potatura per mtime oltre il TTL."""
+
+    def __init__(self, directory, ttl=JOB_RESULT_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self._puts = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, job_id, ext):
+        # l'id arriva dal client: niente percorsi costruiti direttamente con il suo valore
+        return os.path.join(self.directory, hashlib.sha1(job_id.encode()).hexdigest() + ext)
+
+    def _write(self, path, data):
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _after_put(self):
+        with self._lock:
+            self._puts += 1
+            prune = self._puts % _DISK_PRUNE_EVERY == 0
+        if prune:
+            cutoff = time.time() - self.ttl
+            try:
+                for entry in os.scandir(self.directory):
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
+            except OSError:
+                pass
+
+    def set_status(self, job_id, status, error=None):
+        self._write(self._path(job_id, ".json"), json.dumps(_meta(status, error)).encode())
+        self._after_put()
+
+    def put_result(self, job_id, data, content_type):
+        self._write(self._path(job_id, ".bin"), data)
+        self._write(self._path(job_id, ".json"), json.dumps(_meta(DONE, content_type=content_type)).encode())
+        self._after_put()
+
+    def get(self, job_id):
+        path = self._path(job_id, ".json")
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get_result(self, job_id):
+        meta = self.get(job_id)
+        if not meta or meta.get("status") != DONE:
+            return None
+        try:
+            with open(self._path(job_id, ".bin"), "rb") as f:
+                return f.read(), meta.get("content_type", "application/octet-stream")
+        except OSError:
+            return None
+
+
+class RedisStore:
+    """Redis (o compatibile): chiavi job:<id>:meta e job:<id>:result con scadenza TTL."""
+
+    def __init__(self, url, ttl=JOB_RESULT_TTL):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = max(1, int(ttl))
+
+    def set_status(self, job_id, status, error=None):
+        self.client.setex(f"job:{job_id}:meta", self.ttl, json.dumps(_meta(status, error)))
+
+    def put_result(self, job_id, data, content_type):
+        pipe = self.client.pipeline()
+        pipe.setex(f"job:{job_id}:result", self.ttl, data)
+        pipe.setex(f"job:{job_id}:meta", self.ttl, json.dumps(_meta(DONE, content_type=content_type)))
+        pipe.execute()
+
+    def get(self, job_id):
+        raw = self.client.get(f"job:{job_id}:meta")
+        return json.loads(raw) if raw else None
+
+    def get_result(self, job_id):
+        meta = self.get(job_id)
+        if not meta or meta.get("status") != DONE:
+            return None
+        data = self.client.get(f"job:{job_id}:result")
+        if data is None:
+            return None
+        return data, meta.get("content_type", "application/octet-stream")
+
+
+def make_store(spec=JOB_STORE):
+    """Istanzia il backend da JOB_STORE; None se i job sono disabilitati."""
+    if not spec:
+        return None
+    if spec == "memory":
+        return MemoryStore()
+    if spec.startswith("disk:"):
+        return DiskStore(spec[len("disk:"):])
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStore(spec)
+    raise ValueError(f"JOB_STORE non valido: {spec}")
@@ -0,0 +1,198 @@
+import math
+import os
+import random
+import threading
+import time
+
+from prometheus_client import Counter, Gauge
+
+# --- Config (sovrascrivibile da env / ConfigMap) ---
+# preferred      = preferred_next, altrimenti il primo disponibile (comportamento storico)
+# least_inflight = il prossimo step con meno richieste in corso
+# p2c            = power-of-two-choices: due candidati a caso, vince il meno carico
+# ewma           = scelta pesata, peso = 1 / (latenza media mobile * (carico + 1))
+ROUTING_STRATEGY = os.getenv("ROUTING_STRATEGY", "preferred").lower()
+# costante di tempo (s) della media mobile della latenza di inoltro
+ROUTING_EWMA_TAU = float(os.getenv("ROUTING_EWMA_TAU", "10"))
+# per quanto (s) vale l'in-flight riportato dal prossimo step (X-In-Flight)
+ROUTING_REPORT_TTL = float(os.getenv("ROUTING_REPORT_TTL", "5"))
+
+STRATEGIES = ("preferred", "least_inflight", "p2c", "ewma")
+
+routing_decisions_total = Counter(
+    "routing_decisions_total",
+    "Scelte del prossimo step tra le alternative di next_step",
+    ["pipeline_id", "step_id", "pod_name", "next_step", "strategy"]
+)
+
+routing_weight = Gauge(
+    "routing_weight",
+    "Quota di richieste attesa verso il prossimo step secondo la strategia",
+    ["pipeline_id", "step_id", "pod_name", "next_step"],
+    multiprocess_mode="liveall"
+)
+
+routing_latency_ewma = Gauge(
+    "routing_latency_ewma_seconds",
+    "Media mobile della latenza di inoltro verso il prossimo step",
+    ["pipeline_id", "step_id", "pod_name", "next_step"],
+    multiprocess_mode="liveall"
+)
+
+
+class _Target:
+    __slots__ = ("step", "outstanding", "reported", "reported_at", "ewma", "ewma_at",
+                 "decisions", "weight", "latency")
+
+    def __init__(self, step, decisions, weight, latency):
+        self.step = step
+        self.outstanding = 0      # inoltri accodati o in corso da questo pod
+        self.reported = 0         # X-In-Flight + X-Queue-Length dell'ultima risposta
+        self.reported_at = 0.0
+        self.ewma = None
+        self.ewma_at = 0.0
+        self.decisions = decisions
+        self.weight = weight
+        self.latency = latency
+
+
+class Router:
+    """
+    Sceglie il prossimo step tra le alternative pronte di next_step.
+
+    Il carico di una destinazione è la somma degli inoltri ancora aperti da
+    questo pod (started/finished) e dell'in-flight che il prossimo step ha
+    riportato nell'ultima risposta (X-In-Flight, X-Queue-Length), se più
+    recente di ROUTING_REPORT_TTL. La latenza è una media mobile esponenziale
+    nel tempo (ROUTING_EWMA_TAU) del tempo di inoltro, che per /process
+    comprende l'elaborazione del prossimo step; un campione più lento della
+    media la sostituisce subito (peak EWMA). I pesi si adattano quando uno
+    step rallenta o accelera.
+
+    Le destinazioni senza misure di latenza prendono la migliore nota, così
+    vengono provate subito.
+    """
+
+    def __init__(self, labels, strategy=ROUTING_STRATEGY, tau=ROUTING_EWMA_TAU,
+                 report_ttl=ROUTING_REPORT_TTL, rng=None):
+        if strategy not in STRATEGIES:
+            print(f"[WARN] ROUTING_STRATEGY={strategy} non valida, uso 'preferred'")
+            strategy = "preferred"
+        self.labels = tuple(str(l) for l in labels)
+        self.strategy = strategy
+        self.tau = max(tau, 1e-3)
+        self.report_ttl = report_ttl
+        self._rng = rng or random.Random()
+        self._lock = threading.Lock()
+        self._targets = {}  # url -> _Target
+
+    def register(self, step, url):
+        with self._lock:
+            if url not in self._targets:
+                step = str(step)
+                self._targets[url] = _Target(
+                    step,
+                    routing_decisions_total.labels(*self.labels, step, self.strategy),
+                    routing_weight.labels(*self.labels, step),
+                    routing_latency_ewma.labels(*self.labels, step),
+                )
+            return self._targets[url]
+
+    def started(self, url):
+        with self._lock:
+            target = self._targets.get(url)
+            if target is not None:
+                target.outstanding += 1
+
+    def finished(self, url):
+        with self._lock:
+            target = self._targets.get(url)
+            if target is not None:
+                target.outstanding = max(0, target.outstanding - 1)
+
+    def observe(self, url, resp, seconds):
+        """on_response del Forwarder: latenza dell'invio e carico riportato dal prossimo step."""
+        if resp is None or resp.status_code >= 500:
+            return  # i guasti li gestisce il circuit breaker della readiness
+        now = time.time()
+        reported = None
+        try:
+            if "X-In-Flight" in resp.headers:
+                reported = int(resp.headers["X-In-Flight"]) + int(resp.headers.get("X-Queue-Length", 0))
+        except ValueError:
+            pass
+        with self._lock:
+            target = self._targets.get(url)
+            if target is None:
+                return
+            if reported is not None:
+                target.reported, target.reported_at = reported, now
+            if resp.status_code == 429:
+                return  # tempo di rifiuto, non di servizio
+            if target.ewma is None or seconds > target.ewma:
+                # peak EWMA: un rallentamento conta subito, il recupero in ~tau secondi
+                target.ewma = seconds
+            else:
+                w = math.exp(-(now - target.ewma_at) / self.tau)
+                target.ewma = target.ewma * w + seconds * (1 - w)
+            target.ewma_at = now
+            target.latency.set(target.ewma)
+
+    def _load(self, target, now):
+        fresh = now - target.reported_at <= self.report_ttl
+        return target.outstanding + (target.reported if fresh else 0)
+
+    def _costs(self, targets, now):
+        known = [t.ewma for t in targets if t.ewma is not None]
+        default = min(known) if known else 1.0
+        costs = []
+        for t in targets:
+            load = self._load(t, now) + 1
+            costs.append(load * (t.ewma if t.ewma is not None else default)
+                         if self.strategy == "ewma" else load)
+        return costs
+
+    def choose(self, candidates, preferred=None):
+        """candidates: [(step, url)] pronti. Ritorna lo step scelto."""
+        if self.strategy == "preferred" or len(candidates) == 1:
+            chosen, url = candidates[0]
+            for step, step_url in candidates:
+                if preferred is not None and str(step) == str(preferred):
+                    chosen, url = step, step_url
+            self.register(chosen, url).decisions.inc()
+            return chosen
+
+        now = time.time()
+        targets = [self.register(step, url) for step, url in candidates]
+        with self._lock:
+            costs = self._costs(targets, now)
+            if self.strategy == "least_inflight":
+                # a parità di carico: preferred_next, poi l'ordine di next_step
+                best = min(range(len(targets)),
+                           key=lambda i: (costs[i], str(candidates[i][0]) != str(preferred), i))
+            elif self.strategy == "p2c":
+                i, j = self._rng.sample(range(len(targets)), 2)
+                best = i if costs[i] <= costs[j] else j
+            else:
+                inverse = [1.0 / max(c, 1e-9) for c in costs]
+                best = self._pick_weighted(inverse)
+            total = sum(1.0 / max(c, 1e-9) for c in costs)
+            for t, c in zip(targets, costs):
+                t.weight.set((1.0 / max(c, 1e-9)) / total)
+        targets[best].decisions.inc()
+        return candidates[best][0]
+
+    def _pick_weighted(self, weights):
+        x = self._rng.random() * sum(weights)
+        for i, w in enumerate(weights):
+            x -= w
+            if x < 0:
+                return i
+        return len(weights) - 1
+
+    def snapshot(self):
+        """Stato per destinazione (debug / benchmark)."""
+        now = time.time()
+        with self._lock:
+            return {t.step: {"outstanding": t.outstanding, "load": self._load(t, now), "ewma_s": t.ewma}
+                    for t in self._targets.values()}
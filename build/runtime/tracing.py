@@ -0,0 +1,236 @@
+import hashlib
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import requests
+from prometheus_client import Histogram
+
+from runtime import metrics
+
+# --- Config (sovrascrivibile da env / ConfigMap) ---
+# "" = nessun export; "file:/percorso/spans.jsonl" oppure URL di un collector
+# compatibile Zipkin v2 (es. http://zipkin:9411/api/v2/spans, OTel collector)
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "")
+# frazione di richieste tracciate (decisa al primo step e propagata)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "1"))
+
+HEADER_REQUEST_ID = "X-Request-ID"
+HEADER_PARENT_SPAN = "X-Parent-Span"
+HEADER_REQUEST_START = "X-Request-Start"
+HEADER_SAMPLED = "X-Trace-Sampled"
+HEADERS = (HEADER_REQUEST_ID, HEADER_PARENT_SPAN, HEADER_REQUEST_START, HEADER_SAMPLED)
+
+step_phase_latency = Histogram(
+    "step_phase_seconds",
+    "Tempo per fase della richiesta nello step (queue, decode, compute, encode, forward)",
+    ["pipeline_id", "step_id", "pod_name", "phase"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 300)
+)
+
+pipeline_e2e_latency = Histogram(
+    "pipeline_end_to_end_seconds",
+    "Latenza dal primo step (X-Request-Start) alla fine dell'ultimo step",
+    ["pipeline_id", "step_id", "pod_name"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1200)
+)
+
+_HEX_ID = re.compile(r"^([0-9a-f]{16}|[0-9a-f]{32})$")
+
+
+def new_span_id():
+    return uuid.uuid4().hex[:16]
+
+
+def extract(get):
+    """Header di tracing della richiesta in ingresso; `get(nome)` come request.headers.get."""
+    found = {}
+    for name in HEADERS:
+        value = get(name)
+        if value:
+            found[name] = value
+    return found
+
+
+class SpanExporter:
+    """
+    Esporta gli span in background in formato Zipkin v2 (JSON): su file, una
+    riga per span, oppure a lotti via POST a un collector. Coda limitata: se
+    è piena gli span vengono scartati invece di rallentare le richieste.
+    """
+
+    def __init__(self, target, queue_size=TRACE_QUEUE_SIZE, flush_interval=TRACE_FLUSH_INTERVAL):
+        self.target = target
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._session = None
+        threading.Thread(target=self._loop, name="span-exporter", daemon=True).start()
+        print(f"[INFO] Export span verso {target}")
+
+    def export(self, span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < 500:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                print(f"[WARN] Export di {len(batch)} span fallito: {e}")
+
+    def _write(self, batch):
+        if self.target.startswith("file:"):
+            with open(self.target[len("file:"):], "a") as f:
+                for span in batch:
+                    f.write(json.dumps(span) + "\n")
+            return
+        if self._session is None:
+            self._session = requests.Session()
+        self._session.post(self.target, json=batch, timeout=5).raise_for_status()
+
+
+class Tracer:
+    """Crea il contesto di tracing di ogni richiesta e registra le fasi (istogrammi + span)."""
+
+    def __init__(self, service, labels, exporter=None, sample_rate=TRACE_SAMPLE_RATE):
+        self.service = service
+        self.labels = tuple(str(l) for l in labels)
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self._timers = {}
+        self._e2e = pipeline_e2e_latency.labels(*self.labels)
+        self._tags = dict(zip(("pipeline_id", "step_id", "pod_name"), self.labels))
+
+    def begin(self, incoming=None):
+        incoming = incoming or {}
+        request_id = incoming.get(HEADER_REQUEST_ID) or uuid.uuid4().hex
+        sampled = incoming.get(HEADER_SAMPLED)
+        if sampled is None:
+            sampled = self.exporter is not None and random.random() < self.sample_rate
+        else:
+            sampled = sampled == "1"
+        return RequestTrace(self, request_id, incoming.get(HEADER_PARENT_SPAN),
+                            incoming.get(HEADER_REQUEST_START), sampled)
+
+    def observe_end_to_end(self, seconds, request_id=None):
+        metrics.observe(self._e2e, seconds, request_id)
+
+    def observe(self, phase, seconds):
+        timer = self._timers.get(phase)
+        if timer is None:
+            timer = self._timers[phase] = step_phase_latency.labels(*self.labels, phase)
+        timer.observe(seconds)
+
+    def span(self, trace, name, start, end, parent, span_id=None, tags=None):
+        if not trace.sampled or self.exporter is None:
+            return
+        all_tags = dict(self._tags)
+        all_tags["request_id"] = trace.request_id
+        for k, v in (tags or {}).items():
+            all_tags[k] = str(v)
+        span = {
+            "traceId": trace.trace_id,
+            "id": span_id or new_span_id(),
+            "name": name,
+            "timestamp": int(start * 1e6),
+            "duration": max(1, int((end - start) * 1e6)),
+            "localEndpoint": {"serviceName": self.service},
+            "tags": all_tags,
+        }
+        if parent:
+            span["parentId"] = parent
+        self.exporter.export(span)
+
+
+class RequestTrace:
+    """
+    Contesto di una richiesta in questo step: request id, span dello step
+    (padre delle fasi) e istante di ingresso nella pipeline.
+    """
+
+    def __init__(self, tracer, request_id, parent_span, request_start, sampled):
+        self.tracer = tracer
+        self.request_id = request_id
+        # id compatibile Zipkin anche se il client passa un X-Request-ID arbitrario
+        self.trace_id = request_id if _HEX_ID.match(request_id) else hashlib.md5(request_id.encode()).hexdigest()
+        self.parent_span = parent_span
+        self.span_id = new_span_id()
+        self.start = time.time()
+        self.request_start = request_start or repr(self.start)
+        self.sampled = sampled
+        self._finished = False
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.time())
+
+    def record(self, name, start, end, **tags):
+        self.tracer.observe(name, end - start)
+        self.tracer.span(self, name, start, end, parent=self.span_id, tags=tags)
+
+    def queue_wait(self, waited):
+        """Callback per AdmissionController.stage(on_wait=...)."""
+        now = time.time()
+        self.record("queue", now - waited, now)
+
+    def forwarded(self, ok, enqueued, end):
+        """Callback per Forwarder.submit(on_done=...): chiude la fase forward e lo span dello step."""
+        self.record("forward", enqueued, end, ok=ok)
+        self.finish(end, forwarded=ok)
+
+    def end_to_end(self, now=None):
+        """Da chiamare all'ultimo step: latenza dall'ingresso nella pipeline."""
+        now = now or time.time()
+        try:
+            elapsed = now - float(self.request_start)
+        except ValueError:
+            return
+        if elapsed >= 0:
+            self.tracer.observe_end_to_end(elapsed, self.request_id)
+
+    def headers(self):
+        """Header da propagare al prossimo step."""
+        return {
+            HEADER_REQUEST_ID: self.request_id,
+            HEADER_PARENT_SPAN: self.span_id,
+            HEADER_REQUEST_START: self.request_start,
+            HEADER_SAMPLED: "1" if self.sampled else "0",
+        }
+
+    def finish(self, end=None, **tags):
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        self.tracer.span(self, f"step-{self.tracer.labels[1]}", self.start, end or time.time(),
+                         parent=self.parent_span, span_id=self.span_id, tags=tags)
+
+
+def make_exporter(target=TRACE_EXPORT):
+    return SpanExporter(target) if target else None
@@ -0,0 +1,129 @@
+"""
+Formato dei frame tra step della pipeline.
+
+Tra step intermedi il frame viaggia come array uint8 "raw" con un piccolo
+header (shape + dtype + compressione), evitando decode/encode JPEG ad ogni
+hop e la perdita di qualità. Solo l'ultimo step produce JPEG.
+
+Header (little endian, 20 byte):
+    magic   4s   b"RAWF"
+    version B
+    dtype   B    (vedi DTYPES)
+    comp    B    (vedi COMPRESSIONS)
+    ndim    B
+    shape   3I   (h, w, c) - c=1 per immagini a un canale
+"""
+import struct
+
+import numpy as np
+
+try:
+    import lz4.frame as _lz4
+except ImportError:
+    _lz4 = None
+
+try:
+    import zstandard as _zstd
+except ImportError:
+    _zstd = None
+
+CONTENT_TYPE_RAW = "application/x-raw-frame"
+CONTENT_TYPE_JPEG = "image/jpeg"
+
+# Header con cui ogni step dichiara (su /readyz) i formati che accetta
+FORMATS_HEADER = "X-Frame-Formats"
+
+MAGIC = b"RAWF"
+VERSION = 1
+_HEADER = struct.Struct("<4sBBBB3I")
+
+DTYPES = {1: np.dtype(np.uint8)}
+_DTYPE_CODES = {v: k for k, v in DTYPES.items()}
+
+COMPRESSIONS = {"none": 0, "lz4": 1, "zstd": 2}
+_COMPRESSION_NAMES = {v: k for k, v in COMPRESSIONS.items()}
+
+
+def available_compressions():
+    out = ["none"]
+    if _lz4 is not None:
+        out.append("lz4")
+    if _zstd is not None:
+        out.append("zstd")
+    return out
+
+
+def supported_formats():
+    """Formati accettati da questo pod, es. ['jpeg', 'raw', 'raw+lz4']."""
+    return ["jpeg"] + ["raw" if c == "none" else f"raw+{c}" for c in available_compressions()]
+
+
+def format_name(compression):
+    return "raw" if compression == "none" else f"raw+{compression}"
+
+
+def encode_frame(arr, compression="none"):
+    """ndarray uint8 (h, w) o (h, w, c) -> bytes"""
+    arr = np.ascontiguousarray(arr)
+    if arr.dtype not in _DTYPE_CODES:
+        raise ValueError(f"dtype non supportato: {arr.dtype}")
+    if arr.ndim == 2:
+        h, w = arr.shape
+        c = 1
+    elif arr.ndim == 3:
+        h, w, c = arr.shape
+    else:
+        raise ValueError(f"shape non supportata: {arr.shape}")
+
+    payload = arr.data
+    if compression == "lz4":
+        if _lz4 is None:
+            raise ValueError("lz4 non disponibile")
+        payload = _lz4.compress(payload)
+    elif compression == "zstd":
+        if _zstd is None:
+            raise ValueError("zstandard non disponibile")
+        payload = _zstd.ZstdCompressor(level=1).compress(payload)
+    elif compression != "none":
+        raise ValueError(f"compressione sconosciuta: {compression}")
+
+    header = _HEADER.pack(MAGIC, VERSION, _DTYPE_CODES[arr.dtype],
+                          COMPRESSIONS[compression], arr.ndim, h, w, c)
+    # una sola copia del payload (header + bytes(payload) ne farebbe due)
+    return b"".join((header, payload))
+
+
+def decode_frame(data):
+    """bytes -> ndarray uint8 (vista sul buffer quando non compresso)"""
+    if len(data) < _HEADER.size:
+        raise ValueError("frame raw troncato")
+    magic, version, dtype_code, comp, ndim, h, w, c = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("header frame raw non valido")
+
+    dtype = DTYPES.get(dtype_code)
+    if dtype is None:
+        raise ValueError(f"dtype code sconosciuto: {dtype_code}")
+
+    payload = memoryview(data)[_HEADER.size:]
+    compression = _COMPRESSION_NAMES.get(comp)
+    if compression == "lz4":
+        if _lz4 is None:
+            raise ValueError("frame lz4 ma lz4 non disponibile")
+        payload = _lz4.decompress(payload)
+    elif compression == "zstd":
+        if _zstd is None:
+            raise ValueError("frame zstd ma zstandard non disponibile")
+        payload = _zstd.ZstdDecompressor().decompress(payload, max_output_size=h * w * c * dtype.itemsize)
+    elif compression != "none":
+        raise ValueError(f"compressione sconosciuta: {comp}")
+
+    shape = (h, w) if ndim == 2 else (h, w, c)
+    arr = np.frombuffer(payload, dtype=dtype)
+    if arr.size != h * w * c:
+        raise ValueError("dimensione frame raw non coerente con l'header")
+    return arr.reshape(shape)
+
+
+def is_raw(content_type):
+    return (content_type or "").split(";")[0].strip() == CONTENT_TYPE_RAW
@@ -2,8 +2,40 @@ import tensorflow as tf
 import tensorflow_hub as hub
 import numpy as np
 import cv2
-from PIL import Image
+import hashlib
+import os
 import threading
+import time
+from prometheus_client import Gauge
+from runtime.batching import MicroBatcher
+from runtime.frame import Frame, as_frame, BGR, GRAY, RGB
+
+# --- Config (sovrascrivibile da env / ConfigMap) ---
+CLASSIFIER_MODEL_URL = os.getenv(
+    "CLASSIFIER_MODEL_URL", "https://tfhub.dev/tensorflow/ssd_mobilenet_v2/fpnlite_320x320/1"
+)
+# SavedModel già scaricato (nell'immagine o su un volume): se esiste non si va in rete.
+# Sovrascrivibile per step con "model_path" nei params
+CLASSIFIER_MODEL_PATH = os.getenv("CLASSIFIER_MODEL_PATH", "")
+# cache dei download di TF Hub (TFHUB_CACHE_DIR): su un volume persistente il
+# modello viene scaricato una volta sola e riusato ai riavvii del pod
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", "")
+# inferenze a vuoto per ogni risoluzione di profilo prima di dichiararsi pronti
+CLASSIFIER_WARMUP = os.getenv("CLASSIFIER_WARMUP", "true").lower() == "true"
+
+model_startup_seconds = Gauge(
+    "model_startup_seconds",
+    "Durata delle fasi di avvio del modello (load, warmup_<risoluzione>, total)",
+    ["model", "phase", "source"],
+    multiprocess_mode="max"
+)
+
+model_ready_gauge = Gauge(
+    "model_ready",
+    "1 quando il modello è caricato e riscaldato",
+    ["model"],
+    multiprocess_mode="max"
+)
 
 # --- Semaforo Globale ---
 # Permette solo a 1 thread alla volta di eseguire l'inferenza sulla GPU
@@ -18,64 +50,217 @@ for gpu in gpus:
     
 _global_infer_fn = None
 _model_ready = False
+_load_started = False
+_load_lock = threading.Lock()
 PROFILE_RESOLUTION = {
     "light": 320,
     "heavy": 640,
 }
+MODEL_LABEL = "classifier_light"
+
+
+def model_source(model_path=None, model_url=None):
+    """
+    (handle per hub.load, origine): SavedModel locale se esiste, altrimenti
+    l'URL TF Hub, dalla cache MODEL_CACHE_DIR se già scaricato.
+    """
+    model_path = model_path or CLASSIFIER_MODEL_PATH
+    model_url = model_url or CLASSIFIER_MODEL_URL
+    if model_path:
+        if os.path.isdir(model_path):
+            return model_path, "local"
+        print(f"[WARN] model_path {model_path} non trovato, uso {model_url}")
+    if MODEL_CACHE_DIR:
+        os.environ["TFHUB_CACHE_DIR"] = MODEL_CACHE_DIR
+        # stessa directory che usa il resolver di TF Hub: sha1 dell'URL
+        cached = os.path.join(MODEL_CACHE_DIR, hashlib.sha1(model_url.encode("utf8")).hexdigest())
+        if os.path.isdir(cached):
+            return model_url, "cache"
+    return model_url, "download"
+
+
+def _is_batch_shape_error(e):
+    """
+    Il modello non accetta input con batch > 1 (firma con batch fisso):
+    l'unico errore per cui il batching va disattivato per sempre. Gli altri
+    (OOM transitorio, op cancellata) valgono solo per quella chiamata.
+    """
+    invalid_argument = getattr(getattr(tf, "errors", None), "InvalidArgumentError", None)
+    return isinstance(e, ValueError) or (invalid_argument is not None and isinstance(e, invalid_argument))
+
 
-def load_model():
+def run_warmup(infer_fn, source):
+    """
+    Traccia il tf.function per ogni risoluzione di profilo e per ogni
+    dimensione di batch che _infer_batch può passare al modello (1 e
+    max_batch, vedi _pad_batch) prima della prima richiesta vera.
+    """
+    global _batch_supported
+    for size in sorted(set(PROFILE_RESOLUTION.values())):
+        start = time.time()
+        with gpu_semaphore:
+            infer_fn(tf.zeros([1, size, size, 3], dtype=tf.uint8))
+            if batcher.max_batch > 1 and _batch_supported:
+                try:
+                    infer_fn(tf.zeros([_padded_size(2), size, size, 3], dtype=tf.uint8))
+                except Exception as e:
+                    if not _is_batch_shape_error(e):
+                        print(f"[WARN] Warm-up batched fallito, batching resta attivo: {e}", flush=True)
+                    else:
+                        print(f"[WARN] Inferenza batched non supportata dal modello, uso batch=1: {e}", flush=True)
+                        _batch_supported = False
+        elapsed = time.time() - start
+        model_startup_seconds.labels(MODEL_LABEL, f"warmup_{size}", source).set(elapsed)
+        print(f"[INFO] Warm-up {size}x{size}: {elapsed:.2f}s", flush=True)
+
+
+def load_model(model_path=None, model_url=None, warm=CLASSIFIER_WARMUP):
     global _global_infer_fn, _model_ready
-    model_url="https://tfhub.dev/tensorflow/ssd_mobilenet_v2/fpnlite_320x320/1"
-    print("[INFO] Loading TF model async...")
+    handle, source = model_source(model_path, model_url)
+    print(f"[INFO] Loading TF model async ({source}: {handle})...")
+    start = time.time()
     try:
-        model = hub.load(model_url)
+        model = hub.load(handle)
         @tf.function
         def infer_fn(input_tensor):
             return model(input_tensor)
 
+        model_startup_seconds.labels(MODEL_LABEL, "load", source).set(time.time() - start)
+        if warm:
+            run_warmup(infer_fn, source)
         _global_infer_fn = infer_fn
+        # pronto (e /readyz ok) solo a modello caricato e riscaldato
         _model_ready = True
-        print("[INFO] Model loaded successfully.", flush=True)
+        model_ready_gauge.labels(MODEL_LABEL).set(1)
+        model_startup_seconds.labels(MODEL_LABEL, "total", source).set(time.time() - start)
+        print(f"[INFO] Model loaded successfully in {time.time() - start:.1f}s.", flush=True)
     except Exception as e:
         print(f"[ERROR] Model load failed: {e}", flush=True)
-        
-threading.Thread(target=load_model, daemon=True).start()
+
+
+def start_loading(model_path=None, model_url=None, warm=CLASSIFIER_WARMUP):
+    """Avvia il caricamento in background una sola volta per processo (primo Classifier creato)."""
+    global _load_started
+    with _load_lock:
+        if _load_started or _model_ready:
+            return
+        _load_started = True
+    threading.Thread(target=load_model, args=(model_path, model_url, warm), daemon=True).start()
+
+# Il modello TF Hub dichiara input [1, h, w, 3]: se il batch > 1 viene
+# rifiutato si ripiega su inferenze singole dentro lo stesso batch.
+_batch_supported = True
+
+
+def _padded_size(count):
+    """
+    Dimensione di batch passata al modello per `count` frame: i batch
+    parziali vengono riempiti fino a max_batch, così il tf.function ha solo
+    due forme (1 e max_batch) già tracciate dal warm-up, invece di un
+    retrace di qualche secondo sul percorso della richiesta per ogni
+    dimensione nuova.
+    """
+    return 1 if count <= 1 else batcher.max_batch
+
+
+def _pad_batch(frames):
+    """Stack dei frame più frame a zero fino a _padded_size (scartati dopo l'inferenza)."""
+    batch = np.stack(frames)
+    missing = _padded_size(len(frames)) - len(frames)
+    if missing > 0:
+        batch = np.concatenate([batch, np.zeros((missing,) + batch.shape[1:], dtype=batch.dtype)])
+    return batch
+
+def _infer_batch(size, frames):
+    """frames: lista di array uint8 [size, size, 3] -> lista di (boxes, scores, classes)"""
+    global _batch_supported
+
+    if not _model_ready or _global_infer_fn is None:
+        raise RuntimeError("Model not ready yet")
+
+    with gpu_semaphore:
+        if len(frames) > 1 and _batch_supported:
+            try:
+                outputs = _global_infer_fn(tf.convert_to_tensor(_pad_batch(frames)))
+                boxes = outputs["detection_boxes"].numpy()
+                scores = outputs["detection_scores"].numpy()
+                classes = outputs["detection_classes"].numpy().astype(np.int32)
+                return [(boxes[i], scores[i], classes[i]) for i in range(len(frames))]
+            except Exception as e:
+                if not _is_batch_shape_error(e):
+                    # errore transitorio: questo batch frame per frame, il prossimo di nuovo batched
+                    print(f"[WARN] Inferenza batched fallita, riprovo frame per frame: {e}", flush=True)
+                else:
+                    print(f"[WARN] Inferenza batched non supportata dal modello, uso batch=1: {e}", flush=True)
+                    _batch_supported = False
+
+        results = []
+        for frame in frames:
+            outputs = _global_infer_fn(tf.expand_dims(frame, 0))
+            # Estraiamo i risultati in numpy subito per liberare la memoria TF
+            results.append((
+                outputs["detection_boxes"][0].numpy(),
+                outputs["detection_scores"][0].numpy(),
+                outputs["detection_classes"][0].numpy().astype(np.int32),
+            ))
+        return results
+
+# Raggruppa i frame concorrenti con la stessa risoluzione di profilo
+batcher = MicroBatcher(_infer_batch, name="classifier_light")
 
 class Classifier:
-    def __init__(self, model_name="pednet", threshold=0.5, **kwargs):
+    # riceve il Frame: ridimensiona dall'array decodificato e disegna in-place
+    accepts_frame = True
+    # SERVER_MODE=prefork: modello e batcher restano nel processo padre, i worker gli inviano i frame
+    shared_model = True
+
+    def __init__(self, model_name="pednet", threshold=0.5, downscale_input=False,
+                 model_path=None, model_url=None, warmup=CLASSIFIER_WARMUP, **kwargs):
         self.threshold = threshold
+        # modello condiviso da tutte le istanze: scaricato/caricato una volta sola
+        start_loading(model_path, model_url, bool(warmup))
+        # con downscale_input il JPEG viene decodificato già ridotto (scalatura DCT)
+        # fino alla risoluzione del profilo: box disegnati sull'immagine ridotta
+        self.downscale_input = bool(downscale_input)
+        # richieste da ammettere insieme in run() perché il batcher possa riempire un batch
+        self.concurrency = batcher.max_batch
 
     @property
     def ready(self):
         return _model_ready 
 
-    def run(self, image: Image.Image, load_profile="light"):
+    def input_min_side(self, load_profile):
+        if not self.downscale_input:
+            return None
+        return PROFILE_RESOLUTION.get(load_profile, 320)
+
+    def run(self, frame, load_profile="light"):
         global _global_infer_fn, _model_ready
 
         if not _model_ready or _global_infer_fn is None:
             raise RuntimeError("Model not ready yet")
 
+        frame = as_frame(frame)
+        if frame.order == GRAY:
+            frame = Frame(frame.rgb(), RGB, frame.original_size)
+
         # 1. Pre-processing (Eseguito in parallelo, usa solo CPU/RAM)
-        np_img = np.array(image, dtype=np.uint8)
-        h_orig, w_orig = np_img.shape[:2]
+        h_orig, w_orig = frame.array.shape[:2]
         size = PROFILE_RESOLUTION.get(load_profile, 320)
         # target_w, target_h = 320, 320
-        np_resized = cv2.resize(np_img, (size, size))
-        input_tensor = tf.expand_dims(np_resized, 0)
+        np_resized = cv2.resize(frame.array, (size, size))
+        if frame.order == BGR:
+            # il modello vuole RGB: si inverte solo l'immagine già ridotta
+            np_resized = np.ascontiguousarray(np_resized[..., ::-1])
 
         # 2. Sezione Critica: Accesso alla GPU
-        # Il semaforo mette in coda le richieste extra senza farle crashare
-        
-        with gpu_semaphore:
-            outputs = _global_infer_fn(input_tensor)
-            
-            # Estraiamo i risultati in numpy subito per liberare la memoria TF
-            boxes = outputs["detection_boxes"][0].numpy()
-            scores = outputs["detection_scores"][0].numpy()
-            classes = outputs["detection_classes"][0].numpy().astype(np.int32)
+        # Il batcher mette in coda le richieste con la stessa risoluzione e le
+        # esegue insieme (fino a BATCH_MAX_SIZE o BATCH_MAX_WAIT_MS)
+        boxes, scores, classes = batcher.submit(size, np_resized)
 
-        # 3. Post-processing (Disegno dei box)
-        np_draw = cv2.cvtColor(np_img, cv2.COLOR_RGB2BGR)
+        # 3. Post-processing (Disegno dei box direttamente sul frame: il verde
+        # (0, 255, 0) è lo stesso in RGB e BGR, nessuna conversione di colore)
+        np_draw = frame.writable()
         for box, score, label in zip(boxes, scores, classes):
             if score < self.threshold:
                 continue
@@ -94,5 +279,4 @@ class Classifier:
                 0.5, (0, 255, 0), 2,
             )
 
-        np_rgb = cv2.cvtColor(np_draw, cv2.COLOR_BGR2RGB)
-        return Image.fromarray(np_rgb)
+        return frame
@@ -1,8 +1,24 @@
-from PIL import ImageFilter
+import cv2
+import numpy as np
+
+from runtime.frame import Frame
+
+# kernel di ImageFilter.SHARPEN di PIL (il risultato differisce al più di 1 per arrotondamento)
+_SHARPEN = np.array([[-2, -2, -2], [-2, 32, -2], [-2, -2, -2]], dtype=np.float32) / 16
+
 
 class Deblur:
+    # stesso input + stessi parametri -> stesso output (cacheabile)
+    deterministic = True
+    # filtra l'array del Frame in qualunque ordine di canali, senza passare da PIL
+    accepts_frame = True
+
     def __init__(self, **kwargs):
         pass
 
-    def run(self, image, load_profile="light"):
-        return image.filter(ImageFilter.SHARPEN)
+    def run(self, frame, load_profile="light"):
+        out = cv2.filter2D(frame.array, -1, _SHARPEN, borderType=cv2.BORDER_REPLICATE)
+        # come PIL: il bordo di un pixel resta quello originale
+        out[0, :], out[-1, :], out[:, 0], out[:, -1] = \
+            frame.array[0, :], frame.array[-1, :], frame.array[:, 0], frame.array[:, -1]
+        return Frame(out, frame.order, frame.original_size)
@@ -1,8 +1,19 @@
-from PIL import ImageOps
+import cv2
+
+from runtime.frame import Frame, BGR, GRAY
+
 
 class Grayscale:
+    # stesso input + stessi parametri -> stesso output (cacheabile)
+    deterministic = True
+    # lavora sull'array del Frame: un solo canale in uscita, niente ritorno a RGB
+    accepts_frame = True
+
     def __init__(self, **kwargs):
         pass
 
-    def run(self, image, load_profile="light"):
-        return ImageOps.grayscale(image).convert("RGB")
+    def run(self, frame, load_profile="light"):
+        if frame.order == GRAY:
+            return frame
+        code = cv2.COLOR_BGR2GRAY if frame.order == BGR else cv2.COLOR_RGB2GRAY
+        return Frame(cv2.cvtColor(frame.array, code), GRAY, frame.original_size)
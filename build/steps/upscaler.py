@@ -1,39 +1,50 @@
 import subprocess
 import tempfile
 import os
+import shutil
 import uuid
 import cv2
-from PIL import Image
-import numpy as np
 import threading
 import time
+from runtime.batching import MicroBatcher
+from runtime.frame import Frame, as_frame, BGR, GRAY, JPEG_QUALITY
 
 gpu_lock = threading.Semaphore(1)
 
-class Upscaler:
-    def __init__(self, model_path, scale_factor=4, tta=False, max_retries=2, retry_delay=2, **kwargs):
+UPSCALER_BINARY = os.getenv("UPSCALER_BINARY", "/root/realsr-ncnn-vulkan/build/realsr-ncnn-vulkan")
+# frame per lancio del binario in modalità directory (1 = un processo per frame)
+UPSCALER_BATCH_SIZE = int(os.getenv("UPSCALER_BATCH_SIZE", "4"))
+UPSCALER_BATCH_WAIT_MS = float(os.getenv("UPSCALER_BATCH_WAIT_MS", "20"))
+
+
+def default_staging_dir():
+    # file temporanei su tmpfs quando disponibile (niente I/O su disco)
+    env = os.getenv("UPSCALER_STAGING_DIR")
+    if env:
+        return env
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+class RealsrBackend:
+    """
+    Invoca il binario realsr-ncnn-vulkan (o uno compatibile, es. un fake per i
+    test locali). input/output possono essere file singoli o directory: in
+    modalità directory il modello e il device Vulkan vengono creati una sola
+    volta per tutti i frame.
+    """
+
+    def __init__(self, binary, model_path, max_retries=2, retry_delay=2):
+        self.binary = binary
         self.model_path = model_path
-        self.scale_factor = str(scale_factor)
-        self.tta = tta
         self.max_retries = max_retries
         self.retry_delay = retry_delay
-        self.cmd_base = [
-            "/root/realsr-ncnn-vulkan/build/realsr-ncnn-vulkan",
-            "-m", model_path,
-            "-f", "jpg"
-        ]
-
-    def run(self, image, load_profile="light"):
-        tmp_dir = tempfile.gettempdir()
-        uid = uuid.uuid4().hex
-        input_path = os.path.join(tmp_dir, f"input_{uid}.jpg")
-        output_path = os.path.join(tmp_dir, f"output_{uid}.jpg")
-        image.save(input_path, format="JPEG")
 
-        cmd = self.cmd_base + ["-i", input_path, "-o", output_path, "-s", self.scale_factor]
-        # 🔹 override TTA in base al profilo di carico
-        use_tta = self.tta or (load_profile == "heavy")
-        if  use_tta:
+    def run(self, input_path, output_path, scale_factor, tta):
+        cmd = [self.binary, "-m", self.model_path, "-f", "jpg",
+               "-i", input_path, "-o", output_path, "-s", str(scale_factor)]
+        if tta:
             cmd.append("-x")
 
         attempt = 0
@@ -42,7 +53,7 @@ class Upscaler:
                 try:
                     #subprocess.run(cmd, check=True, timeout=1000, capture_output=True)
                     subprocess.run(cmd, check=True, timeout=1000, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    break  # success, esce dal ciclo
+                    return  # success
                 except subprocess.CalledProcessError as e:
                     stderr = e.stderr.decode(errors="ignore") if e.stderr else ""
                     if "vkCreateDevice failed" in stderr:
@@ -50,26 +61,100 @@ class Upscaler:
                         print(f"GPU saturata (tentativo {attempt}/{self.max_retries}), attendo {self.retry_delay}s...")
                         time.sleep(self.retry_delay)
                         continue  # riprova
-                    else:
-                        raise RuntimeError(f"Errore durante l'upscaling: {stderr or e}")
+                    raise RuntimeError(f"Errore durante l'upscaling: {stderr or e}")
                 except subprocess.TimeoutExpired:
                     raise RuntimeError("Timeout: GPU bloccata o troppo lenta durante l’upscaling.")
-                finally:
-                    if os.path.exists(input_path):
-                        os.remove(input_path)
 
-        if attempt == self.max_retries:
-            raise RuntimeError("GPU sempre occupata dopo vari tentativi, richiesta annullata.")
+        raise RuntimeError("GPU sempre occupata dopo vari tentativi, richiesta annullata.")
+
+
+def _write_jpeg(path, frame):
+    # OpenCV scrive direttamente dall'array (BGR: nessuna conversione se il frame lo è già)
+    arr = frame.array if frame.order in (BGR, GRAY) else frame.bgr()
+    if not cv2.imwrite(path, arr, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]):
+        raise RuntimeError(f"Scrittura del frame fallita: {path}")
+
+
+def _read_frame(path):
+    img = cv2.imread(path)
+    if img is None:
+        raise RuntimeError("Nessun file di output generato da realsr-ncnn-vulkan.")
+    return Frame(img, BGR)
+
 
-        if not os.path.exists(output_path):
-            raise RuntimeError("Nessun file di output generato da realsr-ncnn-vulkan.")
+class Upscaler:
+    # stesso input + model_path/scale_factor/tta/load_profile -> stesso output (cacheabile)
+    deterministic = True
+    # il Frame va su file e torna come array BGR di OpenCV, senza passare da PIL
+    accepts_frame = True
+    # SERVER_MODE=prefork: lanci del binario e gruppi del batcher nel processo padre
+    shared_model = True
+
+    def __init__(self, model_path, scale_factor=4, tta=False, max_retries=2, retry_delay=2,
+                 binary=None, staging_dir=None, batch_size=None, batch_wait_ms=None,
+                 backend=None, **kwargs):
+        self.model_path = model_path
+        self.scale_factor = str(scale_factor)
+        self.tta = tta
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.staging_dir = staging_dir or default_staging_dir()
+        self.backend = backend or RealsrBackend(
+            binary or UPSCALER_BINARY, model_path, max_retries=max_retries, retry_delay=retry_delay
+        )
+
+        batch_size = UPSCALER_BATCH_SIZE if batch_size is None else int(batch_size)
+        batch_wait_ms = UPSCALER_BATCH_WAIT_MS if batch_wait_ms is None else float(batch_wait_ms)
+        # raggruppa i frame concorrenti con la stessa opzione TTA in un solo lancio
+        self.batcher = None
+        if batch_size > 1:
+            self.batcher = MicroBatcher(self._run_group, max_batch=batch_size,
+                                        max_wait_ms=batch_wait_ms, name="upscaler")
+        # richieste da ammettere insieme in run() perché il batcher possa riempire un gruppo
+        self.concurrency = max(1, batch_size)
+
+    def run(self, image, load_profile="light"):
+        # 🔹 override TTA in base al profilo di carico
+        use_tta = self.tta or (load_profile == "heavy")
+        image = as_frame(image)
 
-        img = cv2.imread(output_path)
-        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        if self.batcher is not None:
+            try:
+                return self.batcher.submit(use_tta, image)
+            except Exception as e:
+                print(f"[WARN] Upscaling a gruppi fallito, ripiego sul singolo frame: {e}")
+        return self._run_single(image, use_tta)
 
+    def _run_group(self, use_tta, images):
+        """Un solo lancio del binario in modalità directory per tutto il gruppo."""
+        work_dir = os.path.join(self.staging_dir, f"upscale_{uuid.uuid4().hex}")
+        in_dir = os.path.join(work_dir, "in")
+        out_dir = os.path.join(work_dir, "out")
+        os.makedirs(in_dir)
+        os.makedirs(out_dir)
         try:
-            os.remove(output_path)
-        except FileNotFoundError:
-            pass
+            names = [f"{i:04d}" for i in range(len(images))]
+            for name, image in zip(names, images):
+                _write_jpeg(os.path.join(in_dir, f"{name}.jpg"), image)
+
+            self.backend.run(in_dir, out_dir, self.scale_factor, use_tta)
+
+            return [_read_frame(os.path.join(out_dir, f"{name}.jpg")) for name in names]
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
 
-        return Image.fromarray(img_rgb)
+    def _run_single(self, image, use_tta):
+        uid = uuid.uuid4().hex
+        input_path = os.path.join(self.staging_dir, f"input_{uid}.jpg")
+        output_path = os.path.join(self.staging_dir, f"output_{uid}.jpg")
+        _write_jpeg(input_path, image)
+
+        try:
+            self.backend.run(input_path, output_path, self.scale_factor, use_tta)
+            return _read_frame(output_path)
+        finally:
+            for path in (input_path, output_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,150 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from kubernetes.dynamic import DynamicClient
+
+# Diff e apply incrementale degli oggetti di una pipeline (PUT /pipeline/<id>):
+# confronta gli oggetti generati con lo stato nel cluster, applica solo quelli
+# cambiati con server-side apply, in parallelo e a fasi:
+#   0. ConfigMap e Service (le ConfigMap prima dei Deployment: i pod leggono
+#      PIPELINE_CONFIG come env solo all'avvio)
+#   1. Deployment e Ingress
+#   2. cancellazione degli step rimossi (quando gli altri non li usano più)
+
+APPLY_WORKERS = int(os.getenv("APPLY_WORKERS", "8"))
+FIELD_MANAGER = "topography"
+
+PHASES = {"ConfigMap": 0, "Service": 0, "Deployment": 1, "Ingress": 1}
+DELETE_PHASE = 2
+_API_VERSIONS = {
+    "ConfigMap": "v1",
+    "Service": "v1",
+    "Deployment": "apps/v1",
+    "Ingress": "networking.k8s.io/v1",
+}
+
+
+def live_state(api_client, pipeline_id, namespace="default"):
+    """Oggetti della pipeline nel cluster, come dict JSON: {(kind, nome): oggetto}."""
+    v1 = client.CoreV1Api(api_client)
+    apps_v1 = client.AppsV1Api(api_client)
+    net_v1 = client.NetworkingV1Api(api_client)
+    selector = f"pipeline_id={pipeline_id}"
+    found = []
+    found += [("ConfigMap", o) for o in v1.list_namespaced_config_map(namespace, label_selector=selector).items]
+    found += [("Service", o) for o in v1.list_namespaced_service(namespace, label_selector=selector).items]
+    found += [("Deployment", o) for o in
+              apps_v1.list_namespaced_deployment(namespace, label_selector=selector).items]
+    try:
+        found.append(("Ingress", net_v1.read_namespaced_ingress(f"{pipeline_id}-ingress", namespace)))
+    except ApiException as e:
+        if e.status != 404:
+            raise
+    return {(kind, o.metadata.name): api_client.sanitize_for_serialization(o) for kind, o in found}
+
+
+def _scalar_equal(desired, live):
+    if desired in ("", None, [], {}) and live in ("", None, [], {}):
+        return True
+    return str(desired) == str(live)  # es. quantità GPU 1 vs "1"
+
+
+def field_diff(desired, live, path=""):
+    """
+    Percorsi dei campi di `desired` che differiscono in `live`. Confronto a
+    sottoinsieme: i campi aggiunti dall'API server (default, status,
+    annotazioni di altri manager) non contano.
+    """
+    if isinstance(desired, dict):
+        if not isinstance(live, dict):
+            return [] if not desired and live is None else [path or "."]
+        diffs = []
+        for key, value in desired.items():
+            diffs += field_diff(value, live.get(key), f"{path}.{key}" if path else key)
+        return diffs
+    if isinstance(desired, list):
+        if not isinstance(live, list) or len(live) != len(desired):
+            return [] if not desired and not live else [path]
+        diffs = []
+        for i, (d, l) in enumerate(zip(desired, live)):
+            diffs += field_diff(d, l, f"{path}[{i}]")
+        return diffs
+    return [] if _scalar_equal(desired, live) else [path]
+
+
+def plan(desired, live):
+    """Azioni create/update/delete ordinate per fase, più i nomi degli oggetti invariati."""
+    changes, unchanged = [], []
+    wanted = {}
+    for obj in desired:
+        key = (obj["kind"], obj["metadata"]["name"])
+        wanted[key] = obj
+        current = live.get(key)
+        if current is None:
+            changes.append({"kind": key[0], "name": key[1], "action": "create", "object": obj})
+            continue
+        fields = field_diff({k: obj[k] for k in obj if k not in ("apiVersion", "kind")}, current)
+        if fields:
+            changes.append({"kind": key[0], "name": key[1], "action": "update", "fields": fields, "object": obj})
+        else:
+            unchanged.append(f"{key[0]}/{key[1]}")
+    for key in live:
+        if key not in wanted:
+            changes.append({"kind": key[0], "name": key[1], "action": "delete"})
+    changes.sort(key=lambda c: (DELETE_PHASE if c["action"] == "delete" else PHASES[c["kind"]], c["kind"], c["name"]))
+    return changes, sorted(unchanged)
+
+
+def _apply_one(dyn, change, namespace):
+    start = time.time()
+    resource = dyn.resources.get(api_version=_API_VERSIONS[change["kind"]], kind=change["kind"])
+    if change["action"] == "delete":
+        try:
+            dyn.delete(resource, name=change["name"], namespace=namespace)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+    else:
+        dyn.server_side_apply(resource, body=change["object"], namespace=namespace,
+                              field_manager=FIELD_MANAGER, force_conflicts=True)
+    return time.time() - start
+
+
+def apply_plan(api_client, changes, namespace="default", workers=APPLY_WORKERS):
+    """
+    Applica le azioni fase per fase; dentro una fase in parallelo. Ritorna
+    (risultati per azione, durata per fase). Un errore ferma le fasi successive.
+    """
+    dyn = DynamicClient(api_client)
+    results, phases = [], {}
+    by_phase = {}
+    for change in changes:
+        phase = DELETE_PHASE if change["action"] == "delete" else PHASES[change["kind"]]
+        by_phase.setdefault(phase, []).append(change)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for phase in sorted(by_phase):
+            start = time.time()
+            batch = by_phase[phase]
+            futures = [pool.submit(_apply_one, dyn, c, namespace) for c in batch]
+            failed = False
+            for change, future in zip(batch, futures):
+                entry = {"kind": change["kind"], "name": change["name"], "action": change["action"]}
+                try:
+                    entry["seconds"] = round(future.result(), 3)
+                except Exception as e:
+                    entry["error"] = str(e)
+                    failed = True
+                results.append(entry)
+            phases[str(phase)] = round(time.time() - start, 3)
+            if failed:
+                break
+    return results, phases
+
+
+def describe(changes):
+    """Piano senza i corpi degli oggetti, per le risposte JSON (dry-run)."""
+    return [{k: v for k, v in c.items() if k != "object"} for c in changes]
@@ -0,0 +1,256 @@
+import itertools
+import json
+import os
+import sys
+
+import yaml
+
+# Placement automatico degli step sui nodi: sceglie per ogni step GPU il nodo
+# che minimizza la latenza attesa del cammino critico del DAG degli step.
+#
+# Modello: uno step con costo misurato c (secondi su un nodo di fattore
+# PLACEMENT_REFERENCE_FACTOR, di default nano) su un nodo di fattore f con
+# L pod GPU già presenti e k altri step della stessa pipeline impiega
+#     c * ref / f * (1 + L + k)
+# (GPU condivisa a time-slicing). Il cammino critico è il percorso più lento
+# da uno step di ingresso a uno finale seguendo next_step.
+#
+# Il solver è puro (nessuna chiamata a Kubernetes): l'inventario dei nodi
+# può arrivare dal cluster (cluster_inventory) o da un file JSON:
+#
+#   python3 placement.py pipeline.json inventory.json
+
+GPU_LABEL_KEY = "nvidia.com/device-plugin.config"
+GPU_RESOURCE = "nvidia.com/gpu.shared"
+FALLBACK_GPU_FACTOR = {"nano": 1.0, "xavier": 2.0, "orin": 3.0}
+PLACEMENT_REFERENCE_FACTOR = float(os.getenv("PLACEMENT_REFERENCE_FACTOR", "1"))
+# oltre questo numero di combinazioni si passa da ricerca esaustiva a greedy + ricerca locale
+PLACEMENT_EXACT_LIMIT = int(os.getenv("PLACEMENT_EXACT_LIMIT", "20000"))
+# costo indicativo (s) per tipo di step sul nodo di riferimento, se non misurato
+DEFAULT_STEP_COST_S = {"upscaling": 2.5, "detection": 0.12, "grayscale": 0.015, "deblur": 0.18}
+
+
+def parse_qos_factors(scheduler_config_yaml):
+    """Fattori per classe GPU dal plugin QoSAware della config dello scheduler."""
+    cfg = yaml.safe_load(scheduler_config_yaml) or {}
+    for pc in cfg.get("pluginConfig", []):
+        if pc.get("name") == "QoSAware":
+            return {m["labelValue"]: float(m["factor"]) for m in pc.get("args", {}).get("mappings", [])}
+    raise ValueError("QoSAware config not found")
+
+
+def cluster_inventory(v1, factors=None, ignore_pipeline=None):
+    """
+    Inventario dal cluster: classe GPU dalla label dei nodi, fattori dal
+    QoSAware (fallback FALLBACK_GPU_FACTOR), carico = pod GPU in esecuzione
+    (esclusi quelli di `ignore_pipeline`, che il solver conta già da sé).
+    """
+    if factors is None:
+        try:
+            cm = v1.read_namespaced_config_map(name="scheduler-config", namespace="scheduler-plugins")
+            factors = parse_qos_factors(cm.data["scheduler-config.yaml"])
+        except Exception as e:
+            print(f"[WARN] Uso fallback GPU_FACTOR: {e}")
+            factors = dict(FALLBACK_GPU_FACTOR)
+
+    gpu_pods = {}
+    for pod in v1.list_pod_for_all_namespaces(field_selector="status.phase=Running").items:
+        node = pod.spec.node_name
+        if ignore_pipeline and (pod.metadata.labels or {}).get("pipeline_id") == ignore_pipeline:
+            continue
+        if node and any(GPU_RESOURCE in ((c.resources.requests or {}) if c.resources else {})
+                        for c in pod.spec.containers):
+            gpu_pods[node] = gpu_pods.get(node, 0) + 1
+
+    inventory = []
+    for node in v1.list_node().items:
+        labels = node.metadata.labels or {}
+        gpu_class = labels.get(GPU_LABEL_KEY)
+        if not gpu_class or gpu_class not in factors:
+            continue
+        if node.spec.unschedulable:
+            continue
+        allocatable = (node.status.allocatable or {}).get(GPU_RESOURCE)
+        inventory.append({
+            "name": node.metadata.name,
+            "gpu_class": gpu_class,
+            "factor": factors[gpu_class],
+            "load": gpu_pods.get(node.metadata.name, 0),
+            "capacity": int(allocatable) if allocatable else None,
+        })
+    return inventory
+
+
+def _next_ids(unit):
+    nxt = unit.get("next_step") or []
+    if isinstance(nxt, (int, str)):
+        nxt = [nxt]
+    return [int(n) for n in nxt]
+
+
+def step_cost(unit, costs):
+    """Costo (s) sul nodo di riferimento: per id, poi per tipo, sommato sulla catena di step fusi."""
+    total = 0.0
+    for sub in unit.get("chain") or [unit]:
+        cost = costs.get(str(sub["id"]), costs.get(sub["type"], DEFAULT_STEP_COST_S.get(sub["type"], 0.1)))
+        total += float(cost)
+    return total
+
+
+class _Problem:
+    def __init__(self, units, nodes, costs):
+        self.units = {u["id"]: u for u in units}
+        self.nodes = {n["name"]: n for n in nodes}
+        self.cost = {uid: step_cost(u, costs) for uid, u in self.units.items()}
+        self.gpu = [uid for uid, u in self.units.items() if int(u.get("gpu", 0)) > 0]
+        self.next = {uid: [n for n in _next_ids(u) if n in self.units] for uid, u in self.units.items()}
+        referenced = {n for ids in self.next.values() for n in ids}
+        self.entries = [uid for uid in self.units if uid not in referenced] or list(self.units)[:1]
+
+    def latencies(self, assignment):
+        counts = {}
+        for node in assignment.values():
+            counts[node] = counts.get(node, 0) + 1
+        lat = {}
+        for uid, cost in self.cost.items():
+            node = assignment.get(uid)
+            if node is None:
+                lat[uid] = cost  # step CPU: nessun effetto della classe GPU
+                continue
+            n = self.nodes[node]
+            lat[uid] = cost * PLACEMENT_REFERENCE_FACTOR / n["factor"] * (1 + n.get("load", 0) + counts[node] - 1)
+        return lat
+
+    def critical_path(self, lat):
+        memo = {}
+
+        def longest(uid, seen):
+            if uid in memo:
+                return memo[uid]
+            best = (0.0, [])
+            for n in self.next[uid]:
+                if n not in seen:
+                    best = max(best, longest(n, seen | {n}), key=lambda x: x[0])
+            memo[uid] = (lat[uid] + best[0], [uid] + best[1])
+            return memo[uid]
+
+        return max((longest(e, {e}) for e in self.entries), key=lambda x: x[0])
+
+    def feasible(self, assignment):
+        counts = {}
+        for node in assignment.values():
+            counts[node] = counts.get(node, 0) + 1
+        return all(self.nodes[n].get("capacity") is None
+                   or counts[n] + self.nodes[n].get("load", 0) <= self.nodes[n]["capacity"]
+                   for n in counts)
+
+    def score(self, assignment):
+        lat = self.latencies(assignment)
+        critical, _ = self.critical_path(lat)
+        return critical, sum(lat.values())
+
+
+def solve(units, nodes, costs=None, fixed=None):
+    """
+    Assegnazione step GPU -> nodo. `units` come fuse_steps(flatten_steps(...)),
+    `nodes` come cluster_inventory(), `costs` {id o tipo: secondi}, `fixed`
+    {id: nodo} per gli step da non spostare. Ritorna assegnazione, latenze
+    stimate, cammino critico e metodo usato.
+    """
+    problem = _Problem(units, nodes, costs or {})
+    fixed = {int(k): v for k, v in (fixed or {}).items() if v in problem.nodes}
+    free = [uid for uid in problem.gpu if uid not in fixed]
+    if problem.gpu and not problem.nodes:
+        raise ValueError("nessun nodo GPU nell'inventario")
+    candidates = list(problem.nodes)
+
+    best, best_score = None, None
+    if len(candidates) ** len(free) <= PLACEMENT_EXACT_LIMIT:
+        method = "exact"
+        for combo in itertools.product(candidates, repeat=len(free)):
+            assignment = dict(fixed)
+            assignment.update(zip(free, combo))
+            if not problem.feasible(assignment):
+                continue
+            score = problem.score(assignment)
+            if best_score is None or score < best_score:
+                best, best_score = assignment, score
+    else:
+        method = "local-search"
+        assignment = dict(fixed)
+        # greedy: prima gli step più costosi, ognuno sul nodo che peggiora meno il risultato
+        for uid in sorted(free, key=lambda u: -problem.cost[u]):
+            options = []
+            for node in candidates:
+                trial = dict(assignment)
+                trial[uid] = node
+                if problem.feasible(trial):
+                    options.append((problem.score(trial), node))
+            if not options:
+                raise ValueError(f"nessun nodo con capacità libera per lo step {uid}")
+            assignment[uid] = min(options)[1]
+        best, best_score = assignment, problem.score(assignment)
+        improved = True
+        while improved:
+            improved = False
+            for uid in free:
+                for node in candidates:
+                    trial = dict(best)
+                    trial[uid] = node
+                    if node != best[uid] and problem.feasible(trial):
+                        score = problem.score(trial)
+                        if score < best_score:
+                            best, best_score, improved = trial, score, True
+
+    if best is None:
+        raise ValueError("nessuna assegnazione rispetta la capacità dei nodi")
+    lat = problem.latencies(best)
+    critical, path = problem.critical_path(lat)
+    return {
+        "assignment": {str(k): v for k, v in sorted(best.items())},
+        "latency_s": {str(k): round(v, 4) for k, v in sorted(lat.items())},
+        "critical_path": path,
+        "critical_path_s": round(critical, 4),
+        "method": method,
+    }
+
+
+def apply_placement(units, assignment, emit="selector"):
+    """
+    Scrive il risultato negli step: nodeSelector sull'hostname (selector)
+    oppure nodeAffinity preferita (affinity), che lascia allo scheduler e al
+    priority controller la possibilità di spostare il pod.
+    """
+    for unit in units:
+        node = assignment.get(str(unit["id"]))
+        if node is None:
+            continue
+        if emit == "affinity":
+            unit.pop("nodeSelector", None)
+            unit["affinity"] = {"nodeAffinity": {"preferredDuringSchedulingIgnoredDuringExecution": [{
+                "weight": 100,
+                "preference": {"matchExpressions": [
+                    {"key": "kubernetes.io/hostname", "operator": "In", "values": [node]}
+                ]},
+            }]}}
+        else:
+            unit["nodeSelector"] = {"kubernetes.io/hostname": node}
+    return units
+
+
+def main():
+    from topography import flatten_steps, fuse_steps
+
+    if len(sys.argv) != 3:
+        raise SystemExit("uso: python3 placement.py pipeline.json inventory.json")
+    with open(sys.argv[1]) as f:
+        pipeline = json.load(f)
+    with open(sys.argv[2]) as f:
+        inventory = json.load(f)
+    options = pipeline.get("placement") or {}
+    units = fuse_steps(flatten_steps(pipeline["steps"]))
+    print(json.dumps(solve(units, inventory, options.get("costs")), indent=2))
+
+
+if __name__ == "__main__":
+    main()
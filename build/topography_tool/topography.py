@@ -1,8 +1,14 @@
 from flask import Flask, request, jsonify
 from kubernetes import client, config
+import copy
+import hashlib
+import json
+import time
 import yaml
 import uuid
 from typing import Union, List, Dict
+import pipeline_apply
+import placement
 
 
 
@@ -25,7 +31,11 @@ def flatten_steps(steps: List[Union[Dict, List]]):
                 "preferred_next": step.get("preferred_next"),
                 #"next_step": next_step,
                 "next_step": step.get("next_step",[]),
-                "nodeSelector": step.get("nodeSelector")
+                "nodeSelector": step.get("nodeSelector"),
+                "affinity": step.get("affinity"),
+                "fuse_with_next": bool(step.get("fuse_with_next", False)),
+                "server": step.get("server"),
+                "routing": step.get("routing"),
             }
             flat.append(step_obj)
             #current_id += 1
@@ -45,6 +55,67 @@ def flatten_steps(steps: List[Union[Dict, List]]):
     return flat
 
 
+def _next_ids(step):
+    next_step = step.get("next_step") or []
+    if isinstance(next_step, (str, int)):
+        next_step = [next_step]
+    return [int(n) for n in next_step]
+
+
+def fuse_steps(flat: List[Dict]) -> List[Dict]:
+    """
+    Raggruppa le catene di step marcate con "fuse_with_next": true in un
+    unico step (stesso pod, pipeline in-process). Uno step viene fuso con
+    il successivo solo se ha un solo next_step e quel next_step non ha
+    altri predecessori. Lo step risultante mantiene l'id del primo della
+    catena, il next_step dell'ultimo e in "chain" la lista ordinata dei
+    sotto-step.
+    """
+    by_id = {s["id"]: s for s in flat}
+    predecessors = {}
+    for s in flat:
+        for n in _next_ids(s):
+            predecessors.setdefault(n, []).append(s["id"])
+
+    def fusable(s):
+        nxt = _next_ids(s)
+        return (s.get("fuse_with_next") and len(nxt) == 1 and nxt[0] in by_id
+                and len(predecessors.get(nxt[0], [])) == 1)
+
+    absorbed = set()
+    for s in flat:
+        if fusable(s):
+            absorbed.add(_next_ids(s)[0])
+
+    units = []
+    for s in flat:
+        if s["id"] in absorbed:
+            continue
+        chain = [s]
+        while fusable(chain[-1]):
+            chain.append(by_id[_next_ids(chain[-1])[0]])
+        if len(chain) == 1:
+            units.append(s)
+            continue
+
+        volumes = []
+        for sub in chain:
+            for v in sub.get("volumes", []):
+                if v not in volumes:
+                    volumes.append(v)
+        unit = dict(s)
+        unit.update({
+            "gpu": max(int(sub.get("gpu", 0)) for sub in chain),
+            "volumes": volumes,
+            "preferred_next": chain[-1].get("preferred_next"),
+            "next_step": chain[-1].get("next_step", []),
+            "routing": chain[-1].get("routing"),
+            "chain": chain,
+        })
+        units.append(unit)
+    return units
+
+
 def generate_ingress(pipeline_id, namespace="default"):
     return {
         "apiVersion": "networking.k8s.io/v1",
@@ -82,9 +153,8 @@ def generate_ingress(pipeline_id, namespace="default"):
 
 
 # --- YAML Builders ---
-def generate_configmap(step, pipeline_id, namespace="default"):
-    # Costruisco lo step che deve andare dentro "steps"
-    step_config = {
+def _step_config(step):
+    return {
         "id": step["id"],
         "type": step["type"],
         "params": step.get("params", {}),
@@ -94,12 +164,20 @@ def generate_configmap(step, pipeline_id, namespace="default"):
         "preferred_next": step.get("preferred_next"),
         "next_step": step.get("next_step", []),
     }
+
+
+def generate_configmap(step, pipeline_id, namespace="default"):
+    # Costruisco lo step (o la catena di step fusi) che deve andare dentro "steps"
+    chain = step.get("chain")
     # Struttura della configmap
     config_data = {
         "pipeline_id": pipeline_id,
         "step_id": step["id"],
-        "steps": [step_config],
+        "steps": [_step_config(s) for s in chain] if chain else [_step_config(step)],
     }
+    if chain:
+        # ordine di esecuzione in-process; si inoltra solo dopo l'ultimo
+        config_data["fused_steps"] = [s["id"] for s in chain]
     cm = {
         "apiVersion": "v1",
         "kind": "ConfigMap",
@@ -113,6 +191,18 @@ def generate_configmap(step, pipeline_id, namespace="default"):
         },
     }
 
+    # modalità di serving del pod (diventano variabili d'ambiente via envFrom)
+    server = step.get("server") or {}
+    for key, env in (("mode", "SERVER_MODE"),
+                     ("executor_workers", "SERVER_EXECUTOR_WORKERS"),
+                     ("connection_limit", "SERVER_CONNECTION_LIMIT"),
+                     ("workers", "PREFORK_WORKERS")):
+        if server.get(key) is not None:
+            cm["data"][env] = str(server[key])
+    # strategia di scelta tra più next_step (runtime/routing.py)
+    if step.get("routing"):
+        cm["data"]["ROUTING_STRATEGY"] = str(step["routing"])
+
     return cm
     """return client.V1ConfigMap(
         api_version="v1",
@@ -242,6 +332,8 @@ def generate_deployments(steps: List[Dict], pipeline_prefix: str, namespace="def
 
         if node_selector:
             deployment_spec["template"]["spec"]["nodeSelector"] = node_selector
+        if step.get("affinity"):
+            deployment_spec["template"]["spec"]["affinity"] = step["affinity"]
 
         # if str(step_id)==0:
         #     deployment_spec["template"]["metadata"] = {
@@ -316,6 +408,107 @@ def generate_services(steps: List[Dict], pipeline_prefix: str, namespace="defaul
 
 
 
+CONFIG_HASH_ANNOTATION = "topography/config-hash"
+
+
+def _config_hash(step, pipeline_id):
+    # senza priority: quella la cambia a runtime il priority controller e non
+    # deve far ripartire i pod a un PUT
+    chain = [dict(s, priority="") for s in (step.get("chain") or [])]
+    data = generate_configmap(dict(step, priority="", chain=chain or None), pipeline_id)["data"]
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _live_priorities(live, pipeline_id):
+    """Priority correnti (decise dal priority controller) per id di step e per Deployment."""
+    steps, deployments = {}, {}
+    for (kind, name), obj in live.items():
+        if kind == "ConfigMap":
+            cfg = yaml.safe_load((obj.get("data") or {}).get("PIPELINE_CONFIG", "{}")) or {}
+            for s in cfg.get("steps", []):
+                if s.get("priority"):
+                    steps[s["id"]] = s["priority"]
+        elif kind == "Deployment":
+            pc = obj["spec"]["template"]["spec"].get("priorityClassName")
+            if pc:
+                deployments[name] = pc
+    return steps, deployments
+
+
+def _live_nodes(live, pipeline_id):
+    """Nodo su cui il placement aveva messo ogni step già esistente (hostname di selector o affinity)."""
+    nodes = {}
+    prefix = f"{pipeline_id}-step-"
+    for (kind, name), obj in live.items():
+        if kind != "Deployment" or not name.startswith(prefix):
+            continue
+        spec = obj["spec"]["template"]["spec"]
+        host = (spec.get("nodeSelector") or {}).get("kubernetes.io/hostname")
+        preferred = ((spec.get("affinity") or {}).get("nodeAffinity") or {}).get(
+            "preferredDuringSchedulingIgnoredDuringExecution") or []
+        for term in preferred:
+            for expr in term["preference"].get("matchExpressions") or []:
+                if expr["key"] == "kubernetes.io/hostname" and expr.get("values"):
+                    host = expr["values"][0]
+        if host:
+            nodes[name[len(prefix):]] = host
+    return nodes
+
+
+def place_steps(pipeline, steps, pipeline_id, live=None):
+    """
+    Placement automatico ("placement": {"mode": "auto"} nel JSON): sceglie il
+    nodo di ogni step GPU e lo scrive negli step come nodeSelector o affinity.
+    L'inventario è quello del JSON ("inventory") o letto dal cluster. Con
+    `live` gli step già deployati restano dove sono, salvo "rebalance": true.
+    """
+    options = pipeline.get("placement") or {}
+    if options.get("mode") != "auto":
+        return None
+    inventory = options.get("inventory")
+    if inventory is None:
+        inventory = placement.cluster_inventory(client.CoreV1Api(), ignore_pipeline=pipeline_id)
+    fixed = {} if options.get("rebalance") else _live_nodes(live or {}, pipeline_id)
+    result = placement.solve(steps, inventory, options.get("costs"), fixed)
+    placement.apply_placement(steps, result["assignment"], options.get("emit", "selector"))
+    print(f"[INFO] Placement {pipeline_id} ({result['method']}): {result['assignment']} "
+          f"cammino critico {result['critical_path_s']}s")
+    return result
+
+
+def pipeline_objects(pipeline, pipeline_id, namespace="default", live=None):
+    """
+    Oggetti desiderati della pipeline (ConfigMap, Deployment, Service, Ingress)
+    e risultato del placement automatico (None se non richiesto).
+    Con `live` (stato nel cluster) gli step esistenti mantengono la priority
+    corrente invece di quella del JSON.
+    """
+    steps = fuse_steps(flatten_steps(copy.deepcopy(pipeline["steps"])))
+    placed = place_steps(pipeline, steps, pipeline_id, live)
+    step_priority, deployment_priority = _live_priorities(live or {}, pipeline_id)
+    for step in steps:
+        for s in step.get("chain") or [step]:
+            if s["id"] in step_priority:
+                s["priority"] = step_priority[s["id"]]
+        if step["id"] in step_priority:
+            step["priority"] = step_priority[step["id"]]
+
+    objects = [generate_configmap(step, pipeline_id, namespace) for step in steps]
+    deployments = generate_deployments(steps, pipeline_id, namespace)
+    for step, dep in zip(steps, deployments):
+        # PIPELINE_CONFIG arriva ai pod come env: se cambia, rollout del solo step
+        template = dep["spec"]["template"]
+        template["metadata"]["annotations"][CONFIG_HASH_ANNOTATION] = _config_hash(step, pipeline_id)
+        if dep["metadata"]["name"] in deployment_priority:
+            template["spec"]["priorityClassName"] = deployment_priority[dep["metadata"]["name"]]
+    objects += deployments
+    objects += generate_services(steps, pipeline_id, namespace)
+    objects.append(generate_ingress(pipeline_id, namespace))
+    for obj in objects:
+        obj["metadata"].setdefault("labels", {})["pipeline_id"] = pipeline_id
+    return objects, placed
+
+
 # --- Endpoints ---
 @app.route("/pipeline", methods=["POST"])
 def create_pipeline():
@@ -325,47 +518,97 @@ def create_pipeline():
             return jsonify({"error": "Invalid JSON, must contain steps"}), 400
 
         config.load_incluster_config()
-        v1 = client.CoreV1Api()
-        apps_v1 = client.AppsV1Api()
+        api_client = client.ApiClient()
 
         pipeline_id = f"pipeline-{uuid.uuid4().hex[:6]}"
-        steps = flatten_steps(pipeline["steps"])
-        results = []
-        
-        # --- Creazione ConfigMap ---
-        for step in steps:
-            cm = generate_configmap(step, pipeline_id)   # <-- passi solo step e pipeline_id
-            v1.create_namespaced_config_map(namespace="default", body=cm)
-            results.append(f"✅ ConfigMap creata per step {step['id']}")
-
-
-        # --- Creazione Deployment ---
-        deployments = generate_deployments(steps, pipeline_id)
-        for dep in deployments:
-            apps_v1.create_namespaced_deployment(namespace="default", body=dep)
-            results.append(f"✅ Deployment creato per {dep['metadata']['name']}")
-
-
-        # --- Creazione Service ---
-        services = generate_services(steps, pipeline_id)
-        for svc in services:
-            v1.create_namespaced_service(namespace="default", body=svc)
-            results.append(f"✅ Service creato per {svc['metadata']['name']}")
-            
-        # ----Creazione Ingress ---    
-        net_v1 = client.NetworkingV1Api()
+        # creazione in parallelo (server-side apply), ConfigMap e Service prima dei Deployment
+        objects, placed = pipeline_objects(pipeline, pipeline_id)
+        changes, _ = pipeline_apply.plan(objects, {})
+        start = time.time()
+        applied, phases = pipeline_apply.apply_plan(api_client, changes)
+        errors = [a for a in applied if "error" in a]
+        results = [f"{'❌' if 'error' in a else '✅'} {a['kind']} {a['name']}" for a in applied]
+        body = {"status": "error" if errors else "ok", "pipeline_id": pipeline_id, "results": results,
+                "timing": {"apply_s": round(time.time() - start, 3), "phases": phases}}
+        if placed:
+            body["placement"] = placed
+        if errors:
+            body["errors"] = errors
+            return jsonify(body), 500
+        return jsonify(body)
 
-        ing = generate_ingress(pipeline_id)
-        net_v1.create_namespaced_ingress(namespace="default", body=ing)
-        results.append("✅ Ingress creato")
-        
-        return jsonify({"status": "ok", "pipeline_id": pipeline_id, "results": results})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/pipeline/<pipeline_id>", methods=["PUT"])
+def update_pipeline(pipeline_id):
+    """
+    Aggiorna una pipeline esistente applicando solo le differenze: gli step
+    invariati non vengono toccati (pod e modelli restano caldi). Con
+    ?dry_run=true restituisce solo il piano.
+    """
+    try:
+        pipeline = request.get_json()
+        if not pipeline or "steps" not in pipeline:
+            return jsonify({"error": "Invalid JSON, must contain steps"}), 400
+        dry_run = request.args.get("dry_run", "false").lower() == "true"
+
+        config.load_incluster_config()
+        api_client = client.ApiClient()
+
+        start = time.time()
+        live = pipeline_apply.live_state(api_client, pipeline_id)
+        if not live:
+            return jsonify({"error": f"pipeline {pipeline_id} non trovata"}), 404
+        objects, placed = pipeline_objects(pipeline, pipeline_id, live=live)
+        changes, unchanged = pipeline_apply.plan(objects, live)
+        timing = {"diff_s": round(time.time() - start, 3)}
+        body = {"pipeline_id": pipeline_id, "changes": pipeline_apply.describe(changes), "unchanged": unchanged}
+        if placed:
+            body["placement"] = placed
+
+        if dry_run or not changes:
+            body["status"] = "dry_run" if dry_run else "unchanged"
+            body["timing"] = timing
+            return jsonify(body)
+
+        start = time.time()
+        applied, phases = pipeline_apply.apply_plan(api_client, changes)
+        timing.update({"apply_s": round(time.time() - start, 3), "phases": phases})
+        errors = [a for a in applied if "error" in a]
+        body.update({"status": "error" if errors else "ok", "applied": applied, "timing": timing})
+        return jsonify(body), (500 if errors else 200)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 
+@app.route("/placement", methods=["POST"])
+def preview_placement():
+    """
+    Calcola il placement di una pipeline senza deployarla. Senza
+    "placement.inventory" nel JSON l'inventario è letto dal cluster.
+    """
+    try:
+        pipeline = request.get_json()
+        if not pipeline or "steps" not in pipeline:
+            return jsonify({"error": "Invalid JSON, must contain steps"}), 400
+        options = dict(pipeline.get("placement") or {}, mode="auto")
+        if options.get("inventory") is None:
+            config.load_incluster_config()
+        steps = fuse_steps(flatten_steps(copy.deepcopy(pipeline["steps"])))
+        result = place_steps(dict(pipeline, placement=options), steps, "preview")
+        result["steps"] = {str(s["id"]): {k: s[k] for k in ("nodeSelector", "affinity") if s.get(k)}
+                           for s in steps if str(s["id"]) in result["assignment"]}
+        return jsonify(result)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 422
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route("/pipeline/<pipeline_id>", methods=["DELETE"])
 def delete_pipeline(pipeline_id):
     try:
@@ -0,0 +1,143 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "build", "priority_controller"))
+import policy  # noqa: E402
+
+# Backtest delle policy di priority del controller su export di Locust:
+# riproduce il carico registrato e simula, per ogni policy, quando avrebbe
+# cambiato PriorityClass e quando il cambio avrebbe avuto effetto (dopo
+# --migration-cost secondi). Confronta la classe effettiva con quella che
+# il carico reale avrebbe richiesto.
+#
+#   python3 backtest_priority.py --prom prom_timeseries.csv
+#   python3 backtest_priority.py --raw raw_timings.csv --interval 30
+#
+# Da prom_timeseries.csv (rps e p95 per step) l'in-flight è stimato con
+# Little: rps * p95. Da raw_timings.csv (solo ingresso, step 0) si usa la
+# colonna http_requests_in_progress, o arrivi * latenza media se assente.
+
+DEFAULT_THRESHOLDS = "low-qos:0:20,medium-qos:21:60,high-qos:61:100000"
+
+
+def parse_thresholds(spec):
+    thresholds = []
+    for item in spec.split(","):
+        name, low, high = item.split(":")
+        thresholds.append({"name": name, "min": float(low), "max": float(high)})
+    return sorted(thresholds, key=lambda x: x["min"])
+
+
+def load_prom(path):
+    """{step_id: [(t, in_flight, rate)]} da prom_timeseries.csv."""
+    series = defaultdict(list)
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            rps, p95 = float(row["rps"] or 0), float(row["p95_s"] or 0)
+            series[("prom", row["step_id"])].append((float(row["timestamp"]), rps * p95, rps))
+    return {k: sorted(v) for k, v in series.items()}
+
+
+def load_raw(path, interval):
+    """Richieste di raw_timings.csv raggruppate in finestre di `interval` secondi."""
+    buckets = defaultdict(lambda: {"n": 0, "latency": 0.0, "inflight": 0.0})
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            t = time.mktime(time.strptime(row["timestamp"], "%Y-%m-%d %H:%M:%S"))
+            b = buckets[int(t // interval) * interval]
+            b["n"] += 1
+            b["latency"] += float(row["response_time_ms"] or 0) / 1000.0
+            b["inflight"] = max(b["inflight"], float(row.get("http_requests_in_progress") or 0))
+    samples = []
+    for t, b in sorted(buckets.items()):
+        rate = b["n"] / interval
+        inflight = b["inflight"] or rate * (b["latency"] / b["n"])
+        samples.append((float(t), inflight, rate))
+    return {("raw", "0"): samples}
+
+
+def simulate(samples, pol, thresholds, migration_cost, cooldown, low_class):
+    """Classe effettiva nel tempo: un cambio deciso a t ha effetto a t + migration_cost."""
+    rank = {t["name"]: i for i, t in enumerate(thresholds)}
+    effective = low_class
+    pending = None  # (ready_at, classe)
+    last_change = None
+    stats = defaultdict(float)
+    key = "backtest"
+
+    for i, (t, inflight, rate) in enumerate(samples):
+        if pending and t >= pending[0]:
+            effective, pending = pending[1], None
+        target = pending[1] if pending else effective
+        if last_change is not None and t - last_change < cooldown:
+            # come il controller: in cooldown la policy osserva ma non decide
+            pol.observe(key, t, inflight, rate)
+        else:
+            decision = pol.decide(key, t, inflight, rate)
+            if decision.priority and decision.priority != target:
+                pending = (t + migration_cost, decision.priority)
+                last_change = t
+                stats["migrations"] += 1
+
+        dt = samples[i + 1][0] - t if i + 1 < len(samples) else 0
+        needed = policy.choose_class(thresholds, inflight, low_class)
+        cap = thresholds[rank[effective]]["max"]
+        stats["seconds"] += dt
+        stats["under_s"] += dt if rank[effective] < rank[needed] else 0
+        stats["over_s"] += dt if rank[effective] > rank[needed] else 0
+        stats["excess_inflight_s"] += max(0.0, inflight - cap) * dt
+        stats["class_s"] += rank[effective] * dt
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prom", help="prom_timeseries.csv di un run Locust")
+    parser.add_argument("--raw", help="raw_timings.csv di un run Locust")
+    parser.add_argument("--interval", type=float, default=30, help="finestra (s) per raw_timings, come CHECK_INTERVAL")
+    parser.add_argument("--thresholds", default=DEFAULT_THRESHOLDS, help="nome:min:max,... come le PriorityClass")
+    parser.add_argument("--migration-cost", type=float, default=policy.MIGRATION_COST_S)
+    parser.add_argument("--cooldown", type=float, default=60, help="PRIORITY_COOLDOWN del controller")
+    parser.add_argument("--policies", default=",".join(policy.POLICIES))
+    parser.add_argument("--output", help="JSON con i risultati per policy e step")
+    args = parser.parse_args()
+
+    series = {}
+    if args.prom:
+        series.update(load_prom(args.prom))
+    if args.raw:
+        series.update(load_raw(args.raw, args.interval))
+    if not series:
+        parser.error("serve almeno uno tra --prom e --raw")
+
+    thresholds = parse_thresholds(args.thresholds)
+    low_class = thresholds[0]["name"]
+    results = {}
+    print(f"{'policy':<10} {'serie':<10} {'migr':>5} {'sotto %':>8} {'sopra %':>8} "
+          f"{'eccesso':>10} {'classe media':>13}")
+    for name in args.policies.split(","):
+        for (source, step_id), samples in sorted(series.items()):
+            kwargs = {"horizon": args.migration_cost} if name == policy.ForecastPolicy.name else {}
+            pol = policy.make_policy(name, lambda: thresholds, low_class, **kwargs)
+            stats = simulate(samples, pol, thresholds, args.migration_cost, args.cooldown, low_class)
+            total = stats["seconds"] or 1.0
+            results.setdefault(name, {})[f"{source}:{step_id}"] = dict(stats)
+            print(f"{name:<10} {source + ':' + step_id:<10} {int(stats['migrations']):>5} "
+                  f"{stats['under_s'] / total * 100:>7.1f}% {stats['over_s'] / total * 100:>7.1f}% "
+                  f"{stats['excess_inflight_s']:>10.0f} {stats['class_s'] / total:>13.2f}")
+
+    # sotto %: tempo con classe inferiore a quella richiesta dal carico reale
+    # eccesso: somma di (in-flight oltre il massimo della classe) * secondi
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"[INFO] Risultati salvati in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
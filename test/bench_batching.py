@@ -0,0 +1,72 @@
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "build"))
+from runtime.batching import MicroBatcher  # noqa: E402
+
+# Benchmark locale del micro-batching del classifier_light con un modello
+# stub su CPU: costo fisso per chiamata + costo per frame.
+#
+#   python3 bench_batching.py --clients 8 --requests 40 --max-batch 4 --max-wait-ms 5
+
+
+def make_stub(fixed_ms, per_item_ms):
+    def infer_batch(size, frames):
+        batch = np.stack(frames)
+        time.sleep((fixed_ms + per_item_ms * len(frames)) / 1000.0)
+        return [(b.mean(), size) for b in batch]
+    return infer_batch
+
+
+def run(max_batch, args):
+    sizes = [320, 640] if args.mixed else [320]
+    batcher = MicroBatcher(make_stub(args.fixed_ms, args.per_item_ms),
+                           max_batch=max_batch, max_wait_ms=args.max_wait_ms, name=f"bench-{max_batch}")
+    frames = {s: np.zeros((s, s, 3), dtype=np.uint8) for s in sizes}
+    latencies = []
+    lock = threading.Lock()
+
+    def client(idx):
+        for i in range(args.requests):
+            size = sizes[(idx + i) % len(sizes)]
+            t0 = time.perf_counter()
+            batcher.submit(size, frames[size])
+            with lock:
+                latencies.append(time.perf_counter() - t0)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    lat = np.array(latencies) * 1000
+    return len(latencies) / elapsed, np.percentile(lat, 50), np.percentile(lat, 99)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=25, help="richieste per client")
+    parser.add_argument("--max-batch", type=int, default=4)
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    parser.add_argument("--fixed-ms", type=float, default=20, help="costo fisso per inferenza")
+    parser.add_argument("--per-item-ms", type=float, default=4, help="costo per frame nel batch")
+    parser.add_argument("--mixed", action="store_true", help="alterna profili 320 e 640")
+    args = parser.parse_args()
+
+    print(f"{'max_batch':>9} {'fps':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for mb in sorted({1, args.max_batch}):
+        fps, p50, p99 = run(mb, args)
+        print(f"{mb:>9} {fps:>8.1f} {p50:>8.1f} {p99:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import argparse
+import io
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import uuid
+
+import numpy as np
+from PIL import Image, ImageFilter, ImageOps
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, "..", "build"))
+from runtime import frame as frames, wire  # noqa: E402
+
+# Memoria allocata per richiesta dal percorso decode -> step -> encode, prima
+# (PIL Image tra gli step, come fino a runtime/frame.py) e dopo (Frame):
+#
+#   python3 bench_frames.py --requests 50
+#   python3 bench_frames.py --steps detection --profile heavy --downscale
+#
+# Misure per richiesta:
+#   alloc_MB  memoria nuova toccata (page fault minori * pagina): con
+#             MALLOC_MMAP_THRESHOLD_ basso ogni buffer grande (numpy, PIL,
+#             OpenCV) è un mmap nuovo, quindi è il volume totale allocato
+#   pil_img   immagini PIL create (ognuna è un buffer di frame intero)
+#   ms        tempo medio
+#
+# Il detector usa il vero steps/classifier_light.py con un modello stub
+# (box fissi) se tensorflow non è installato; l'upscaler test/fake_realsr.py.
+
+MMAP_THRESHOLD = "65536"
+PAGE = resource.getpagesize()
+
+
+def _ensure_mmap_env():
+    if os.environ.get("MALLOC_MMAP_THRESHOLD_") != MMAP_THRESHOLD:
+        env = dict(os.environ, MALLOC_MMAP_THRESHOLD_=MMAP_THRESHOLD)
+        os.execve(sys.executable, [sys.executable] + sys.argv, env)
+
+
+def _stub_tensorflow():
+    """Solo per importare classifier_light senza tensorflow: il modello non viene mai caricato."""
+    if "tensorflow" in sys.modules:
+        return
+    try:
+        import tensorflow  # noqa: F401
+        return
+    except ImportError:
+        pass
+    tf = types.ModuleType("tensorflow")
+    tf.compat = types.SimpleNamespace(v1=types.SimpleNamespace(enable_eager_execution=lambda: None))
+    tf.config = types.SimpleNamespace(experimental=types.SimpleNamespace(
+        list_physical_devices=lambda kind: [], set_memory_growth=lambda *a: None))
+    tf.function = lambda fn: fn
+    hub = types.ModuleType("tensorflow_hub")
+
+    def load(url):
+        raise RuntimeError("modello stub")
+    hub.load = load
+    sys.modules["tensorflow"] = tf
+    sys.modules["tensorflow_hub"] = hub
+
+
+def make_detector(downscale):
+    _stub_tensorflow()
+    from runtime.batching import MicroBatcher
+    from steps import classifier_light
+
+    def infer(size, batch):
+        box = (np.array([[0.1, 0.1, 0.6, 0.5], [0.4, 0.5, 0.9, 0.9]]),
+               np.array([0.9, 0.8]), np.array([1, 3]))
+        return [box for _ in batch]
+
+    classifier_light.batcher = MicroBatcher(infer, max_batch=1, max_wait_ms=0, name="bench_frames")
+    classifier_light._model_ready = True
+    classifier_light._global_infer_fn = infer
+    return classifier_light.Classifier(downscale_input=downscale)
+
+
+# --- prima: PIL Image tra gli step (implementazioni precedenti a runtime/frame.py) ---
+
+def legacy_decode(data):
+    return Image.open(io.BytesIO(data)).convert("RGB")
+
+
+def legacy_detection(image, load_profile, boxes):
+    import cv2
+    np_img = np.array(image, dtype=np.uint8)
+    h, w = np_img.shape[:2]
+    size = {"light": 320, "heavy": 640}.get(load_profile, 320)
+    cv2.resize(np_img, (size, size))
+    np_draw = cv2.cvtColor(np_img, cv2.COLOR_RGB2BGR)
+    for y1, x1, y2, x2 in boxes:
+        cv2.rectangle(np_draw, (int(x1 * w), int(y1 * h)), (int(x2 * w), int(y2 * h)), (0, 255, 0), 2)
+    return Image.fromarray(cv2.cvtColor(np_draw, cv2.COLOR_BGR2RGB))
+
+
+def legacy_upscale(image, binary, staging):
+    import cv2
+    uid = uuid.uuid4().hex
+    src, dst = os.path.join(staging, f"in_{uid}.jpg"), os.path.join(staging, f"out_{uid}.jpg")
+    image.save(src, format="JPEG")
+    subprocess.run([binary, "-i", src, "-o", dst, "-s", "2", "-f", "jpg"], check=True)
+    try:
+        return Image.fromarray(cv2.cvtColor(cv2.imread(dst), cv2.COLOR_BGR2RGB))
+    finally:
+        os.remove(src)
+        os.remove(dst)
+
+
+def legacy_encode_raw(image):
+    arr = np.ascontiguousarray(np.asarray(image))
+    header = bytes(20)
+    return header + bytes(arr.data)
+
+
+def run_legacy(step, data, args, staging):
+    image = legacy_decode(data)
+    if step == "grayscale":
+        image = ImageOps.grayscale(image).convert("RGB")
+    elif step == "deblur":
+        image = image.filter(ImageFilter.SHARPEN)
+    elif step == "detection":
+        image = legacy_detection(image, args.profile, [(0.1, 0.1, 0.6, 0.5), (0.4, 0.5, 0.9, 0.9)])
+    elif step == "upscaling":
+        image = legacy_upscale(image, args.upscaler, staging)
+    if args.output == "raw":
+        return legacy_encode_raw(image)
+    out = io.BytesIO()
+    image.save(out, format="JPEG")
+    return out.getvalue()
+
+
+# --- dopo: Frame ---
+
+def make_step(step, args, staging):
+    if step == "grayscale":
+        from steps.grayscale import Grayscale
+        return Grayscale()
+    if step == "deblur":
+        from steps.deblur import Deblur
+        return Deblur()
+    if step == "detection":
+        return make_detector(args.downscale)
+    from steps.upscaler import Upscaler
+    return Upscaler(model_path="", scale_factor=2, binary=args.upscaler, staging_dir=staging, batch_size=1)
+
+
+def run_frame(step_obj, data, args):
+    declare = getattr(step_obj, "input_min_side", None)
+    frame = frames.decode_image(data, declare(args.profile) if declare else None)
+    frame = frames.as_frame(step_obj.run(frame, load_profile=args.profile))
+    if args.output == "raw":
+        return wire.encode_frame(frame.channels())
+    return frame.encode_jpeg()
+
+
+def measure(fn, requests):
+    fn()  # riscaldamento (import, cache di OpenCV)
+    Image.core.reset_stats()
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    start = time.perf_counter()
+    for _ in range(requests):
+        fn()
+    elapsed = time.perf_counter() - start
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - faults
+    return {
+        "alloc_MB": faults * PAGE / requests / 1e6,
+        "pil_img": Image.core.get_stats()["new_count"] / requests,
+        "ms": elapsed / requests * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", default=os.path.join(TEST_DIR, "your_image.jpg"))
+    parser.add_argument("--steps", default="grayscale,deblur,detection,upscaling")
+    parser.add_argument("--requests", type=int, default=30)
+    parser.add_argument("--profile", default="light", choices=("light", "heavy"))
+    parser.add_argument("--output", default="raw", choices=("raw", "jpeg"),
+                        help="raw = inoltro a uno step intermedio, jpeg = ultimo step")
+    parser.add_argument("--downscale", action="store_true",
+                        help="detector con downscale_input (decode JPEG ridotto)")
+    parser.add_argument("--upscaler", default=os.path.join(TEST_DIR, "fake_realsr.py"))
+    args = parser.parse_args()
+    _ensure_mmap_env()
+
+    with open(args.image, "rb") as f:
+        data = f.read()
+    w, h = Image.open(io.BytesIO(data)).size
+    print(f"[INFO] {args.image}: {w}x{h}, frame RGB {w * h * 3 / 1e6:.2f} MB, uscita {args.output}")
+    staging = tempfile.mkdtemp(prefix="bench_frames_")
+    try:
+        print(f"{'step':<10} {'':<7} {'alloc_MB':>9} {'pil_img':>8} {'ms':>8}")
+        for step in args.steps.split(","):
+            step_obj = make_step(step, args, staging)
+            before = measure(lambda: run_legacy(step, data, args, staging), args.requests)
+            after = measure(lambda: run_frame(step_obj, data, args), args.requests)
+            for name, m in (("prima", before), ("dopo", after)):
+                print(f"{step:<10} {name:<7} {m['alloc_MB']:>9.2f} {m['pil_img']:>8.1f} {m['ms']:>8.2f}")
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
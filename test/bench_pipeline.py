@@ -0,0 +1,433 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import requests
+import yaml
+from prometheus_client.parser import text_string_to_metric_families
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+BUILD_DIR = os.path.join(TEST_DIR, "..", "build")
+sys.path.insert(0, os.path.join(BUILD_DIR, "topography_tool"))
+from topography import flatten_steps, fuse_steps, generate_configmap  # noqa: E402
+
+# Benchmark offline della pipeline, senza cluster né Prometheus:
+#   - un processo build/app.py per step (test/bench_step.py: API Kubernetes
+#     finta e stub CPU per upscaling/detection con latenza configurabile)
+#   - uno step "sink" locale dopo gli ultimi step misura la latenza end-to-end
+#     (X-Request-Start impostato dal client e propagato dagli step)
+#   - a fine run legge /metrics di ogni step e calcola throughput e
+#     percentili per fase (queue, decode, compute, encode, forward)
+#   - scrive un JSON con i risultati; con --baseline confronta con un run
+#     precedente ed esce con codice 1 se c'è una regressione
+#
+#   python3 bench_pipeline.py --pipeline pipeline.json --concurrency 8 --duration 30 --output result.json
+#   python3 bench_pipeline.py --pipeline pipeline.json --baseline result.json --tolerance 0.1
+
+SINK_ID = 99
+PHASES = ("queue_cpu", "queue_accel", "decode", "compute", "encode", "forward")
+
+
+def step_url(prefix, step_id, path=""):
+    return f"http://127.0.0.1:{prefix}{int(step_id):02d}{path}"
+
+
+def load_units(path, pipeline_id):
+    """Step della pipeline come li genera il topography tool (stesso flatten e fusione)."""
+    with open(path) as f:
+        definition = json.load(f)
+    units = fuse_steps(flatten_steps(definition["steps"]))
+    if any(int(u["id"]) >= SINK_ID for u in units):
+        raise ValueError(f"gli id degli step devono essere < {SINK_ID}")
+
+    # gli ultimi step inoltrano al sink invece di rispondere al chiamante
+    for unit in units:
+        boundary = unit["chain"][-1] if unit.get("chain") else unit
+        if not boundary.get("next_step"):
+            boundary["next_step"] = [SINK_ID]
+            unit["next_step"] = [SINK_ID]
+
+    configmaps = {u["id"]: generate_configmap(u, pipeline_id)["data"]["PIPELINE_CONFIG"] for u in units}
+    sink_cm = yaml.dump({"pipeline_id": pipeline_id, "step_id": SINK_ID, "steps": [{"id": SINK_ID}]})
+    return units, configmaps, sink_cm
+
+
+class Sink:
+    """Ultimo hop della pipeline: registra la latenza end-to-end di ogni frame."""
+
+    def __init__(self, port):
+        self.latencies = []
+        self.count = 0
+        self.recording = False
+        self.lock = threading.Lock()
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body=b"ok", headers=None):
+                self.send_response(status)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == "/readyz":
+                    self._reply(200, headers={"X-Frame-Formats": "jpeg"})
+                else:
+                    self._reply(404)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                now = time.time()
+                start = self.headers.get("X-Request-Start")
+                with sink.lock:
+                    sink.count += 1
+                    if sink.recording and start:
+                        sink.latencies.append(now - float(start))
+                self._reply(200, b"{}", {"Content-Type": "application/json"})
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def start_steps(units, configmaps, sink_cm, args):
+    os.makedirs(args.log_dir, exist_ok=True)
+    all_cms = json.dumps(list(configmaps.values()) + [sink_cm])
+    procs = {}
+    for unit in units:
+        env = dict(os.environ)
+        env.update({
+            "PIPELINE_CONFIG": configmaps[unit["id"]],
+            "SERVICE_PORT": f"{args.port_prefix}{int(unit['id']):02d}",
+            "NEXT_STEP_URL_TEMPLATE": f"http://127.0.0.1:{args.port_prefix}{{step_id:02d}}",
+            "BENCH_CONFIGMAPS": all_cms,
+            "BENCH_STUBS": "false" if args.real_steps else "true",
+            "POD_NAME": f"bench-step-{unit['id']}",
+            "SERVER_MODE": args.server_mode,
+            "BENCH_UPSCALER_MS": str(args.upscaler_ms),
+            "BENCH_DETECTION_MS": str(args.detection_ms),
+            "READINESS_PROBE_INTERVAL": "0.5",
+        })
+        for item in args.env:
+            key, _, value = item.partition("=")
+            env[key] = value
+        log = open(os.path.join(args.log_dir, f"step-{unit['id']}.log"), "w")
+        procs[unit["id"]] = subprocess.Popen(
+            [sys.executable, os.path.join(TEST_DIR, "bench_step.py")],
+            env=env, stdout=log, stderr=subprocess.STDOUT,
+        )
+    return procs
+
+
+def wait_ready(units, args, timeout=120):
+    deadline = time.time() + timeout
+    for unit in units:
+        url = step_url(args.port_prefix, unit["id"], "/readyz")
+        while True:
+            try:
+                if requests.get(url, timeout=1).status_code == 200:
+                    break
+            except requests.RequestException:
+                pass
+            if time.time() > deadline:
+                raise RuntimeError(f"step {unit['id']} non pronto (log in {args.log_dir})")
+            time.sleep(0.3)
+
+
+def send_frame(session, url, frame, args):
+    headers = {
+        "X-Test-ID": args.test_id,
+        "X-Load-Profile": args.load_profile,
+        "X-Request-Start": repr(time.time()),
+    }
+    return session.post(url, files={"image": ("frame.jpg", frame, "image/jpeg")}, headers=headers, timeout=600)
+
+
+def warmup(entry_url, frame, sink, args, timeout=120):
+    """Attende che la readiness dei prossimi step sia propagata e che i frame arrivino al sink."""
+    session = requests.Session()
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if send_frame(session, entry_url, frame, args).status_code == 202:
+                break
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    for _ in range(args.warmup):
+        send_frame(session, entry_url, frame, args)
+    while sink.count < 1 + args.warmup and time.time() < deadline:
+        time.sleep(0.2)
+
+
+def run_load(entry_url, frame, args):
+    acks = []
+    statuses = Counter()
+    lock = threading.Lock()
+    stop = time.time() + args.duration
+
+    def client():
+        session = requests.Session()
+        while time.time() < stop:
+            t0 = time.perf_counter()
+            try:
+                status = send_frame(session, entry_url, frame, args).status_code
+            except requests.RequestException:
+                status = "error"
+            with lock:
+                statuses[status] += 1
+                if status == 202:
+                    acks.append(time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return acks, statuses
+
+
+def wait_drained(sink, timeout=120, quiet=2.0):
+    deadline = time.time() + timeout
+    last, last_change = sink.count, time.time()
+    while time.time() < deadline:
+        time.sleep(0.2)
+        if sink.count != last:
+            last, last_change = sink.count, time.time()
+        elif time.time() - last_change > quiet:
+            return
+
+
+# --- metriche ---
+def scrape(units, args):
+    out = {}
+    for unit in units:
+        text = requests.get(step_url(args.port_prefix, unit["id"], "/metrics"), timeout=5).text
+        out[unit["id"]] = list(text_string_to_metric_families(text))
+    return out
+
+
+def histogram_buckets(families, name, **match):
+    """Bucket cumulativi {le: count} sommati sulle serie che corrispondono a `match`."""
+    buckets = Counter()
+    for family in families:
+        if family.name != name:
+            continue
+        for sample in family.samples:
+            if not sample.name.endswith("_bucket"):
+                continue
+            if any(sample.labels.get(k) != v for k, v in match.items()):
+                continue
+            buckets[float(sample.labels["le"])] += sample.value
+    return buckets
+
+
+def histogram_count(families, name, **match):
+    buckets = histogram_buckets(families, name, **match)
+    return buckets.get(float("inf"), 0)
+
+
+def histogram_quantile(buckets, q):
+    """Come histogram_quantile di Prometheus: interpolazione lineare nel bucket."""
+    items = sorted(buckets.items())
+    total = items[-1][1] if items else 0
+    if total <= 0:
+        return None
+    rank = q * total
+    prev_le, prev_count = 0.0, 0.0
+    for le, count in items:
+        if count >= rank:
+            if le == float("inf"):
+                return prev_le
+            if count == prev_count:
+                return le
+            return prev_le + (le - prev_le) * (rank - prev_count) / (count - prev_count)
+        prev_le, prev_count = le, count
+    return prev_le
+
+
+def summarize(buckets):
+    if buckets.get(float("inf"), 0) <= 0:
+        return None
+    return {f"p{int(q * 100)}": round(histogram_quantile(buckets, q) * 1000, 2) for q in (0.5, 0.95, 0.99)}
+
+
+def delta(after, before):
+    return Counter({k: v - before.get(k, 0) for k, v in after.items()})
+
+
+def phase_buckets(families, phase):
+    if phase.startswith("queue_"):
+        return histogram_buckets(families, "admission_wait_seconds", stage=phase[len("queue_"):])
+    if phase == "forward":
+        return histogram_buckets(families, "forward_send_latency_seconds")
+    return histogram_buckets(families, "step_phase_seconds", phase=phase)
+
+
+def hop_report(units, before, after, duration):
+    hops = {}
+    for unit in units:
+        sid = unit["id"]
+        frames = histogram_count(after[sid], "step_processing_time_seconds") - \
+            histogram_count(before[sid], "step_processing_time_seconds")
+        hops[str(sid)] = {
+            "type": "+".join(s["type"] for s in unit.get("chain", [unit])),
+            "frames": int(frames),
+            "fps": round(frames / duration, 2),
+            "phases_ms": {p: summarize(delta(phase_buckets(after[sid], p), phase_buckets(before[sid], p)))
+                          for p in PHASES},
+        }
+    return hops
+
+
+def percentiles_ms(samples):
+    if not samples:
+        return None
+    arr = np.array(samples) * 1000
+    return {"p50": round(float(np.percentile(arr, 50)), 2),
+            "p95": round(float(np.percentile(arr, 95)), 2),
+            "p99": round(float(np.percentile(arr, 99)), 2),
+            "max": round(float(arr.max()), 2)}
+
+
+# --- confronto con un run precedente ---
+def compare(result, baseline, tolerance):
+    """Ritorna la lista delle regressioni oltre la tolleranza relativa."""
+    checks = [
+        ("end_to_end.fps", lambda r: r["end_to_end"]["fps"], True),
+        ("client.rps", lambda r: r["client"]["rps"], True),
+        ("end_to_end.latency_ms.p50", lambda r: (r["end_to_end"]["latency_ms"] or {}).get("p50"), False),
+        ("end_to_end.latency_ms.p99", lambda r: (r["end_to_end"]["latency_ms"] or {}).get("p99"), False),
+    ]
+    regressions = []
+    for name, get, higher_is_better in checks:
+        new, old = get(result), get(baseline)
+        if new is None or old is None or old == 0:
+            continue
+        change = (new - old) / old
+        worse = change < -tolerance if higher_is_better else change > tolerance
+        print(f"  {name:<28} {old:>10.2f} -> {new:>10.2f} ({change * 100:+.1f}%){'  REGRESSIONE' if worse else ''}")
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def print_report(result):
+    c, e = result["client"], result["end_to_end"]
+    print(f"client: {c['sent']} inviati, {c['accepted']} accettati, {c['rps']} req/s, "
+          f"ack {c['ack_ms']}, status {c['statuses']}")
+    print(f"end-to-end: {e['frames']} frame, {e['fps']} fps, latenza {e['latency_ms']}")
+    for sid, hop in result["hops"].items():
+        print(f"step {sid} ({hop['type']}): {hop['frames']} frame, {hop['fps']} fps")
+        for phase, stats in hop["phases_ms"].items():
+            if stats:
+                print(f"    {phase:<12} p50 {stats['p50']:>9} ms  p95 {stats['p95']:>9} ms  p99 {stats['p99']:>9} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pipeline", default=os.path.join(TEST_DIR, "pipeline.json"))
+    parser.add_argument("--image", default=os.path.join(TEST_DIR, "your_image.jpg"))
+    parser.add_argument("--concurrency", type=int, default=8, help="client concorrenti sul primo step")
+    parser.add_argument("--duration", type=float, default=30, help="secondi di carico misurati")
+    parser.add_argument("--warmup", type=int, default=5, help="frame di riscaldamento (non misurati)")
+    parser.add_argument("--server-mode", default="flask", choices=("flask", "async", "prefork"))
+    parser.add_argument("--upscaler-ms", type=float, default=200)
+    parser.add_argument("--detection-ms", type=float, default=30)
+    parser.add_argument("--real-steps", action="store_true", help="usa gli step reali invece degli stub")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE aggiuntive per ogni step")
+    parser.add_argument("--load-profile", default="light")
+    parser.add_argument("--test-id", default="bench")
+    parser.add_argument("--port-prefix", default="61", help="porta di uno step = <prefix><id a 2 cifre>")
+    parser.add_argument("--log-dir", default=os.path.join(tempfile.gettempdir(), "bench_pipeline_logs"))
+    parser.add_argument("--output", default="bench_result.json")
+    parser.add_argument("--baseline", help="JSON di un run precedente da confrontare")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="peggioramento relativo ammesso")
+    args = parser.parse_args()
+
+    pipeline_id = "bench"
+    units, configmaps, sink_cm = load_units(args.pipeline, pipeline_id)
+    with open(args.image, "rb") as f:
+        frame = f.read()
+    entry_url = step_url(args.port_prefix, units[0]["id"], "/process")
+
+    sink = Sink(int(f"{args.port_prefix}{SINK_ID:02d}"))
+    procs = start_steps(units, configmaps, sink_cm, args)
+    try:
+        wait_ready(units, args)
+        warmup(entry_url, frame, sink, args)
+        wait_drained(sink)
+
+        before = scrape(units, args)
+        with sink.lock:
+            sink.recording = True
+        start = time.time()
+        acks, statuses = run_load(entry_url, frame, args)
+        load_time = time.time() - start
+        wait_drained(sink)
+        with sink.lock:
+            sink.recording = False
+            e2e = list(sink.latencies)
+        after = scrape(units, args)
+    finally:
+        for p in procs.values():
+            p.terminate()
+        for p in procs.values():
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+        sink.stop()
+
+    sent = sum(statuses.values())
+    result = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "pipeline": os.path.basename(args.pipeline),
+        "config": {k: v for k, v in vars(args).items() if k not in ("baseline", "output", "log_dir")},
+        "client": {
+            "sent": sent,
+            "accepted": statuses.get(202, 0),
+            "statuses": {str(k): v for k, v in statuses.items()},
+            "rps": round(statuses.get(202, 0) / load_time, 2),
+            "ack_ms": percentiles_ms(acks),
+        },
+        "end_to_end": {
+            "frames": len(e2e),
+            "fps": round(len(e2e) / load_time, 2),
+            "latency_ms": percentiles_ms(e2e),
+        },
+        "hops": hop_report(units, before, after, load_time),
+    }
+    print_report(result)
+    with open(args.output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"risultati in {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"confronto con {args.baseline} (tolleranza {args.tolerance * 100:.0f}%):")
+        if compare(result, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import requests
+from PIL import Image
+
+BUILD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "build")
+
+# Confronto locale SERVER_MODE=flask vs SERVER_MODE=async: avvia app.py due
+# volte (ultimo step grayscale, nessun inoltro) e misura throughput e
+# latenza p50/p99 con N client concorrenti.
+#
+#   python3 bench_server.py --clients 32 --duration 15 --size 1280
+
+
+def make_frame(size):
+    rng = np.random.default_rng(0)
+    arr = rng.integers(0, 255, (size * 9 // 16, size, 3), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(arr).save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def start_server(mode, port, args):
+    env = dict(os.environ)
+    env.update({
+        "SERVER_MODE": mode,
+        "SERVICE_PORT": str(port),
+        "PIPELINE_CONFIG": json.dumps({
+            "pipeline_id": "bench", "step_id": 0,
+            "steps": [{"id": 0, "type": "grayscale", "params": {}, "next_step": []}],
+        }),
+        "ADMISSION_CPU_CONCURRENCY": str(args.cpu_concurrency),
+        "SERVER_EXECUTOR_WORKERS": str(args.executor_workers),
+        "SERVER_CONNECTION_LIMIT": str(max(args.clients * 2, 128)),
+    })
+    proc = subprocess.Popen([sys.executable, "app.py"], cwd=BUILD_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{url}/readyz", timeout=1).status_code == 200:
+                return proc, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f"server {mode} non pronto su {url}")
+
+
+def run(url, frame, args):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop = time.time() + args.duration
+
+    def client():
+        session = requests.Session()
+        while time.time() < stop:
+            t0 = time.perf_counter()
+            try:
+                r = session.post(f"{url}/process", files={"image": ("frame.jpg", frame, "image/jpeg")},
+                                 headers={"X-Test-ID": "bench"}, timeout=60)
+                ok = r.status_code == 200
+            except requests.RequestException:
+                ok = False
+            with lock:
+                if ok:
+                    latencies.append(time.perf_counter() - t0)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(args.clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    lat = np.array(latencies or [0]) * 1000
+    return len(latencies) / elapsed, np.percentile(lat, 50), np.percentile(lat, 99), errors[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=15, help="secondi per modalità")
+    parser.add_argument("--size", type=int, default=1280, help="larghezza del frame JPEG")
+    parser.add_argument("--cpu-concurrency", type=int, default=4)
+    parser.add_argument("--executor-workers", type=int, default=8)
+    parser.add_argument("--port", type=int, default=5601)
+    parser.add_argument("--modes", default="flask,async")
+    args = parser.parse_args()
+
+    frame = make_frame(args.size)
+    print(f"frame {args.size}px ({len(frame) // 1024} KB), {args.clients} client, {args.duration}s per modalità")
+    for i, mode in enumerate(args.modes.split(",")):
+        proc, url = start_server(mode, args.port + i, args)
+        try:
+            rps, p50, p99, errors = run(url, frame, args)
+        finally:
+            proc.terminate()
+            proc.wait(timeout=30)
+        print(f"{mode:>6}: {rps:7.1f} req/s  p50 {p50:7.1f} ms  p99 {p99:7.1f} ms  errori {errors}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import json
+import os
+import sys
+import threading
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+BUILD_DIR = os.path.join(TEST_DIR, "..", "build")
+sys.path.insert(0, BUILD_DIR)
+sys.path.insert(0, TEST_DIR)
+
+# Avvia un singolo step di build/app.py fuori da Kubernetes (usato da
+# bench_pipeline.py):
+#   - API Kubernetes finta (fake_kube_watch.py): le ConfigMap della pipeline
+#     arrivano da BENCH_CONFIGMAPS (lista JSON di PIPELINE_CONFIG), così i
+#     veri informer di update_kubernetes_config popolano active_steps_cache
+#   - upscaling/detection sostituiti dagli stub CPU di bench_stubs.py
+#     (BENCH_STUBS=false per usare gli step reali)
+#   - gli indirizzi dei prossimi step vengono da NEXT_STEP_URL_TEMPLATE
+
+
+def fake_cluster():
+    from fake_kube_watch import FakeCluster, configmap
+    cluster = FakeCluster()
+    for i, cm in enumerate(json.loads(os.getenv("BENCH_CONFIGMAPS", "[]"))):
+        cluster.put("configmaps", configmap(f"bench-cm-{i}", cm))
+    return cluster
+
+
+def install_fake_kubernetes(cluster):
+    from kubernetes import client, config
+    config.load_incluster_config = lambda *a, **k: None
+    client.CoreV1Api = lambda *a, **k: cluster
+
+
+def main():
+    cluster = fake_cluster()
+    install_fake_kubernetes(cluster)
+    if os.getenv("BENCH_STUBS", "true").lower() == "true":
+        import bench_stubs
+        bench_stubs.install(sys.modules)
+
+    os.chdir(BUILD_DIR)
+    import app
+
+    # stesso avvio di `python app.py`
+    if app.SERVER_MODE == "prefork":
+        sys.exit(app.prefork.serve(app, start_config=lambda: app.update_kubernetes_config(cluster.watch)))
+    threading.Thread(target=app.update_kubernetes_config, args=(cluster.watch,), daemon=True).start()
+    if app.SERVER_MODE == "async":
+        from asgi_app import serve
+        serve(app)
+    else:
+        import logging
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        app.app.run(host="127.0.0.1", port=int(app.SERVICE_PORT), threaded=True)
+
+
+if __name__ == "__main__":
+    main()
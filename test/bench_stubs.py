@@ -0,0 +1,63 @@
+import os
+import threading
+import time
+import types
+
+from PIL import Image
+
+# Stub CPU di Upscaler e Classifier per test/bench_pipeline.py: stessa
+# interfaccia degli step reali (costruttore con i params della pipeline,
+# run(image, load_profile)), latenza configurabile, nessuna GPU/modello.
+#
+#   BENCH_UPSCALER_MS   latenza per frame dell'upscaler (default 200)
+#   BENCH_UPSCALER_SCALE fattore di resize effettivo (default 2, 1 = nessun resize)
+#   BENCH_DETECTION_MS  latenza per frame del detector (default 30)
+
+BENCH_UPSCALER_MS = float(os.getenv("BENCH_UPSCALER_MS", "200"))
+BENCH_UPSCALER_SCALE = int(os.getenv("BENCH_UPSCALER_SCALE", "2"))
+BENCH_DETECTION_MS = float(os.getenv("BENCH_DETECTION_MS", "30"))
+
+# un solo "acceleratore" per processo, come gpu_lock / gpu_semaphore degli step reali
+_accel_lock = threading.Lock()
+
+
+class StubUpscaler:
+    deterministic = True
+    shared_model = True
+
+    def __init__(self, model_path=None, scale_factor=4, tta=False, **kwargs):
+        self.scale = max(1, BENCH_UPSCALER_SCALE)
+        self.tta = tta
+
+    def run(self, image, load_profile="light"):
+        use_tta = self.tta or (load_profile == "heavy")
+        with _accel_lock:
+            time.sleep(BENCH_UPSCALER_MS * (2 if use_tta else 1) / 1000.0)
+        if self.scale == 1:
+            return image
+        w, h = image.size
+        return image.resize((w * self.scale, h * self.scale), Image.NEAREST)
+
+
+class StubClassifier:
+    shared_model = True
+    def __init__(self, model_name=None, threshold=0.5, **kwargs):
+        self.ready = True
+
+    def run(self, image, load_profile="light"):
+        with _accel_lock:
+            time.sleep(BENCH_DETECTION_MS / 1000.0)
+        return image
+
+
+def install(modules):
+    """Registra gli stub al posto di steps.upscaler / steps.classifier(_light)."""
+    stubs = {
+        "steps.upscaler": {"Upscaler": StubUpscaler},
+        "steps.classifier": {"Classifier": StubClassifier},
+        "steps.classifier_light": {"Classifier": StubClassifier},
+    }
+    for name, attrs in stubs.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        modules[name] = module
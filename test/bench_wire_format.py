@@ -0,0 +1,63 @@
+import argparse
+import io
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "build"))
+from runtime import wire  # noqa: E402
+
+# Confronto per hop: byte sulla rete e CPU (encode lato mittente + decode
+# lato ricevente) tra il percorso JPEG attuale e il formato raw.
+#
+#   python3 bench_wire_format.py --image your_image.jpg --scale 4 --iterations 20
+
+
+def bench_jpeg(image, iterations):
+    size = 0
+    start = time.process_time()
+    for _ in range(iterations):
+        buf = io.BytesIO()
+        image.save(buf, format="JPEG")
+        data = buf.getvalue()
+        size = len(data)
+        Image.open(io.BytesIO(data)).convert("RGB").load()
+    return size, (time.process_time() - start) / iterations
+
+
+def bench_raw(image, iterations, compression):
+    size = 0
+    start = time.process_time()
+    for _ in range(iterations):
+        data = wire.encode_frame(np.asarray(image), compression)
+        size = len(data)
+        Image.fromarray(wire.decode_frame(data)).convert("RGB")
+    return size, (time.process_time() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "your_image.jpg"))
+    parser.add_argument("--scale", type=int, default=1, help="simula l'output dell'upscaler (es. 4)")
+    parser.add_argument("--iterations", type=int, default=10)
+    args = parser.parse_args()
+
+    image = Image.open(args.image).convert("RGB")
+    if args.scale > 1:
+        image = image.resize((image.width * args.scale, image.height * args.scale), Image.BICUBIC)
+    print(f"Frame {image.width}x{image.height}, {args.iterations} iterazioni per formato\n")
+
+    rows = [("jpeg",) + bench_jpeg(image, args.iterations)]
+    for comp in wire.available_compressions():
+        rows.append((wire.format_name(comp),) + bench_raw(image, args.iterations, comp))
+
+    print(f"{'formato':<10} {'byte/hop':>12} {'cpu ms/hop':>12}")
+    for name, size, cpu in rows:
+        print(f"{name:<10} {size:>12} {cpu * 1000:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import os
+import sys
+import threading
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "build"))
+
+# API Kubernetes finta per gli informer (build/runtime/informer.py):
+# ConfigMap ed Endpoints in memoria con resourceVersion crescente e uno
+# stream di eventi per le watch, compreso il 410 Gone dopo compact().
+# Usata da bench_step.py; lanciata da sola esegue un self-check:
+#
+#   python3 fake_kube_watch.py
+
+_KINDS = {
+    "list_namespaced_config_map": "configmaps",
+    "list_namespaced_endpoints": "endpoints",
+    "list_namespaced_pod": "pods",
+}
+
+
+def configmap(name, pipeline_config):
+    return types.SimpleNamespace(metadata=types.SimpleNamespace(name=name),
+                                 data={"PIPELINE_CONFIG": pipeline_config})
+
+
+def endpoints(name, ready, not_ready=0):
+    addr = types.SimpleNamespace
+    subset = types.SimpleNamespace(addresses=[addr(ip=f"10.0.0.{i}") for i in range(ready)] or None,
+                                   not_ready_addresses=[addr(ip=f"10.0.1.{i}") for i in range(not_ready)] or None)
+    return types.SimpleNamespace(metadata=types.SimpleNamespace(name=name), subsets=[subset])
+
+
+class FakeCluster:
+    """Sostituto di CoreV1Api (metodi list_*) più `watch`, da passare come watch_factory."""
+
+    def __init__(self):
+        self._rv = 0
+        self._compacted = 0
+        self._objects = {kind: {} for kind in _KINDS.values()}
+        self._history = []  # (rv, kind, type, obj)
+        self._cond = threading.Condition()
+
+    def put(self, kind, obj):
+        with self._cond:
+            self._rv += 1
+            obj.metadata.resource_version = str(self._rv)
+            event_type = "MODIFIED" if obj.metadata.name in self._objects[kind] else "ADDED"
+            self._objects[kind][obj.metadata.name] = obj
+            self._history.append((self._rv, kind, event_type, obj))
+            self._cond.notify_all()
+
+    def delete(self, kind, name):
+        with self._cond:
+            obj = self._objects[kind].pop(name)
+            self._rv += 1
+            self._history.append((self._rv, kind, "DELETED", obj))
+            self._cond.notify_all()
+
+    def compact(self):
+        """Scarta lo storico: le watch da un resourceVersion precedente ricevono 410."""
+        with self._cond:
+            self._compacted = self._rv
+            self._history = []
+            self._cond.notify_all()
+
+    def _list(self, kind):
+        with self._cond:
+            return types.SimpleNamespace(items=list(self._objects[kind].values()),
+                                         metadata=types.SimpleNamespace(resource_version=str(self._rv)))
+
+    def list_namespaced_config_map(self, namespace, label_selector=None, **kwargs):
+        return self._list("configmaps")
+
+    def list_namespaced_endpoints(self, namespace, label_selector=None, **kwargs):
+        return self._list("endpoints")
+
+    def list_namespaced_pod(self, namespace, label_selector=None, **kwargs):
+        return self._list("pods")
+
+    def watch(self, func, resource_version=None, timeout_seconds=None, allow_watch_bookmarks=False, **kwargs):
+        kind = _KINDS[func.__name__]
+        last = int(resource_version or 0)
+        deadline = time.time() + (timeout_seconds or 300)
+        while time.time() < deadline:
+            with self._cond:
+                if last < self._compacted:
+                    yield {"type": "ERROR", "object": {"code": 410, "message": "too old resource version"}}
+                    return
+                pending = [h for h in self._history if h[0] > last and h[1] == kind]
+                if not pending:
+                    self._cond.wait(min(0.5, max(0.0, deadline - time.time())))
+                    if not allow_watch_bookmarks or last >= self._rv or \
+                            any(h[0] > last and h[1] == kind for h in self._history):
+                        continue
+                    # nessun evento di questo tipo: BOOKMARK con il resourceVersion
+                    # corrente; come il client reale, object è un dict non deserializzato
+                    last = self._rv
+                    raw = {"kind": "Bookmark", "metadata": {"resourceVersion": str(last)}}
+                    pending = [(last, kind, "BOOKMARK", raw)]
+            for rv, _, event_type, obj in pending:
+                last = rv
+                if event_type == "BOOKMARK":
+                    yield {"type": event_type, "object": obj, "raw_object": obj}
+                else:
+                    yield {"type": event_type, "object": obj}
+
+
+def _wait(predicate, timeout=1.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def main():
+    from runtime.informer import Informer
+
+    cluster = FakeCluster()
+    cluster.put("configmaps", configmap("p-step-0", "steps: [{id: 0}]"))
+    cluster.put("configmaps", configmap("p-step-1", "steps: [{id: 1}]"))
+    cluster.put("endpoints", endpoints("p-step-1", ready=0, not_ready=1))
+
+    parsed = []
+    seen = {}
+
+    def parse(cm):
+        parsed.append(cm.metadata.name)
+        return cm.data["PIPELINE_CONFIG"]
+
+    cms = Informer("configmaps", cluster.list_namespaced_config_map, parse,
+                   on_change=lambda items: seen.update(cms=items), watch_factory=cluster.watch,
+                   watch_timeout=2, namespace="default").start()
+    eps = Informer("endpoints", cluster.list_namespaced_endpoints,
+                   lambda ep: sum(len(s.addresses or []) for s in ep.subsets),
+                   on_change=lambda items: seen.update(eps=items), watch_factory=cluster.watch,
+                   watch_timeout=2, namespace="default").start()
+    assert cms.synced.wait(1) and eps.synced.wait(1), "list iniziale non completato"
+    assert set(seen["cms"]) == {"p-step-0", "p-step-1"}
+    assert seen["eps"] == {"p-step-1": 0}
+
+    # la watch delle endpoints resta ferma mentre cambiano le configmap: riceve
+    # BOOKMARK (dict) con il resourceVersion corrente e non deve interrompersi
+    cluster.put("configmaps", configmap("p-step-1", "steps: [{id: 1}]"))
+    assert _wait(lambda: eps.resource_version == str(cluster._rv), timeout=2), "BOOKMARK non applicato"
+
+    start = time.time()
+    cluster.put("configmaps", configmap("p-step-2", "steps: [{id: 2}]"))
+    assert _wait(lambda: "p-step-2" in seen["cms"]), "ADDED non visto entro 1s"
+    print(f"[INFO] ADDED propagato in {(time.time() - start) * 1000:.0f} ms")
+
+    cluster.delete("configmaps", "p-step-0")
+    assert _wait(lambda: "p-step-0" not in seen["cms"]), "DELETED non visto entro 1s"
+
+    cluster.put("endpoints", endpoints("p-step-1", ready=2))
+    assert _wait(lambda: seen["eps"].get("p-step-1") == 2), "endpoint Ready non visti entro 1s"
+
+    # storico compattato: la watch riceve 410, l'informer rifà il list e
+    # ri-analizza solo gli oggetti con resourceVersion cambiato
+    parsed.clear()
+    cluster.compact()
+    cluster.put("configmaps", configmap("p-step-1", "steps: [{id: 1}, {id: 3}]"))
+    assert _wait(lambda: seen["cms"].get("p-step-1") == "steps: [{id: 1}, {id: 3}]", timeout=3), \
+        "cambio dopo 410 non recuperato"
+    assert parsed == ["p-step-1"], f"re-parsing inatteso: {parsed}"
+
+    # una watch scaduta (timeout) riparte dall'ultimo resourceVersion senza list
+    time.sleep(2.5)
+    parsed.clear()
+    cluster.put("configmaps", configmap("p-step-4", "steps: [{id: 4}]"))
+    assert _wait(lambda: "p-step-4" in seen["cms"]), "evento dopo il timeout della watch perso"
+    assert parsed == ["p-step-4"], f"re-parsing inatteso: {parsed}"
+
+    cms.stop()
+    eps.stop()
+    print("[INFO] Informer OK: list, ADDED/MODIFIED/DELETED, endpoint Ready, 410 e ripresa dal resourceVersion")
+
+
+if __name__ == "__main__":
+    main()
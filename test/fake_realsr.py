@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import sys
+import time
+
+from PIL import Image
+
+# Sostituto CPU di realsr-ncnn-vulkan per test e benchmark locali:
+# stessa CLI (-i/-o file o directory, -s, -m, -f, -x), resize bicubico.
+#
+#   UPSCALER_BINARY=/path/test/fake_realsr.py python3 app.py
+#
+# FAKE_REALSR_STARTUP_MS simula il caricamento del modello / device Vulkan
+# (pagato una volta per lancio), FAKE_REALSR_FRAME_MS il costo per frame.
+
+
+def upscale(src, dst, scale, fmt):
+    img = Image.open(src).convert("RGB")
+    img = img.resize((img.width * scale, img.height * scale), Image.BICUBIC)
+    img.save(dst, format="JPEG" if fmt in ("jpg", "jpeg") else fmt.upper())
+    time.sleep(float(os.getenv("FAKE_REALSR_FRAME_MS", "0")) / 1000.0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", required=True)
+    parser.add_argument("-o", required=True)
+    parser.add_argument("-s", type=int, default=4)
+    parser.add_argument("-m", default="")
+    parser.add_argument("-f", default="png")
+    parser.add_argument("-x", action="store_true")
+    args = parser.parse_args()
+
+    time.sleep(float(os.getenv("FAKE_REALSR_STARTUP_MS", "0")) / 1000.0)
+
+    if os.path.isdir(args.i):
+        os.makedirs(args.o, exist_ok=True)
+        for name in sorted(os.listdir(args.i)):
+            base = os.path.splitext(name)[0]
+            upscale(os.path.join(args.i, name), os.path.join(args.o, f"{base}.{args.f}"), args.s, args.f)
+    else:
+        upscale(args.i, args.o, args.s, args.f)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+import argparse
+import time
+
+import requests
+
+# Client dei job: invia un'immagine al primo step (JOB_STORE attivo),
+# interroga /jobs/<id> finché il job non è concluso e salva il risultato.
+#
+#   python3 job_client.py http://<node-ip>:<node-port> your_image.jpg --output result.jpg
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url", help="indirizzo del primo step")
+    parser.add_argument("image")
+    parser.add_argument("--output", default="result.jpg")
+    parser.add_argument("--test-id", default="job-client")
+    parser.add_argument("--load-profile", default="light")
+    parser.add_argument("--callback", help="X-Callback-URL a cui l'ultimo step invia il risultato")
+    parser.add_argument("--poll", type=float, default=0.5, help="secondi tra due interrogazioni")
+    parser.add_argument("--timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    headers = {"X-Test-ID": args.test_id, "X-Load-Profile": args.load_profile}
+    if args.callback:
+        headers["X-Callback-URL"] = args.callback
+    with open(args.image, "rb") as f:
+        r = requests.post(f"{args.url}/process", files={"image": f}, headers=headers)
+
+    if r.status_code == 200:
+        # pipeline a un solo step: il risultato arriva direttamente
+        with open(args.output, "wb") as f:
+            f.write(r.content)
+        print(f"[INFO] Risultato immediato salvato in {args.output}")
+        return
+    if r.status_code != 202 or "job_id" not in r.json():
+        raise SystemExit(f"[ERROR] Risposta inattesa ({r.status_code}): {r.text}")
+
+    job_url = f"{args.url}{r.headers['Location']}"
+    print(f"[INFO] Job {r.json()['job_id']} accettato")
+    start = time.time()
+    while time.time() - start < args.timeout:
+        status = requests.get(job_url).json()
+        if status.get("status") != "pending":
+            break
+        time.sleep(args.poll)
+    else:
+        raise SystemExit("[ERROR] Timeout in attesa del job")
+
+    if status.get("status") != "done":
+        raise SystemExit(f"[ERROR] Job fallito: {status}")
+    result = requests.get(f"{job_url}/result")
+    result.raise_for_status()
+    with open(args.output, "wb") as f:
+        f.write(result.content)
+    print(f"[INFO] Job concluso in {time.time() - start:.2f}s, risultato salvato in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
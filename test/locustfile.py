@@ -1,3 +1,5 @@
+import bisect
+import collections
 import csv
 import json
 import math
@@ -31,6 +33,19 @@ TEST_STOP_TS = None
 REALTIME_RUNNING = True
 LOAD_PROFILE = "light"
 
+# Modalità di log delle richieste:
+# - sync     = una riga di raw_timings scritta e flushata per ogni richiesta,
+#              metriche Prometheus lette dal listener (comportamento storico)
+# - buffered = record in un ring buffer in memoria, scritti a blocchi da un
+#              writer in background; Prometheus e kubectl letti da un timer e
+#              uniti ai record al momento della scrittura
+LOG_MODE = os.getenv("LOCUST_LOG_MODE", "sync").lower()
+RAW_FORMAT = os.getenv("LOCUST_RAW_FORMAT", "csv").lower()  # csv | parquet (solo buffered, richiede pyarrow)
+RING_SIZE = int(os.getenv("LOCUST_RING_SIZE", "100000"))  # record in attesa oltre i quali si scarta
+FLUSH_INTERVAL = float(os.getenv("LOCUST_FLUSH_INTERVAL", "2"))
+KUBECTL_INTERVAL = float(os.getenv("LOCUST_KUBECTL_INTERVAL", "30"))
+CPU_WARN_PERCENT = float(os.getenv("LOCUST_CPU_WARN", "90"))  # % di un core oltre cui il generatore è saturo
+
 # ==========================
 # PROM QUERIES (GLOBALI)
 # ==========================
@@ -52,9 +67,7 @@ histogram_quantile(
 # ==========================
 # FILES
 # ==========================
-raw_file = open("raw_timings.csv", "w", newline="")
-raw_writer = csv.writer(raw_file)
-raw_writer.writerow([
+RAW_COLUMNS = [
     "timestamp",
     "test_id",
     "request_type",
@@ -66,8 +79,24 @@ raw_writer.writerow([
     "http_requests_in_progress",
     "node_ip",
     "load_profile"
-])
-raw_file.flush()
+]
+
+if LOG_MODE == "buffered" and RAW_FORMAT == "parquet":
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        print("⚠️ pyarrow non installato: raw_timings in CSV")
+        RAW_FORMAT = "csv"
+else:
+    RAW_FORMAT = "csv"
+
+raw_file = raw_writer = None
+if RAW_FORMAT == "csv":
+    raw_file = open("raw_timings.csv", "w", newline="")
+    raw_writer = csv.writer(raw_file)
+    raw_writer.writerow(RAW_COLUMNS)
+    raw_file.flush()
 
 # ==========================
 # PROM CACHE
@@ -358,7 +387,6 @@ def node_ip_from_base_url():
 #         LOAD_PROFILE,
 #     ])
 #     raw_file.flush()
-@events.request.add_listener
 def log_request(request_type, name, response_time, response_length, exception, **kwargs):
     gpu_dict, http_dict = get_metrics_cached()
 
@@ -387,6 +415,184 @@ def log_request(request_type, name, response_time, response_length, exception, *
         LOAD_PROFILE,
     ])
     raw_file.flush()
+
+
+# ==========================
+# LOG BUFFERED (LOCUST_LOG_MODE=buffered)
+# ==========================
+# Il listener fa solo un append di una tupla: niente I/O, niente query.
+# Il writer scrive a blocchi ogni FLUSH_INTERVAL secondi; ogni record prende
+# l'ultimo campione Prometheus precedente al suo timestamp (as-of join).
+_ring = collections.deque()
+_ring_dropped = 0
+_rows_written = 0
+_samples = []     # [(gpu_dict, http_dict)] in ordine di tempo
+_samples_ts = []  # timestamp dei campioni, per bisect
+_bg_stop = threading.Event()
+_parquet_writer = None
+
+
+def buffer_request(request_type, name, response_time, response_length, exception, **kwargs):
+    global _ring_dropped
+    if len(_ring) >= RING_SIZE:
+        # writer in ritardo: si scarta invece di far crescere la memoria
+        _ring_dropped += 1
+        return
+    response = kwargs.get("response")
+    _ring.append((
+        time.time(),
+        request_type,
+        name,
+        response_time,
+        exception is None,
+        response.status_code if response is not None else "",
+    ))
+
+
+events.request.add_listener(buffer_request if LOG_MODE == "buffered" else log_request)
+
+
+def sample_at(ts):
+    """Campione (gpu, http) valido al tempo ts: l'ultimo precedente, o il primo se ts è prima di tutti."""
+    i = bisect.bisect_right(_samples_ts, ts) - 1
+    if i < 0:
+        return _samples[0] if _samples_ts else ({}, {})
+    return _samples[i]
+
+
+def enrichment_loop():
+    """Campiona Prometheus ogni CACHE_TTL s e aggiorna le mappe kubectl ogni KUBECTL_INTERVAL s."""
+    global NODE_NAME_MAP, STEP_NODE_MAP, pipeline_node_ips
+    last_kubectl = time.time()
+    while not _bg_stop.is_set():
+        sample = (query_gpu_usage_per_node(), query_http_in_progress_per_step())
+        # prima il campione, poi il timestamp: bisect non vede mai un indice senza campione
+        _samples.append(sample)
+        _samples_ts.append(time.time())
+
+        if time.time() - last_kubectl >= KUBECTL_INTERVAL:
+            last_kubectl = time.time()
+            try:
+                NODE_NAME_MAP = build_node_name_map()
+                STEP_NODE_MAP = get_step_node_map(PIPELINE_ID)
+                pipeline_node_ips = {ip for ips in STEP_NODE_MAP.values() for ip in ips}
+            except Exception as e:
+                print("⚠️ kubectl refresh error:", e)
+
+        _bg_stop.wait(CACHE_TTL)
+
+
+def write_batch():
+    """Svuota il ring buffer su raw_timings (CSV o Parquet) con un solo flush."""
+    global _rows_written, _parquet_writer
+    batch = []
+    while _ring:
+        batch.append(_ring.popleft())
+    if not batch:
+        return
+
+    node_ip = node_ip_from_base_url()
+    rows = []
+    for ts, request_type, name, response_time, ok, status_code in batch:
+        gpu_dict, http_dict = sample_at(ts)
+        rows.append((
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)),
+            TEST_ID,
+            request_type,
+            name,
+            float(response_time),
+            "OK" if ok else "FAIL",
+            str(status_code),
+            float(gpu_dict.get(node_ip, 0) if node_ip else 0),
+            float(http_dict.get("step-0", 0)),
+            node_ip or "ingress",
+            LOAD_PROFILE,
+        ))
+
+    if RAW_FORMAT == "parquet":
+        table = pyarrow.Table.from_arrays(
+            [pyarrow.array(col) for col in zip(*rows)], names=RAW_COLUMNS
+        )
+        if _parquet_writer is None:
+            _parquet_writer = pyarrow.parquet.ParquetWriter("raw_timings.parquet", table.schema)
+        _parquet_writer.write_table(table)  # un row group per blocco
+    else:
+        raw_writer.writerows(
+            r[:4] + (f"{r[4]:.2f}", r[5], r[6], f"{r[7]:.2f}", f"{r[8]:.2f}") + r[9:]
+            for r in rows
+        )
+        raw_file.flush()
+    _rows_written += len(rows)
+
+
+def writer_loop():
+    while not _bg_stop.wait(FLUSH_INTERVAL):
+        try:
+            write_batch()
+        except Exception as e:
+            print("⚠️ raw_timings write error:", e)
+
+
+def close_buffered_log():
+    """Ultimo blocco a fine test (il writer è già fermo)."""
+    global _parquet_writer
+    write_batch()
+    if _parquet_writer is not None:
+        _parquet_writer.close()
+        _parquet_writer = None
+    print(f"📁 raw_timings: {_rows_written} record scritti, {_ring_dropped} scartati (ring pieno)")
+
+
+# ==========================
+# SELF-CHECK DEL GENERATORE
+# ==========================
+# Locust (gevent) usa un solo core per processo: vicino al 100% le richieste
+# partono in ritardo e le latenze misurate includono l'attesa nel generatore.
+# Ogni secondo: CPU del processo (% di un core) e ritardo del timer rispetto
+# al secondo atteso (loop lag), in generator_health.csv.
+_health = []  # [(cpu_percent, loop_lag_ms)]
+
+
+def health_loop():
+    with open("generator_health.csv", "w", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["timestamp", "test_id", "cpu_percent", "loop_lag_ms", "ring_len", "ring_dropped"])
+        last_wall, last_cpu = time.time(), time.process_time()
+        while not _bg_stop.wait(1.0):
+            wall, cpu = time.time(), time.process_time()
+            dt = wall - last_wall
+            cpu_percent = (cpu - last_cpu) / dt * 100 if dt > 0 else 0.0
+            lag_ms = max(0.0, dt - 1.0) * 1000
+            last_wall, last_cpu = wall, cpu
+
+            _health.append((cpu_percent, lag_ms))
+            w.writerow([wall, TEST_ID, round(cpu_percent, 1), round(lag_ms, 1), len(_ring), _ring_dropped])
+            f.flush()
+
+
+def report_generator_health():
+    if not _health:
+        return
+    cpu = [c for c, _ in _health]
+    saturated = sum(1 for c in cpu if c >= CPU_WARN_PERCENT) / len(cpu)
+    print(
+        f"🩺 Generatore: CPU media {sum(cpu) / len(cpu):.0f}%, max {max(cpu):.0f}%, "
+        f"{saturated * 100:.0f}% dei secondi sopra {CPU_WARN_PERCENT:.0f}%, "
+        f"loop lag max {max(l for _, l in _health):.0f} ms"
+    )
+    if saturated > 0.1:
+        hint = "" if LOG_MODE == "buffered" else " o LOCUST_LOG_MODE=buffered"
+        print(f"⚠️ Generatore saturo: le latenze includono il ritardo di Locust, usare più processi (--processes){hint}")
+
+
+def start_background():
+    _bg_stop.clear()
+    del _health[:]
+    threads = [health_loop]
+    if LOG_MODE == "buffered":
+        threads += [enrichment_loop, writer_loop]
+    for target in threads:
+        threading.Thread(target=target, daemon=True).start()
 # ==========================
 # USER
 # ==========================
@@ -503,6 +709,7 @@ def on_test_start(environment, **_):
     with open("realtime_rps.csv", "w", newline="") as f:
         csv.writer(f).writerow(["timestamp", "test_id", "rps", "fail_ratio", "users"])
     export_realtime_metrics(environment)
+    start_background()
 
 # ==========================
 # PROMETHEUS EXPORT PER TEST_ID (FINE TEST)
@@ -705,6 +912,12 @@ def on_test_stop(environment, **_):
     global REALTIME_RUNNING
     REALTIME_RUNNING = False
     duration_s = int(TEST_STOP_TS - (TEST_START_TS or TEST_STOP_TS))
+
+    _bg_stop.set()
+    if LOG_MODE == "buffered":
+        close_buffered_log()
+    report_generator_health()
+
     print(f"📊 Export Prometheus per TEST_ID={TEST_ID}, duration={duration_s}s")
 
     try:
@@ -0,0 +1,522 @@
+import argparse
+import heapq
+import itertools
+import json
+import math
+import os
+import re
+import sys
+from collections import defaultdict, deque
+from multiprocessing import Pool
+
+import numpy as np
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, "..", "build", "topography_tool"))
+from topography import flatten_steps, fuse_steps  # noqa: E402
+
+# Simulatore a eventi discreti della pipeline, per capacity planning prima
+# del deploy:
+#   - legge lo stesso JSON del Topography Tool (flatten + fusione degli step)
+#   - ogni step (unità) ha una fase CPU (decode/encode, ADMISSION_CPU_CONCURRENCY)
+#     e, se usa la GPU, una fase acceleratore (ADMISSION_ACCEL_CONCURRENCY = 1,
+#     uno alla volta) con code limitate (ADMISSION_MAX_QUEUE, oltre -> 429)
+#   - tempi di servizio da istogrammi step_processing_time_seconds (testo di
+#     /metrics o di Prometheus), altrimenti lognormali indicative per tipo;
+#     scalati con il fattore della classe GPU del nodo (nano/xavier/orin)
+#   - routing come choose_next_step: preferred_next, altrimenti il primo
+#     next_step non saturo
+#   - arrivi come il CustomShape di Locust (constant/ramp/step/spike/sinus),
+#     a utenti chiusi (wait_time 0, come locustfile.py) o aperti (Poisson)
+#
+#   python3 simulate_pipeline.py --pipeline pipeline.json --mode closed --users 20 --curve ramp
+#   python3 simulate_pipeline.py --pipeline pipeline.json --find-saturation --slo 30
+#   python3 simulate_pipeline.py --pipeline pipeline.json --sweep-classes nano,xavier,orin --histograms metrics.txt
+
+# come FALLBACK_GPU_FACTOR del priority controller
+GPU_FACTOR = {"nano": 1.0, "xavier": 2.0, "orin": 3.0}
+
+# (media ms, coefficiente di variazione) su nano: valori indicativi, da
+# sostituire con istogrammi misurati (--histograms)
+DEFAULT_SERVICE_MS = {
+    "upscaling": (2500.0, 0.3),
+    "detection": (120.0, 0.3),
+    "grayscale": (15.0, 0.2),
+    "deblur": (180.0, 0.3),
+}
+DEFAULT_CPU_MS = (20.0, 0.3)  # decode + encode + inoltro per richiesta
+RETRY_AFTER_S = 1.0  # attesa del client Locust dopo un 429 all'ingresso
+
+
+# ===== DISTRIBUZIONI =====
+
+class LogNormal:
+    def __init__(self, mean_s, cv):
+        self.mean = mean_s
+        sigma2 = math.log(1 + cv * cv)
+        self.mu = math.log(mean_s) - sigma2 / 2
+        self.sigma = math.sqrt(sigma2)
+
+    def sample(self, rng, n):
+        return rng.lognormal(self.mu, self.sigma, n)
+
+    def scaled(self, factor):
+        d = LogNormal.__new__(LogNormal)
+        d.mean, d.mu, d.sigma = self.mean * factor, self.mu + math.log(factor), self.sigma
+        return d
+
+
+class Empirical:
+    """Distribuzione da istogramma cumulativo (le -> conteggio): inversa della CDF interpolata."""
+
+    def __init__(self, bounds, cdf):
+        self.bounds = np.asarray(bounds, dtype=float)
+        self.cdf = np.asarray(cdf, dtype=float)
+        mids = (self.bounds[1:] + self.bounds[:-1]) / 2
+        self.mean = float(np.sum(mids * np.diff(self.cdf)))
+
+    def sample(self, rng, n):
+        return np.interp(rng.random(n), self.cdf, self.bounds)
+
+    def scaled(self, factor):
+        return Empirical(self.bounds * factor, self.cdf)
+
+
+_BUCKET = re.compile(r'^step_processing_time_seconds_bucket\{(?P<labels>[^}]*)\}\s+(?P<value>\S+)')
+_LABEL = re.compile(r'(\w+)="([^"]*)"')
+
+
+def parse_histograms(text):
+    """{step_id: Empirical} dagli istogrammi step_processing_time_seconds (sommati su pod e test)."""
+    counts = defaultdict(lambda: defaultdict(float))
+    for line in text.splitlines():
+        m = _BUCKET.match(line.strip())
+        if not m:
+            continue
+        labels = dict(_LABEL.findall(m.group("labels")))
+        le = labels.get("le")
+        if le is None or le == "+Inf":
+            continue
+        counts[labels.get("step_id", "?")][float(le)] += float(m.group("value"))
+    dists = {}
+    for step_id, buckets in counts.items():
+        bounds = sorted(buckets)
+        total = buckets[bounds[-1]]
+        if total <= 0:
+            continue
+        dists[step_id] = Empirical([0.0] + bounds, [0.0] + [min(1.0, buckets[b] / total) for b in bounds])
+    return dists
+
+
+class _Sampler:
+    """Campioni pre-generati a blocchi con numpy (il ciclo a eventi resta in Python puro)."""
+
+    def __init__(self, dists, rng, block=4096):
+        self.dists = dists
+        self.rng = rng
+        self.block = block
+        self._buf = []
+
+    def __call__(self):
+        if not self._buf:
+            total = sum(d.sample(self.rng, self.block) for d in self.dists)
+            self._buf = total.tolist()
+        return self._buf.pop()
+
+
+# ===== CARICO (come CustomShape in locustfile.py) =====
+
+def curve_value(curve, t, peak, duration):
+    if curve == "ramp":
+        return peak * t / duration
+    if curve == "step":
+        return (int(t // (duration / 5)) + 1) * peak / 5
+    if curve == "spike":
+        return peak if duration / 4 <= t <= 3 * duration / 4 else peak / 10
+    if curve == "sinus":
+        return (peak / 2) * (1 + math.sin(t / duration * 2 * math.pi))
+    return peak
+
+
+# ===== MODELLO =====
+
+def node_class(step, default):
+    host = ((step.get("nodeSelector") or {}).get("kubernetes.io/hostname") or "").lower()
+    for name in GPU_FACTOR:
+        if name in host:
+            return name
+    return default
+
+
+def build_units(definition):
+    units = fuse_steps(flatten_steps(definition["steps"]))
+    for unit in units:
+        unit["chain"] = unit.get("chain") or [unit]
+        nxt = unit.get("next_step") or []
+        unit["next_ids"] = [int(n) for n in ([nxt] if isinstance(nxt, (int, str)) else nxt)]
+    return units
+
+
+class Station:
+    """Fase con `servers` posti e coda FIFO limitata; statistiche integrate nel tempo."""
+
+    __slots__ = ("servers", "max_queue", "busy", "queue", "last", "q_area", "busy_area", "max_q")
+
+    def __init__(self, servers, max_queue):
+        self.servers = servers
+        self.max_queue = max_queue
+        self.busy = 0
+        self.queue = deque()
+        self.last = 0.0
+        self.q_area = 0.0
+        self.busy_area = 0.0
+        self.max_q = 0
+
+    def advance(self, now):
+        dt = now - self.last
+        self.q_area += len(self.queue) * dt
+        self.busy_area += self.busy * dt
+        self.last = now
+
+    def saturated(self):
+        return len(self.queue) >= self.max_queue
+
+
+def simulate(definition, classes=None, mode="closed", peak=10.0, curve="constant", duration=600.0,
+             histograms=None, measured_on="nano", default_class="nano", cpu_concurrency=2,
+             accel_concurrency=1, max_queue=64, replicas=None, cpu_ms=DEFAULT_CPU_MS,
+             service_ms=None, warmup=0.1, seed=1):
+    """
+    Una simulazione. `classes` {id unità: classe GPU} sovrascrive i nodeSelector;
+    `peak` = utenti (closed) o richieste/s (open) al picco della curva.
+    """
+    rng = np.random.default_rng(seed)
+    units = build_units(definition)
+    by_id = {u["id"]: u for u in units}
+    referenced = {n for u in units for n in u["next_ids"]}
+    entry = next((u["id"] for u in units if u["id"] not in referenced), units[0]["id"])
+    service_ms = dict(DEFAULT_SERVICE_MS, **(service_ms or {}))
+    histograms = histograms or {}
+    classes = classes or {}
+    replicas = replicas or {}
+
+    model = {}
+    for unit in units:
+        uid = unit["id"]
+        gpu = int(unit.get("gpu", 0)) > 0
+        cls = classes.get(uid) or node_class(unit, default_class)
+        factor = GPU_FACTOR[measured_on] / GPU_FACTOR[cls] if gpu else 1.0
+        dists = []
+        for sub in unit["chain"]:
+            d = histograms.get(str(sub["id"]))
+            if d is None:
+                mean, cv = service_ms.get(sub["type"], (100.0, 0.3))
+                d = LogNormal(mean / 1000.0, cv)
+            dists.append(d.scaled(factor) if int(sub.get("gpu", 0)) > 0 else d)
+        n = int(replicas.get(uid, 1))
+        cpu = Station(cpu_concurrency * n, max_queue * n)
+        compute = Station(accel_concurrency * n, max_queue * n) if gpu else None
+        model[uid] = {
+            "class": cls if gpu else "cpu",
+            "cpu": cpu,
+            "compute": compute,
+            "cpu_time": _Sampler([LogNormal(cpu_ms[0] / 1000.0, cpu_ms[1])], rng),
+            "compute_time": _Sampler(dists, rng),
+            "sojourn": [],
+            "rejected": 0,
+        }
+
+    events = []
+    seq = itertools.count()
+    now = 0.0
+    measure_from = duration * warmup
+    e2e = []
+    stats = {"offered": 0, "completed": 0, "rejected": 0}
+
+    def push(t, kind, *data):
+        heapq.heappush(events, (t, next(seq), kind, data))
+
+    def start(station, req, uid, phase):
+        station.advance(now)
+        if station.busy < station.servers:
+            station.busy += 1
+            m = model[uid]
+            service = m["cpu_time"]() if phase == "cpu" else m["compute_time"]()
+            if phase == "cpu" and station is m["cpu"] and m["compute"] is None:
+                service += m["compute_time"]()  # step senza GPU: calcolo nella fase CPU
+            push(now + service, "done", req, uid, phase)
+            return True
+        if station.saturated():
+            return False
+        station.queue.append((req, uid, phase))
+        station.max_q = max(station.max_q, len(station.queue))
+        return True
+
+    def release(station):
+        station.advance(now)
+        station.busy -= 1
+        if station.queue:
+            req, uid, phase = station.queue.popleft()
+            station.busy += 1
+            m = model[uid]
+            service = m["cpu_time"]() if phase == "cpu" else m["compute_time"]()
+            if phase == "cpu" and m["compute"] is None:
+                service += m["compute_time"]()
+            push(now + service, "done", req, uid, phase)
+
+    def enter(req, uid):
+        req["unit_start"] = now
+        if not start(model[uid]["cpu"], req, uid, "cpu"):
+            model[uid]["rejected"] += 1
+            return False
+        return True
+
+    def route(uid):
+        unit = by_id[uid]
+        if not unit["next_ids"]:
+            return None
+        preferred = unit.get("preferred_next")
+        order = ([int(preferred)] if preferred is not None and int(preferred) in unit["next_ids"] else [])
+        order += sorted(n for n in unit["next_ids"] if n not in order)
+        for n in order:
+            if n in model and not model[n]["cpu"].saturated():
+                return n
+        return order[0] if order and order[0] in model else None
+
+    def submit(user):
+        req = {"t0": now, "user": user}
+        if now >= measure_from:
+            stats["offered"] += 1
+        if not enter(req, entry):
+            if now >= measure_from:
+                stats["rejected"] += 1
+            if user is not None:
+                push(now + RETRY_AFTER_S, "user", user)
+            return
+
+    # arrivi
+    if mode == "closed":
+        # numero di utenti aggiornato ogni secondo, come tick() di LoadTestShape
+        for t in range(int(duration)):
+            push(float(t), "users", int(curve_value(curve, t, peak, duration)))
+    else:
+        rate_max = max(curve_value(curve, x, peak, duration) for x in np.linspace(0, duration, 200)) or 1e-9
+        push(rng.exponential(1 / rate_max), "arrival", rate_max)
+
+    wanted_users = 0
+    user_ids = itertools.count()
+    live_users = set()
+
+    while events:
+        now, _, kind, data = heapq.heappop(events)
+        if now > duration:
+            break
+        if kind == "arrival":
+            rate_max = data[0]
+            if rng.random() * rate_max <= curve_value(curve, now, peak, duration):
+                submit(None)
+            push(now + rng.exponential(1 / rate_max), "arrival", rate_max)
+        elif kind == "users":
+            wanted_users = data[0]
+            while len(live_users) < wanted_users:
+                user = next(user_ids)
+                live_users.add(user)
+                submit(user)
+        elif kind == "user":
+            user = data[0]
+            if len(live_users) > wanted_users:
+                live_users.discard(user)  # utente in eccesso: si ritira
+            else:
+                submit(user)
+        elif kind == "done":
+            req, uid, phase = data
+            m = model[uid]
+            station = m[phase]
+            release(station)
+            if phase == "cpu" and m["compute"] is not None:
+                if not start(m["compute"], req, uid, "compute"):
+                    m["rejected"] += 1
+                    _finish_rejected(req, uid, entry, stats, now, measure_from, push)
+                continue
+            # unità conclusa
+            if req["t0"] >= measure_from:
+                m["sojourn"].append(now - req["unit_start"])
+            if uid == entry and req["user"] is not None:
+                push(now, "user", req["user"])  # 202 al client: nuova richiesta
+            nxt = route(uid)
+            if nxt is None:
+                if req["t0"] >= measure_from:
+                    stats["completed"] += 1
+                    e2e.append(now - req["t0"])
+                continue
+            if not enter(req, nxt) and req["t0"] >= measure_from:
+                stats["rejected"] += 1
+
+    measured = max(duration - measure_from, 1e-9)
+    result = {
+        "offered": stats["offered"],
+        "completed": stats["completed"],
+        "rejected": stats["rejected"],
+        "throughput": stats["completed"] / measured,
+        "e2e": _percentiles(e2e),
+        "units": {},
+    }
+    for uid, m in model.items():
+        m["cpu"].advance(now)
+        stage = m["compute"] or m["cpu"]
+        stage.advance(now)
+        result["units"][str(uid)] = {
+            "class": m["class"],
+            "utilization": stage.busy_area / (now * stage.servers) if now else 0.0,
+            "mean_queue": (m["cpu"].q_area + (m["compute"].q_area if m["compute"] else 0.0)) / now if now else 0.0,
+            "max_queue": max(m["cpu"].max_q, m["compute"].max_q if m["compute"] else 0),
+            "rejected": m["rejected"],
+            "latency": _percentiles(m["sojourn"]),
+        }
+    return result
+
+
+def _finish_rejected(req, uid, entry, stats, now, measure_from, push):
+    if req["t0"] >= measure_from:
+        stats["rejected"] += 1
+    if uid == entry and req["user"] is not None:
+        push(now + RETRY_AFTER_S, "user", req["user"])
+
+
+def _percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    arr = np.asarray(values)
+    p50, p95, p99 = np.percentile(arr, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+
+def sustainable(result, slo, max_reject=0.01, min_completed=0.95):
+    """Nessun accumulo: pochi 429, completate quasi tutte le ammesse, p99 entro lo SLO."""
+    if not result["offered"]:
+        return True
+    admitted = result["offered"] - result["rejected"]
+    ok = result["rejected"] / result["offered"] <= max_reject and result["completed"] >= min_completed * admitted
+    p99 = result["e2e"]["p99"]
+    return ok and (slo is None or (p99 is not None and p99 <= slo))
+
+
+def find_saturation(definition, slo=None, lo=0.01, hi=None, iterations=10, **kwargs):
+    """Massima rate (open, costante) sostenibile secondo sustainable(), per bisezione."""
+    kwargs = dict(kwargs, mode="open", curve="constant")
+    if hi is None:
+        hi = 1.0
+        while sustainable(simulate(definition, peak=hi, **kwargs), slo) and hi < 1e4:
+            lo, hi = hi, hi * 2
+    for _ in range(iterations):
+        mid = (lo + hi) / 2
+        if sustainable(simulate(definition, peak=mid, **kwargs), slo):
+            lo = mid
+        else:
+            hi = mid
+    at = simulate(definition, peak=lo, **kwargs)
+    bottleneck = max(at["units"].items(), key=lambda kv: kv[1]["utilization"])[0]
+    return {"rate": lo, "bottleneck": bottleneck, "at_saturation": at}
+
+
+def _sweep_one(job):
+    definition, classes, slo, kwargs = job
+    sat = find_saturation(definition, slo=slo, classes=classes, **kwargs)
+    cost = sum(GPU_FACTOR[c] for c in classes.values())
+    return {"classes": classes, "cost": cost, "rate": sat["rate"], "bottleneck": sat["bottleneck"],
+            "p99": sat["at_saturation"]["e2e"]["p99"]}
+
+
+def print_result(result):
+    e2e = result["e2e"]
+    fmt = lambda v: "-" if v is None else f"{v:.2f}"  # noqa: E731
+    print(f"offerte {result['offered']}  completate {result['completed']}  429 {result['rejected']}  "
+          f"throughput {result['throughput']:.2f}/s  e2e p50 {fmt(e2e['p50'])}s p95 {fmt(e2e['p95'])}s "
+          f"p99 {fmt(e2e['p99'])}s")
+    print(f"{'step':>5} {'classe':<7} {'util':>6} {'coda media':>11} {'coda max':>9} {'429':>6} "
+          f"{'p95 s':>8} {'p99 s':>8}")
+    for uid, u in sorted(result["units"].items(), key=lambda kv: int(kv[0])):
+        print(f"{uid:>5} {u['class']:<7} {u['utilization'] * 100:>5.0f}% {u['mean_queue']:>11.1f} "
+              f"{u['max_queue']:>9} {u['rejected']:>6} {fmt(u['latency']['p95']):>8} {fmt(u['latency']['p99']):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pipeline", default=os.path.join(TEST_DIR, "pipeline.json"))
+    parser.add_argument("--mode", default="closed", choices=("closed", "open"),
+                        help="closed: utenti Locust (wait_time 0); open: arrivi di Poisson")
+    parser.add_argument("--users", type=float, default=10, help="utenti al picco (closed)")
+    parser.add_argument("--rate", type=float, default=1.0, help="richieste/s al picco (open)")
+    parser.add_argument("--curve", default="constant", choices=("constant", "ramp", "step", "spike", "sinus"))
+    parser.add_argument("--duration", type=float, default=600, help="secondi simulati")
+    parser.add_argument("--histograms", help="testo Prometheus con step_processing_time_seconds (es. curl /metrics)")
+    parser.add_argument("--measured-on", default="nano", choices=sorted(GPU_FACTOR),
+                        help="classe GPU su cui sono stati misurati gli istogrammi")
+    parser.add_argument("--default-class", default="nano", choices=sorted(GPU_FACTOR))
+    parser.add_argument("--class", dest="classes", action="append", default=[], help="ID=classe, es. 0=orin")
+    parser.add_argument("--replicas", action="append", default=[], help="ID=N pod dello step")
+    parser.add_argument("--service", action="append", default=[], help="TIPO=MEDIA_MS[:CV] su nano")
+    parser.add_argument("--cpu-concurrency", type=int, default=2)
+    parser.add_argument("--accel-concurrency", type=int, default=1)
+    parser.add_argument("--max-queue", type=int, default=64)
+    parser.add_argument("--find-saturation", action="store_true", help="cerca la massima rate sostenibile")
+    parser.add_argument("--slo", type=float, help="p99 end-to-end massimo (s) per la ricerca della saturazione")
+    parser.add_argument("--sweep-classes", help="classi da provare su ogni step GPU, es. nano,xavier,orin")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="JSON con i risultati")
+    args = parser.parse_args()
+
+    with open(args.pipeline) as f:
+        definition = json.load(f)
+    histograms = {}
+    if args.histograms:
+        with open(args.histograms) as f:
+            histograms = parse_histograms(f.read())
+        print(f"[INFO] Istogrammi per gli step {sorted(histograms)}")
+    service = {}
+    for item in args.service:
+        name, _, spec = item.partition("=")
+        mean, _, cv = spec.partition(":")
+        service[name] = (float(mean), float(cv or 0.3))
+    kwargs = dict(
+        duration=args.duration, histograms=histograms, measured_on=args.measured_on,
+        default_class=args.default_class, cpu_concurrency=args.cpu_concurrency,
+        accel_concurrency=args.accel_concurrency, max_queue=args.max_queue,
+        replicas={int(k): int(v) for k, v in (r.split("=") for r in args.replicas)},
+        service_ms=service, seed=args.seed,
+    )
+    classes = {int(k): v for k, v in (c.split("=") for c in args.classes)}
+
+    if args.sweep_classes:
+        options = args.sweep_classes.split(",")
+        gpu_units = [u["id"] for u in build_units(definition) if int(u.get("gpu", 0)) > 0]
+        jobs = [(definition, dict(zip(gpu_units, combo)), args.slo, kwargs)
+                for combo in itertools.product(options, repeat=len(gpu_units))]
+        print(f"[INFO] {len(jobs)} configurazioni su {args.workers} processi")
+        with Pool(args.workers) as pool:
+            results = pool.map(_sweep_one, jobs)
+        results.sort(key=lambda r: (-r["rate"], r["cost"]))
+        print(f"{'rate/s':>8} {'costo':>6} {'collo':>6}  classi")
+        for r in results[:args.top]:
+            print(f"{r['rate']:>8.3f} {r['cost']:>6.0f} {r['bottleneck']:>6}  "
+                  + " ".join(f"{k}={v}" for k, v in sorted(r["classes"].items())))
+        output = results
+    elif args.find_saturation:
+        output = find_saturation(definition, slo=args.slo, classes=classes, **kwargs)
+        print(f"Saturazione a {output['rate']:.3f} richieste/s (collo di bottiglia: step {output['bottleneck']})")
+        print_result(output["at_saturation"])
+    else:
+        peak = args.users if args.mode == "closed" else args.rate
+        output = simulate(definition, classes=classes, mode=args.mode, peak=peak, curve=args.curve, **kwargs)
+        print_result(output)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+        print(f"[INFO] Risultati salvati in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
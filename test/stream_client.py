@@ -0,0 +1,97 @@
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+import requests
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "build"))
+from runtime import framestream  # noqa: E402
+
+# Client di /stream: invia una sequenza di frame (video o immagine ripetuta)
+# su una sola connessione HTTP chunked e stampa il riepilogo della pipeline.
+#
+#   python3 stream_client.py http://<node-ip>:<node-port> --image your_image.jpg --frames 100 --fps 25
+#   python3 stream_client.py http://<node-ip>:<node-port> --video camera.mp4
+
+
+def frames_from_image(path, count):
+    with open(path, "rb") as f:
+        data = f.read()
+    for _ in range(count):
+        yield data
+
+
+def frames_from_video(path, count):
+    import cv2
+    cap = cv2.VideoCapture(path)
+    sent = 0
+    try:
+        while count <= 0 or sent < count:
+            ok, bgr = cap.read()
+            if not ok:
+                return
+            buf = io.BytesIO()
+            Image.fromarray(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)).save(buf, format="JPEG", quality=90)
+            sent += 1
+            yield buf.getvalue()
+    finally:
+        cap.release()
+
+
+def body(frames, fps, stats):
+    interval = 1.0 / fps if fps > 0 else 0
+    next_at = time.time()
+    seq = 0
+    for data in frames:
+        if interval:
+            delay = next_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            next_at += interval
+        yield framestream.encode_record(framestream.KIND_JPEG, seq, data)
+        stats["sent"] = seq + 1
+        stats["bytes"] += len(data)
+        seq += 1
+    yield framestream.end_record(seq)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url", help="base URL del primo step (es. http://127.0.0.1:5000)")
+    parser.add_argument("--image", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "your_image.jpg"))
+    parser.add_argument("--video", help="file video (richiede opencv); ha precedenza su --image")
+    parser.add_argument("--frames", type=int, default=100, help="frame da inviare (0 = tutto il video)")
+    parser.add_argument("--fps", type=float, default=0, help="frame al secondo (0 = il più veloce possibile)")
+    parser.add_argument("--test-id", default="stream")
+    parser.add_argument("--load-profile", default="light")
+    args = parser.parse_args()
+
+    frames = frames_from_video(args.video, args.frames) if args.video else frames_from_image(args.image, args.frames)
+    stats = {"sent": 0, "bytes": 0}
+    start = time.time()
+    r = requests.post(
+        args.url.rstrip("/") + "/stream",
+        data=body(frames, args.fps, stats),
+        headers={
+            "Content-Type": framestream.CONTENT_TYPE_STREAM,
+            "X-Test-ID": args.test_id,
+            "X-Load-Profile": args.load_profile,
+        },
+        timeout=(5, 3600),
+    )
+    elapsed = time.time() - start
+
+    print(f"inviati {stats['sent']} frame ({stats['bytes'] // 1024} KB) in {elapsed:.2f}s "
+          f"-> {stats['sent'] / elapsed:.1f} fps, status {r.status_code}")
+    try:
+        print(json.dumps(r.json(), indent=2))
+    except ValueError:
+        print(r.text)
+
+
+if __name__ == "__main__":
+    main()
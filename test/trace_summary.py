@@ -0,0 +1,48 @@
+import argparse
+import json
+from collections import defaultdict
+
+import numpy as np
+
+# Riepilogo degli span esportati con TRACE_EXPORT=file:<percorso>:
+# per ogni step e fase, percentili della durata e quota sul tempo totale
+# delle richieste tracciate (dove vanno i millisecondi).
+#
+#   python3 trace_summary.py /tmp/spans.jsonl
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("spans", help="file JSONL (formato Zipkin v2, uno span per riga)")
+    args = parser.parse_args()
+
+    durations = defaultdict(list)
+    traces = defaultdict(list)
+    with open(args.spans) as f:
+        for line in f:
+            span = json.loads(line)
+            key = (span["tags"].get("step_id", "?"), span["name"])
+            durations[key].append(span["duration"] / 1000.0)
+            traces[span["traceId"]].append(span)
+
+    # latenza per trace: dal primo inizio all'ultima fine tra tutti gli step
+    totals = []
+    for spans in traces.values():
+        start = min(s["timestamp"] for s in spans)
+        end = max(s["timestamp"] + s["duration"] for s in spans)
+        totals.append((end - start) / 1000.0)
+    total_ms = sum(totals) or 1.0
+
+    print(f"{len(traces)} trace, latenza p50 {np.percentile(totals, 50):.1f} ms, "
+          f"p99 {np.percentile(totals, 99):.1f} ms")
+    print(f"{'step':>5} {'fase':<10} {'n':>6} {'p50 ms':>9} {'p99 ms':>9} {'quota':>7}")
+    for (step_id, name), values in sorted(durations.items()):
+        if name.startswith("step-"):
+            continue
+        arr = np.array(values)
+        print(f"{step_id:>5} {name:<10} {len(arr):>6} {np.percentile(arr, 50):>9.1f} "
+              f"{np.percentile(arr, 99):>9.1f} {arr.sum() / total_ms * 100:>6.1f}%")
+
+
+if __name__ == "__main__":
+    main()